@@ -2,73 +2,140 @@
 
 # imports
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-import seaborn as sns
-import statistics
-from scipy.stats import linregress
-from matplotlib.backends.backend_pdf import PdfPages
 import glob
 import os
 import datetime
-from statsmodels.tsa.seasonal import STL
-from bangla import tmplt, complete_date_range
+from bangla import tmplt, stl_params, load_monthly_stations, monthly_seasonal
+from fast_render import page_axes, finish_page, savefig_options, pyplot
+from station_catalog import StationCatalog, DangerLevelIndex, station_id_from_path
+from parallel_run import paginate
+from result_cache import ResultCache, content_hash, run_pages_cached
+from stage_trace import stage, staged, start_trace, stop_trace
+from monthly_aggregation import monthly_from_daily, monthly_station_frames
 
 
 
 
 
-# getting all the station data  (input path)
-folder_path = '/Users/biar/Desktop/cleaned_BWDB_tidal_data_1985_2018'             ### change the path name when needed 
-csv_files = glob.glob(f'{folder_path}/*.csv')
+# draws one page of (up to) four cleaned monthly station files
+def plot_page_cleaned(page, shared):
+    DL_data, station_frames, seasonal_by_file, fast = shared
 
-#getting the danger level water data
-DL_data = pd.read_csv('/Users/biar/Desktop/SWL_DL_extracted_from_interpolated.csv')
+    fig, axes = page_axes(fast)
 
+    for i in range(4):
+        if i < len(page):
+            file_path = page[i]
+            station_name = station_id_from_path(file_path)
 
-print(f"Found {len(csv_files)} CSV files to process")
+            #the df completed to the range 1985-2018 
+            df = station_frames[file_path]
 
+            with stage('tmplt', station_name):
+                tmplt(df, station_name, axes[i],DL_data, seasonal_by_file.get(file_path), fast)
 
 
-## setting output path
-output_path='/Users/biar/Desktop/cleaned_tidal_plots.pdf'                         ### change the output path when needed 
 
 
+        else:
+            axes[i].set_visible(False)  
 
+    return finish_page(fig, fast)
 
 
 
-###the main loop
-# loop through all the stations 
-with PdfPages(output_path) as pdf:
+# cache key of a page: the station series, their danger level rows and the STL settings
+def cleaned_page_key(page, shared):
+    DL_data, station_frames = shared[:2]
+    station_names = [station_id_from_path(file_path) for file_path in page]
 
-    for j in range(0, len(csv_files), 4):
-        fig, axes = plt.subplots(nrows=4, ncols=1, figsize=(12, 18))
+    parts = []
+    for file_path, station_name in zip(page, station_names):
+        parts.append(station_frames[file_path])
+        parts.append(DL_data.frame(station_name))
 
-        for i in range(4):
-            if j + i < len(csv_files):
-                file_path = csv_files[j + i]
-                file_name = os.path.basename(file_path)
-                file_name = os.path.splitext(file_name)[0]
-                station_name = file_name.split('_monthly')[0]
+    return '+'.join(station_names), content_hash('cleaned_page', parts, stl_params, shared[3])
 
-                df = pd.read_csv(file_path)
 
 
-                #making the df the complete df with range 1985-2018 
-                df = complete_date_range(df)  
 
-                tmplt(df, station_name, axes[i],DL_data)
-                   
 
+if __name__ == "__main__":
 
+    # the plotting stack, only the report pages need it (see fast_render.pyplot)
+    from matplotlib.backends.backend_pdf import PdfPages
+    plt = pyplot()
 
-            else:
-                axes[i].set_visible(False)  
+    # getting all the station data  (input path)
+    folder_path = '/Users/biar/Desktop/cleaned_BWDB_tidal_data_1985_2018'             ### change the path name when needed 
+    DL_path = '/Users/biar/Desktop/SWL_DL_extracted_from_interpolated.csv'
 
-        plt.tight_layout()
-        pdf.savefig(fig, bbox_inches='tight')
-        plt.close(fig)
-        
-print(f"PDF saved to: {os.path.abspath(output_path)}")
+    # the station catalog of the folder, kept next to the data and only rebuilt when a file changed
+    catalog = StationCatalog([(folder_path, 'monthly', 'tidal')], danger_level_path=DL_path,
+                             catalog_path=os.path.join(folder_path, '.station_catalog.json'))
+    csv_files = catalog.files('monthly')
 
+    #getting the danger level water data (one lookup per station instead of a filter over the table)
+    DL_data = DangerLevelIndex(pd.read_csv(DL_path))
+
+
+    print(f"Found {len(csv_files)} CSV files to process")
+
+
+
+    ## setting output path
+    output_path='/Users/biar/Desktop/cleaned_tidal_plots.pdf'                         ### change the output path when needed 
+
+    ## number of worker processes (1 = the old single process loop, None = all cores)
+    n_workers = 1                                                                     ### change when needed 
+
+    ## result cache, unchanged pages are reused from here on the next run (None = no cache)
+    cache_dir = None                                                                  ### change when needed 
+    cache = ResultCache(cache_dir, max_bytes=2 * 1024 ** 3) if cache_dir else None
+
+    ## fast rendering: one reused figure, lines drawn the quick way (smaller PDF, same statistics)
+    fast_render = False                                                               ### change when needed 
+
+    ## the monthly series aggregated from the merged daily CSV (mean, min, max of every month) instead of the monthly
+    ## files of folder_path (None = the files), a month needs min_valid_days days of data; cached in cache_dir
+    daily_csv_path = None                                                             ### change when needed 
+    min_valid_days = 20                                                               ### change when needed 
+
+    ## stage timing: every stage of every station into this JSON lines file (None = off, see stage_trace.py),
+    ## the peak memory of every stage and station too (tracemalloc, slows the run down) and cProfile over one
+    ## station (None = no profile)
+    trace_path = None                                                                 ### change when needed 
+    trace_memory = False                                                              ### change when needed 
+    profile_station = None                                                            ### change when needed 
+    if trace_path or trace_memory or profile_station:
+        start_trace(trace_path, memory=trace_memory, profile_station=profile_station)
+
+
+
+
+    # reading all the stations (the files, or every station of the daily matrix) and their STL in one batch
+    if daily_csv_path:
+        station_frames = monthly_station_frames(monthly_from_daily(daily_csv_path, cache=cache, min_valid_days=min_valid_days))
+        csv_files = list(station_frames)
+        print(f"{len(csv_files)} stations aggregated to months from: {daily_csv_path}")
+    else:
+        station_frames = load_monthly_stations(csv_files)
+    seasonal_by_file = monthly_seasonal(station_frames, csv_files, cache=cache)
+
+
+    ###the main loop
+    # loop through all the stations, four to a page, pages come back in order even with several workers
+    with PdfPages(output_path) as pdf:
+
+        for page_number, fig in enumerate(staged(run_pages_cached(plot_page_cleaned, paginate(csv_files), cache, cleaned_page_key,
+                                    n_workers=n_workers, shared=(DL_data, station_frames, seasonal_by_file, fast_render)), 'draw_page')):
+
+            with stage('savefig', page=page_number + 1):
+                pdf.savefig(fig, **savefig_options(fast_render))
+            plt.close(fig)
+            
+    print(f"PDF saved to: {os.path.abspath(output_path)}")
+
+    # the slowest stages and stations of the run (when traced)
+    stop_trace()
@@ -2,25 +2,42 @@
 
 # imports
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-import seaborn as sns
-import statistics
-from scipy.stats import linregress
-from matplotlib.backends.backend_pdf import PdfPages
-import glob
 import os
 import datetime
-from statsmodels.tsa.seasonal import STL
-import shutil
+from parallel_run import paginate
+from exceedance import exceedance_engine
+from result_cache import ResultCache, content_hash, run_pages_cached
+from calendar_grid import monthly_grid
+from seasonal_decomposition import decompose_stations
+from station_catalog import StationCatalog, DangerLevelIndex, station_id_from_path, link_files
+from fast_render import plot_series, plot_trend, page_axes, finish_page, savefig_options, pyplot
+from stage_trace import stage, staged, start_trace, stop_trace
+from quality_check import quality_table, REASON_TOO_FEW, REASON_LONG_GAP, REASON_MULTIPLE_GAPS
+from seasonal_trends import seasonal_trends
+from monthly_aggregation import monthly_from_daily, monthly_station_frames
+from station_io import read_stations, read_monthly_station, READ_THREADS
+
+
+
+# the STL and quality check settings (also part of the result cache keys)
+stl_params = {'seasonal': 13, 'period': 12, 'robust': True}
+quality_thresholds = {'min_valid_months': 204, 'long_gap_months': 60, 'multiple_gap_months': 24, 'max_multiple_gaps': 1}
 
 
 
 # the time series plot function
-def tmplt (stationdata,station_name,ax,danger_level_data):
+# seasonal: the STL seasonal component on the rows of stationdata (from decompose_stations), None fits it here
+# fast=True draws the lines the quick way (see fast_render.py)
+def tmplt (stationdata,station_name,ax,danger_level_data,seasonal=None,fast=False):
+    from scipy.stats import linregress
+
     dt_used = stationdata.copy()
 
-    matching_station = danger_level_data[danger_level_data['StationID'] == station_name]     # check the matching stations 
+    # the station's danger level record (danger_level_data: the table or its station_catalog.DangerLevelIndex)
+    if not isinstance(danger_level_data, DangerLevelIndex):
+        danger_level_data = DangerLevelIndex(danger_level_data)
+    matching_station = danger_level_data.get(station_name)
 
     #cleaning NaN only for regression 
     dt_cleaned = dt_used.dropna() # for the regression to run smoothly 
@@ -28,22 +45,25 @@ def tmplt (stationdata,station_name,ax,danger_level_data):
     ## plotting the time series lines and regression part 
 
 
-    # stl decomposition
-    dt_for_stl = dt_cleaned['SWLavg']
-    stl = STL(dt_for_stl, seasonal = 13, period =12 , robust =True)
-    stl_result= stl.fit()
+    # stl decomposition (the months without data are left out of the fit)
+    if seasonal is None:
+        with stage('stl', station_name):
+            seasonal = decompose_stations(dt_used['SWLavg'], [station_name], stl_params, min_valid=2)['seasonal'][:, 0]
 
-    seas = stl_result.seasonal
+    seas = pd.Series(seasonal, index=dt_used.index)[dt_used['SWLavg'].notna().to_numpy()]
 
     deseasonalised_swlavg = dt_cleaned['SWLavg']-seas
 
     #fit a linear trend to the deseasonalised data
-    slope, intercept, r_value, p_value, std_err = linregress(dt_cleaned['DecYear'],deseasonalised_swlavg)
+    with stage('regression', station_name):
+        slope, intercept, r_value, p_value, std_err = linregress(dt_cleaned['DecYear'],deseasonalised_swlavg)
 
-    dt_used.plot(x='DecYear',y='SWLavg',  ax=ax,label='Average surface water level')
+    if fast:
+        plot_series(ax, dt_used['DecYear'], dt_used['SWLavg'], fast, label='Average surface water level')
+    else:
+        dt_used.plot(x='DecYear',y='SWLavg',  ax=ax,label='Average surface water level')
 
-    trend_line = slope*dt_used['DecYear'] +intercept
-    ax.plot(dt_used['DecYear'], trend_line, color='orange', label=f'Linear trend (deseasonalised) slope: {slope:.2f}', linewidth=2)
+    plot_trend(ax, dt_used['DecYear'], slope, intercept, fast, color='orange', label=f'Linear trend (deseasonalised) slope: {slope:.2f}', linewidth=2)
 
 
 
@@ -56,14 +76,14 @@ def tmplt (stationdata,station_name,ax,danger_level_data):
 
     ## matching the danger level station id and station name 
 
-    if matching_station.empty:
+    if matching_station is None:
         print(f"[Warning] No matching station name for station id: {station_name}")
         ax.set_title(f'{station_name} Water Level Monthly Trend (1985-2018)')
         ax.text(1.02, 0.6, 'No Station Danger Level Record', transform=ax.transAxes, color='red', verticalalignment='top')
 
     else:
-        actual_name = matching_station['StationNam'].iloc[0]
-        river_name = matching_station['RiverName'].iloc[0]
+        actual_name = matching_station['StationNam']
+        river_name = matching_station['RiverName']
         ax.set_title(f'{station_name}-{actual_name} (River: {river_name}) Water Level Monthly Trend (1985-2018)')
 
 
@@ -79,22 +99,21 @@ def tmplt (stationdata,station_name,ax,danger_level_data):
 
     #plotting the danger level and calculating num of times exceeded 
     count = 0
-    if not matching_station.empty:
+    if matching_station is not None:
         
-        danger_level = matching_station['DLm'].iloc[0] 
+        danger_level = matching_station['DLm'] 
         
 
         if pd.isna(danger_level):
-            danger_level = matching_station['DLmInterp'].iloc[0]
+            danger_level = matching_station['DLmInterp']
             interpolated_note = '(Interpolated) '
         else: 
             interpolated_note = ''
         
-        for watervalue in stationdata['SWLavg']:
-            if watervalue >  danger_level:
-                count += 1
-
-        percentage = (count/(len(stationdata.dropna())))*100
+        with stage('exceedance', station_name):
+            exceedance = exceedance_engine(stationdata['SWLavg'], [danger_level], stationdata['DateTMS'], [station_name])
+        count = int(exceedance['count'][0])
+        percentage = exceedance['percentage'][0]
         ax.text(1.02, 0.6,f'{interpolated_note}Danger Level Exceeded Times: {count} ({percentage:.2f}%)', transform=ax.transAxes, color='red', verticalalignment='top')
         ax.axhline(danger_level, color='red', linestyle='-', label=f'Danger Water Level: {danger_level:.2f}')
 
@@ -114,40 +133,98 @@ def tmplt (stationdata,station_name,ax,danger_level_data):
     ax.grid(True)
 
 
-# applying the criterias (the filtering process)
-def fails_quality_check(sdata,ax):
+# the title a skipped station gets on its page
+skipped_titles = {REASON_TOO_FEW: 'Less than 50% of data',
+                  REASON_LONG_GAP: 'Long continuous gap',
+                  REASON_MULTIPLE_GAPS: 'Multiple gaps'}
+
+
+def mark_skipped(ax, station_name, reason):
+    print(f"Skipping {station_name}: {reason}")
+    ax.set_title(f'{station_name} - Skipped: {skipped_titles.get(reason, reason)}')
 
 
-    # 1. less than 17/34 years
-    years_with_data = sdata.loc[sdata['SWLavg'].notna(), 'DecYear'].unique()
-    if len(years_with_data) < 204:
-        print(f"Skipping {station_name}: Covering too few years")
-        ax.set_title(f'{station_name} - Skipped: Less than 50% of data')
-        return ax, True
-    
-    # 2. Long continuous gap (more than 5 years)
-    sdata['HasData'] = sdata['SWLavg'].notna().astype(int)
-    sdata['GapGroup'] = (sdata['HasData'].diff() != 0).cumsum()
-    gap_lengths = sdata[sdata['HasData'] == 0].groupby('GapGroup').size()
-    if (gap_lengths >= 60).any():
-        print(f'Skipping {station_name}: Long continuous gap')
-        ax.set_title(f'{station_name} - Skipped: Long continuous gap')
-        return ax, True
-    
-    # 3. Multiple gaps with each more than 2 years
-    if (gap_lengths >= 24).sum() > 1:
-        print(f'Skipping {station_name}: Multiple long gaps')
-        ax.set_title(f'{station_name} - Skipped: Multiple gaps')
-        return ax, True
 
-    # 4. Sudden changes          (need to be discussed)
-    #sdata['Change'] = sdata['SWLavg'].diff().abs()
-    #if (sdata['Change'] > 1.5).any():  # adjust threshold
-    #    print(f'Skipping {station_name}: Abrupt changes')
-    #    ax.set_title(f'{station_name} - Skipped: Abrupt changes')
-    #    return ax, True
+# applying the criterias (the filtering process) to one station, see quality_check.quality_table
+#   1. less than 17/34 years, 2. long continuous gap (5 years or more), 3. multiple gaps of 2 years or more
+# (4. sudden changes still need to be discussed)
+def fails_quality_check(sdata,ax,station_name):
 
-    return False
+    qc = quality_table(sdata['SWLavg'], [station_name], **quality_thresholds).iloc[0]
+    if qc['Passed']:
+        return False
+
+    mark_skipped(ax, station_name, qc['Reason'])
+    return True
+
+
+
+# reading the monthly station files and completing them to 1985-2018 (an empty file gives None)
+# the files are read n_threads at a time, typed and only the columns used (see station_io.py)
+def load_monthly_stations(csv_files, n_threads=READ_THREADS):
+    station_frames = {}
+
+    with stage('read_csv', files=len(csv_files)):
+        frames = read_stations(csv_files, read_monthly_station, n_threads=n_threads)
+
+    for file_path, df in zip(csv_files, frames):
+        station_name = station_id_from_path(file_path)
+        with stage('complete_date_range', station_name):
+            station_frames[file_path] = complete_date_range(df) if not df.empty else None
+
+    return station_frames
+
+
+
+# the quality table of every station in one call, plus which stations are selected (passed or wanted by hand)
+# this one table drives both the plots and the copy of the selected files
+def screen_stations(station_frames, manually_wanted, thresholds=quality_thresholds):
+    file_paths = [file_path for file_path, df in station_frames.items() if df is not None]
+    station_names = [station_id_from_path(file_path) for file_path in file_paths]
+
+    if file_paths:
+        values = np.column_stack([station_frames[file_path]['SWLavg'].to_numpy(dtype=float) for file_path in file_paths])
+    else:
+        values = np.empty((0, 0))
+
+    qc_table = quality_table(values, station_names, **thresholds)
+    qc_table['FilePath'] = file_paths
+    qc_table['ManuallyWanted'] = qc_table['StationID'].isin(manually_wanted)
+    qc_table['Selected'] = qc_table['Passed'] | qc_table['ManuallyWanted']
+    return qc_table
+
+
+
+# the STL seasonal component of the given station frames (all on the monthly calendar) in one batch, by file path
+# cache: a result_cache.ResultCache, a station is only decomposed again when its series or stl_params change
+def monthly_seasonal(station_frames, file_paths, cache=None):
+    file_paths = [file_path for file_path in file_paths if station_frames[file_path] is not None]
+    if not file_paths:
+        return {}
+
+    station_names = [station_id_from_path(file_path) for file_path in file_paths]
+    values = np.column_stack([station_frames[file_path]['SWLavg'].to_numpy(dtype=float) for file_path in file_paths])
+
+    with stage('stl_batch', stations=len(station_names)):
+        seasonal = decompose_stations(values, station_names, stl_params, cache=cache, min_valid=2)['seasonal']
+    return dict(zip(file_paths, seasonal.T))
+
+
+
+# per calendar month trends and the seasonal Kendall test of the given station frames, all stations in one batch
+# (see seasonal_trends.py), the tidy month table and the one row per station table
+def monthly_seasonal_trends(station_frames, file_paths, min_years=10):
+    file_paths = [file_path for file_path in file_paths if station_frames[file_path] is not None]
+    station_names = [station_id_from_path(file_path) for file_path in file_paths]
+    grid = monthly_grid()
+
+    if file_paths:
+        values = np.column_stack([station_frames[file_path]['SWLavg'].to_numpy(dtype=float) for file_path in file_paths])
+    else:
+        values = np.empty((len(grid), 0))
+
+    with stage('seasonal_trends', stations=len(station_names)):
+        return seasonal_trends(values, station_names, grid.year, min_years=min_years)
 
 
 
@@ -156,34 +233,21 @@ def complete_date_range(the_data):
  ## checking if the original data starts with 1985 and ends with 2018, and add the rows if not 
 
     the_data['DateTMS'] = pd.to_datetime(the_data[['Year', 'Month','Day']])     #get the timeseries object 
-    # create a new dataframe with all months from 1985 to 2018
-    full_range = pd.date_range(start='1985-01-31', end='2018-12-31', freq='ME')
-    complete_df = pd.DataFrame({
-        'DateTMS': full_range,
-        'Year': full_range.year,
-        'Month': full_range.month,
-        'Day': full_range.day,
-        'SWLavg': np.nan})
-
 
-    def year_fraction(date):
-        start = datetime.date(date.year, 1, 1).toordinal()
-        year_length = datetime.date(date.year+1, 1, 1).toordinal() - start
-        return date.year + float(date.toordinal() - start) / year_length
+    # the month-end calendar 1985-2018 with its decimal years, built once per process (see calendar_grid.py)
+    grid = monthly_grid()
 
+    if not the_data.empty:
+        # scatter the existing values onto the calendar by position (no merge), NaN where there is no value
+        positions = grid.positions(the_data['DateTMS'])
+        swlavg = grid.align(None, the_data['SWLavg'], positions)
+        dec_year = grid.align(None, the_data['DecYear'], positions)
 
-    complete_df['DecYear'] = complete_df['DateTMS'].apply(lambda x: year_fraction(x.date()))
-    
+        the_data = grid.frame()
+        the_data.insert(4, 'SWLavg', swlavg)
 
-    # merge the two df and keep existing values
-    if not the_data.empty:
-        the_data = pd.merge(complete_df, the_data[['DateTMS', 'SWLavg','DecYear']], 
-                          on='DateTMS', how='left', suffixes=('', '_existing'))
-        
-        # use existing values where available, otherwise keep NaN
-        the_data['SWLavg'] = the_data['SWLavg_existing'].fillna(the_data['SWLavg'])
-        the_data['DecYear'] = the_data['DecYear_existing'].fillna(the_data['DecYear'])
-        the_data = the_data.drop(['SWLavg_existing','DecYear_existing'], axis=1)
+        # use existing decimal years where available
+        the_data['DecYear'] = np.where(np.isnan(dec_year), the_data['DecYear'], dec_year)
    
     # sort by data and reset index
     the_data = the_data.sort_values('DateTMS').reset_index(drop=True)
@@ -194,15 +258,93 @@ def complete_date_range(the_data):
 
 
 
+# draws one page of (up to) four monthly station files, selected stations get the full plot, the rest grey
+def plot_page_monthly(page, shared):
+    danger_level_data, station_frames, qc_table, seasonal_by_file, fast = shared
+
+    fig, axes = page_axes(fast)
+
+    for i in range(4):
+        if i < len(page):
+            file_path = page[i]
+            station_name = station_id_from_path(file_path)
+
+            #the df completed to the range 1985-2018 
+            df = station_frames[file_path]
+
+            if df is None:
+                print(f"Skipping {station_name}: CSV file is empty")
+                axes[i].text(0.5, 0.5, f'No data available for {station_name}', ha='center', va='center', transform=axes[i].transAxes)
+                axes[i].set_title(f'{station_name} - No Data')
+
+                continue
+
+
+
+            # the manual selection or the quality check passed
+            if qc_table.loc[file_path, 'Selected']:
+                #Actual plotting 
+                with stage('tmplt', station_name):
+                    tmplt(df, station_name, axes[i], danger_level_data, seasonal_by_file.get(file_path), fast)
+
+            else: 
+                #the filtered plots are grey
+                mark_skipped(axes[i], station_name, qc_table.loc[file_path, 'Reason'])
+
+                if fast:
+                    plot_series(axes[i], df['DecYear'], df['SWLavg'], fast, label='Average surface water level', color='grey')
+                else:
+                    df.plot(x='DecYear',y='SWLavg',  ax=axes[i],label='Average surface water level', color = 'grey')
+                axes[i].set_xlabel('Year')
+                axes[i].set_ylabel('Water Level (meters)')
+                axes[i].set_xlim(1984, 2020)
+                axes[i].text(1.02, 0.6, 'Failed Quality Check', transform=axes[i].transAxes, color='grey', fontsize=15)
+                axes[i].grid(True)
+
+
+
+        else:
+            axes[i].set_visible(False)  
+
+    return finish_page(fig, fast)
+
+
+
+# cache key of a page: the station series, their danger level rows, their quality rows and the settings
+def monthly_page_key(page, shared):
+    danger_level_data, station_frames, qc_table = shared[:3]
+    station_names = [station_id_from_path(file_path) for file_path in page]
+
+    parts = []
+    for file_path, station_name in zip(page, station_names):
+        parts.append(station_frames[file_path])
+        parts.append(danger_level_data.frame(station_name))
+        if file_path in qc_table.index:
+            parts.append(qc_table.loc[file_path])
+
+    return '+'.join(station_names), content_hash('monthly_page', parts, stl_params, quality_thresholds, shared[4])
+
+
+
+
 if __name__ == "__main__":
 
+    # the plotting stack, only the report pages need it (see fast_render.pyplot)
+    from matplotlib.backends.backend_pdf import PdfPages
+    plt = pyplot()
+
 
     # getting all the station data 
     folder_path = '/Users/biar/Desktop/BWDB_nontidal_data_1985_2018'             ### change the path name when needed 
-    csv_files = glob.glob(f'{folder_path}/*.csv')
+    danger_level_path = '/Users/biar/Desktop/BWDB_river_danger_level_data.csv'
 
-    #getting the danger level water data
-    danger_level_data = pd.read_csv('/Users/biar/Desktop/BWDB_river_danger_level_data.csv')
+    # the station catalog of the folder, kept next to the data and only rebuilt when a file changed
+    catalog = StationCatalog([(folder_path, 'monthly', 'nontidal')], danger_level_path=danger_level_path,     ### change the location when needed 
+                             catalog_path=os.path.join(folder_path, '.station_catalog.json'))
+    csv_files = catalog.files('monthly')
+
+    #getting the danger level water data (one lookup per station instead of a filter over the table)
+    danger_level_data = DangerLevelIndex(pd.read_csv(danger_level_path))
 
 
     print(f"Found {len(csv_files)} CSV files to process")
@@ -217,81 +359,90 @@ if __name__ == "__main__":
 
 
     ## Part 1 of writting selected data files into a new folder  
-    stations_passed = []
     destination_folder = ''           ### change the output folder name when needed 
     tidal_manually_wanted = ['SW193','SW136.1', 'SW278', 'SW253', 'SW38.1', 'SW323', 'SW320', 'SW121', 'SW230.1', 'SW288.4', 'SW180']
     nontidal_manually_wanted = ['SW8', 'SW313', 'SW326', 'SW172.5', 'SW149.1', 'SW72B', 'SW233A', 'SW236', 'SW252.1', 'SW101.5', 'SW265', 'SW216A', 'SW344', 'SW227', 'SW233', 'SW311.4', 'SW131.5', 'SW150']
 
 
-    ###the main loop
-    # loop through all the stations 
-    with PdfPages(output_path) as pdf:
+    ## number of worker processes (1 = the old single process loop, None = all cores)
+    n_workers = 1                                                                             ### change when needed 
 
-        for j in range(0, len(csv_files), 4):
-            fig, axes = plt.subplots(nrows=4, ncols=1, figsize=(12, 18))
+    ## result cache, unchanged pages are reused from here on the next run (None = no cache)
+    cache_dir = None                                                                          ### change when needed 
+    cache = ResultCache(cache_dir, max_bytes=2 * 1024 ** 3) if cache_dir else None
 
-            for i in range(4):
-                if j + i < len(csv_files):
-                    file_path = csv_files[j + i]
-                    file_name = os.path.basename(file_path)
-                    file_name = os.path.splitext(file_name)[0]
-                    station_name = file_name.split('_monthly')[0]
+    ## fast rendering: one reused figure, lines drawn the quick way (smaller PDF, same statistics)
+    fast_render = False                                                                       ### change when needed 
 
-                    df = pd.read_csv(file_path)
+    ## the monthly series aggregated from the merged daily CSV (mean, min, max of every month) instead of the monthly
+    ## files of folder_path (None = the files), a month needs min_valid_days days of data; cached in cache_dir
+    daily_csv_path = None                                                                     ### change when needed 
+    min_valid_days = 20                                                                       ### change when needed 
 
-                    if df.empty:
-                        print(f"Skipping {station_name}: CSV file is empty")
-                        axes[i].text(0.5, 0.5, f'No data available for {station_name}', ha='center', va='center', transform=axes[i].transAxes)
-                        axes[i].set_title(f'{station_name} - No Data')
 
-                        continue
-                    
+    ## the quality report (one row per station)
+    quality_report_path = '/Users/biar/Desktop/quality_check_report_for_nontidal.csv'                 ### change the output path when needed 
 
+    ## the trend of every calendar month (one row per station and month) and the seasonal Kendall test (one row per station)
+    seasonal_trends_path = '/Users/biar/Desktop/monthly_trends_for_nontidal.csv'                      ### change the output path when needed 
+    seasonal_kendall_path = '/Users/biar/Desktop/seasonal_kendall_for_nontidal.csv'                   ### change the output path when needed 
 
-                    #making the df the complete df with range 1985-2018 
-                    df = complete_date_range(df)  
+    ## stage timing: every stage of every station into this JSON lines file (None = off, see stage_trace.py),
+    ## the peak memory of every stage and station too (tracemalloc, slows the run down) and cProfile over one
+    ## station (None = no profile)
+    trace_path = None                                                                         ### change when needed 
+    trace_memory = False                                                                      ### change when needed 
+    profile_station = None                                                                    ### change when needed 
+    if trace_path or trace_memory or profile_station:
+        start_trace(trace_path, memory=trace_memory, profile_station=profile_station)
 
-                    
 
-                    # the manual selection
-                    if station_name in nontidal_manually_wanted:       ### change the location when needed 
-                        tmplt(df, station_name, axes[i])
-                        stations_passed.append(file_path)
-                    else: 
+    # reading all the stations (the files, or every station of the daily matrix) and screening them in one go
+    if daily_csv_path:
+        station_frames = monthly_station_frames(monthly_from_daily(daily_csv_path, cache=cache, min_valid_days=min_valid_days))
+        csv_files = list(station_frames)
+        print(f"{len(csv_files)} stations aggregated to months from: {daily_csv_path}")
+    else:
+        station_frames = load_monthly_stations(csv_files)
+    qc_table = screen_stations(station_frames, nontidal_manually_wanted)     ### change the location when needed 
+    qc_table.to_csv(quality_report_path, index=False)
+    print(f"{qc_table['Passed'].sum()} of {len(qc_table)} stations passed the quality check, {qc_table['Selected'].sum()} selected")
+    print(f"Quality report saved to: {quality_report_path}")
 
+    # the STL of all the selected stations in one batch
+    seasonal_by_file = monthly_seasonal(station_frames, qc_table.loc[qc_table['Selected'], 'FilePath'], cache=cache)
 
-                    #the filtering part and making the filtered plots grey
-                        if fails_quality_check(df, axes[i]):
+    # the per month trends of the selected stations, next to the quality report
+    by_month, seasonal_kendall = monthly_seasonal_trends(station_frames, qc_table.loc[qc_table['Selected'], 'FilePath'])
+    by_month.to_csv(seasonal_trends_path, index=False)
+    seasonal_kendall.to_csv(seasonal_kendall_path, index=False)
+    print(f"Monthly trends saved to: {seasonal_trends_path} and {seasonal_kendall_path}")
 
-                            
-                            df.plot(x='DecYear',y='SWLavg',  ax=axes[i],label='Average surface water level', color = 'grey')
-                            axes[i].set_xlabel('Year')
-                            axes[i].set_ylabel('Water Level (meters)')
-                            axes[i].set_xlim(1984, 2020)
-                            axes[i].text(1.02, 0.6, 'Failed Quality Check', transform=axes[i].transAxes, color='grey', fontsize=15)
-                            axes[i].grid(True)
-                        
-                        else: 
-                            #Actual plotting 
-                            tmplt(df, station_name, axes[i])
-                            stations_passed.append(file_path)
 
+    ###the main loop
+    # loop through all the stations, four to a page, pages come back in order even with several workers
+    with PdfPages(output_path) as pdf:
 
+        pages = paginate(csv_files)
 
-                else:
-                    axes[i].set_visible(False)  
+        for page_number, fig in enumerate(staged(run_pages_cached(plot_page_monthly, pages, cache, monthly_page_key, n_workers=n_workers,
+                                    shared=(danger_level_data, station_frames, qc_table.set_index('FilePath', drop=False),
+                                            seasonal_by_file, fast_render)), 'draw_page')):
 
-            plt.tight_layout()
-            pdf.savefig(fig, bbox_inches='tight')
+            with stage('savefig', page=page_number + 1):
+                pdf.savefig(fig, **savefig_options(fast_render))
             plt.close(fig)
             
     print(f"PDF saved to: {os.path.abspath(output_path)}")
 
 
-    ## Part 2 of writting selected data files into a new folder 
-    for stations_path in stations_passed:
-        if os.path.isfile(stations_path):  
-            shutil.copy(stations_path, destination_folder)
-        else:
-            print(f"File not found: {stations_path}")
+    ## Part 2 of writting selected data files into a new folder (hard links, no bytes copied)
+    ## (only for the monthly files, the daily matrix has none)
+    if not daily_csv_path:
+        stations_passed = qc_table.loc[qc_table['Selected'], 'FilePath'].tolist()
+        linked, copied = link_files(stations_passed, destination_folder)
+        print(f"{linked} station files linked, {copied} copied into: {destination_folder}")
+
+    # the slowest stages and stations of the run (when traced)
+    stop_trace()
 
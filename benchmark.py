@@ -0,0 +1,505 @@
+## Benchmarks of the analysis hot paths on synthetic stations (no BWDB data needed)
+## a deterministic generator for N stations x 1985-2018 (daily and monthly), every case timed (wall and CPU)
+## and its peak memory traced, one JSON line per case appended to the results file so runs can be compared
+
+# imports
+import matplotlib
+matplotlib.use('Agg')
+
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_pdf import PdfPages
+from calendar_grid import daily_grid, monthly_grid
+from parallel_run import paginate
+
+
+
+# the synthetic series of one station on a calendar (decimal years), its own random stream so station i is the
+# same whatever the number of stations: monsoon seasonality (two harmonics peaking around August), a trend,
+# AR(1) noise, a late start for some stations, a few long gaps and scattered missing steps
+# gap_scale: steps per day (1 daily, 1/30 monthly), so the gaps are about as long in time at both resolutions
+def _station_series(dec_year, station_number, seed, gap_scale):
+    rng = np.random.default_rng([seed, 0, station_number])
+    n = len(dec_year)
+    t = dec_year - 1985.0
+
+    base = rng.uniform(2.0, 12.0)
+    amplitude = rng.uniform(0.5, 4.0)
+    phase = rng.normal(0.6, 0.05)            # fraction of the year of the peak (~August)
+    slope = rng.normal(0.0, 0.02)            # meters per year
+
+    seasonal = amplitude * (np.cos(2 * np.pi * (t - phase)) + 0.3 * np.cos(4 * np.pi * (t - phase)))
+    phi = 0.9 if gap_scale >= 1 else 0.3
+    noise = lfilter([1.0], [1.0, -phi], rng.normal(0.0, 0.15 * amplitude, n))
+    values = base + slope * t + seasonal + noise
+
+    missing = rng.random(n) < rng.uniform(0.0, 0.05)
+
+    # some stations start late (up to 20 years), some stop early
+    if rng.random() < 0.3:
+        missing[:int(rng.uniform(0, 20) * 365 * gap_scale)] = True
+    if rng.random() < 0.1:
+        missing[n - int(rng.uniform(0, 10) * 365 * gap_scale):] = True
+
+    # a few long gaps of one month to three years
+    for _ in range(rng.poisson(1.5)):
+        length = max(int(rng.uniform(30, 3 * 365) * gap_scale), 1)
+        start = rng.integers(0, max(n - length, 1))
+        missing[start:start + length] = True
+
+    values[missing] = np.nan
+    return values
+
+
+
+# the merged daily matrix of N stations (the layout of merge_surface_water_data: Date, Year, Month, Day,
+# DecimYear, SW1...)
+def synthetic_daily(n_stations, seed=0, start='1985-01-01', end='2018-12-31'):
+    grid = daily_grid(start, end)
+    station_columns = [f'SW{j + 1}' for j in range(n_stations)]
+
+    df = pd.DataFrame({'Date': grid.dates.strftime('%Y-%m-%d'), 'Year': grid.year, 'Month': grid.month,
+                       'Day': grid.day, 'DecimYear': grid.dec_year})
+    values = {name: _station_series(grid.dec_year, j, seed, 1) for j, name in enumerate(station_columns)}
+    return pd.concat([df, pd.DataFrame(values)], axis=1)
+
+
+
+# N monthly station files as read from disk (Year, Month, Day, DecYear, SWLavg), missing months left out
+# like in the BWDB files, by station id
+def synthetic_monthly(n_stations, seed=0, start='1985-01-31', end='2018-12-31'):
+    grid = monthly_grid(start, end)
+    frames = {}
+
+    for j in range(n_stations):
+        values = _station_series(grid.dec_year, j, seed, 1 / 30)
+        keep = np.isfinite(values)
+        frames[f'SW{j + 1}'] = pd.DataFrame({'Year': grid.year[keep], 'Month': grid.month[keep],
+                                             'Day': grid.day[keep], 'DecYear': grid.dec_year[keep],
+                                             'SWLavg': values[keep]})
+    return frames
+
+
+
+# a danger level table for the stations (StationID, StationNam, RiverName, DLm, DLmInterp),
+# about one in ten without a BWDB level (the interpolated one is used then) and one in twenty not listed at all
+def synthetic_danger_levels(values_by_station, seed=0):
+    rng = np.random.default_rng([seed, 1])
+    rows = []
+
+    for station_id, values in values_by_station.items():
+        if rng.random() < 0.05 or not np.isfinite(values).any():
+            continue
+        level = np.nanpercentile(values, 95) + rng.normal(0.0, 0.2)
+        rows.append({'StationID': station_id, 'StationNam': f'Station {station_id}', 'RiverName': 'Synthetic',
+                     'DLm': np.nan if rng.random() < 0.1 else round(level, 2), 'DLmInterp': round(level + 0.1, 2)})
+
+    return pd.DataFrame(rows, columns=['StationID', 'StationNam', 'RiverName', 'DLm', 'DLmInterp'])
+
+
+
+# the daily matrix written as BWDB style station files, odd stations tidal (SWLmin) and even ones non-tidal (SWLmpwd)
+def write_daily_files(df_all_stations, folder_tidal, folder_nontidal):
+    os.makedirs(folder_tidal, exist_ok=True)
+    os.makedirs(folder_nontidal, exist_ok=True)
+
+    station_columns = [col for col in df_all_stations.columns if col.startswith('SW')]
+    for j, station_name in enumerate(station_columns):
+        tidal = j % 2 == 0
+        values = df_all_stations[station_name]
+        keep = values.notna()
+        station_df = pd.DataFrame({'Date': df_all_stations['Date'][keep],
+                                   'SWLmin' if tidal else 'SWLmpwd': values[keep].round(2)})
+        folder = folder_tidal if tidal else folder_nontidal
+        suffix = 'tidal' if tidal else 'nontidal'
+        station_df.to_csv(os.path.join(folder, f'{station_name}_{suffix}_daily.csv'), index=False)
+
+
+
+# the inputs of every case for one number of stations, generated once (and only what the cases ask for)
+class BenchmarkInputs:
+
+    def __init__(self, n_stations, seed=0, work_dir=None):
+        self.n_stations = n_stations
+        self.seed = seed
+        self.work_dir = work_dir
+        self._built = {}
+
+
+    def get(self, name):
+        if name not in self._built:
+            self._built[name] = getattr(self, '_' + name)()
+        return self._built[name]
+
+
+    def _daily(self):
+        return synthetic_daily(self.n_stations, self.seed)
+
+    def _daily_station_columns(self):
+        return [col for col in self.get('daily').columns if col.startswith('SW')]
+
+    def _daily_danger_levels(self):
+        df = self.get('daily')
+        return synthetic_danger_levels({name: df[name].to_numpy() for name in self.get('daily_station_columns')},
+                                       self.seed)
+
+    def _daily_results(self):
+        from trend_engine import batch_trends
+        return batch_trends(self.get('daily'), self.get('daily_danger_levels'),
+                            self.get('daily_station_columns')).set_index('StationID', drop=False)
+
+    def _monthly_raw(self):
+        return synthetic_monthly(self.n_stations, self.seed)
+
+    def _monthly(self):
+        from bangla import complete_date_range
+        return {name: complete_date_range(df.copy()) for name, df in self.get('monthly_raw').items()}
+
+    def _monthly_danger_levels(self):
+        from station_catalog import DangerLevelIndex
+        return DangerLevelIndex(synthetic_danger_levels(
+            {name: df['SWLavg'].to_numpy() for name, df in self.get('monthly').items()}, self.seed))
+
+    def _daily_folders(self):
+        folder = os.path.join(self.work_dir, f'daily_{self.n_stations}_{self.seed}')
+        folder_tidal = os.path.join(folder, 'tidal')
+        folder_nontidal = os.path.join(folder, 'nontidal')
+        write_daily_files(self.get('daily'), folder_tidal, folder_nontidal)
+        return folder_tidal, folder_nontidal, os.path.join(folder, 'merged.csv')
+
+
+
+# the cases: name -> (resolution, setup), setup(inputs) returns the function that is timed (inputs are not)
+
+def _case_complete_date_range(inputs):
+    from bangla import complete_date_range
+    frames = inputs.get('monthly_raw')
+    return lambda: [complete_date_range(df.copy()) for df in frames.values()]
+
+
+def _case_fails_quality_check(inputs):
+    from bangla import fails_quality_check
+    frames = inputs.get('monthly')
+    ax = Figure().subplots()
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [fails_quality_check(df, ax, name) for name, df in frames.items()]
+    return run
+
+
+def _case_tmplt(inputs):
+    from bangla import tmplt
+    frames = inputs.get('monthly')
+    danger_level_data = inputs.get('monthly_danger_levels')
+    ax = Figure().subplots()
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name, df in frames.items():
+                ax.clear()
+                tmplt(df, name, ax, danger_level_data)
+    return run
+
+
+# tmplt_daily in its three parts, for all stations the way batch_trends runs them
+def _case_daily_stl(inputs):
+    from seasonal_decomposition import decompose_stations
+    from trend_engine import daily_stl_params
+    Y = inputs.get('daily')[inputs.get('daily_station_columns')].to_numpy(dtype=float)
+    return lambda: decompose_stations(Y, inputs.get('daily_station_columns'), daily_stl_params)
+
+
+def _case_daily_theilsen(inputs):
+    from theilsen import theil_sen
+    df = inputs.get('daily')
+    x = df['DecimYear'].to_numpy(dtype=float)
+    Y = df[inputs.get('daily_station_columns')].to_numpy(dtype=float)
+    return lambda: [theil_sen(Y[:, j], x) for j in range(Y.shape[1])]
+
+
+def _case_daily_mann_kendall(inputs):
+    from mann_kendall import mann_kendall
+    df = inputs.get('daily')
+    x = df['DecimYear'].to_numpy(dtype=float)
+    Y = df[inputs.get('daily_station_columns')].to_numpy(dtype=float)
+    return lambda: mann_kendall(Y, x, np.zeros(Y.shape[1]))
+
+
+# the deseasonalised fit is timed on the series minus its day of year mean (the cost doesn't depend on the values)
+def _case_daily_regression(inputs):
+    from trend_engine import ols_columns
+    df = inputs.get('daily')
+    x = df['DecimYear'].to_numpy(dtype=float)
+    Y = df[inputs.get('daily_station_columns')].to_numpy(dtype=float)
+    deseasonalised = Y - df[inputs.get('daily_station_columns')].groupby(
+        pd.to_datetime(df['Date']).dt.dayofyear.to_numpy()).transform('mean').to_numpy(dtype=float)
+    return lambda: (ols_columns(x, Y), ols_columns(x, deseasonalised))
+
+
+def _case_daily_to_monthly(inputs):
+    from monthly_aggregation import monthly_aggregate
+    df = inputs.get('daily')
+    Y = df[inputs.get('daily_station_columns')].to_numpy(dtype=float)
+    return lambda: monthly_aggregate(Y, df['Date'], inputs.get('daily_station_columns'))
+
+
+def _case_daily_correlation(inputs):
+    from station_correlation import pairwise_correlation
+    Y = inputs.get('daily')[inputs.get('daily_station_columns')].to_numpy(dtype=float)
+    return lambda: pairwise_correlation(Y)
+
+
+def _case_daily_gev(inputs):
+    from extreme_values import gev_analysis
+    df = inputs.get('daily')
+    Y = df[inputs.get('daily_station_columns')].to_numpy(dtype=float)
+    danger_levels = np.nanpercentile(Y, 99, axis=0)
+    return lambda: gev_analysis(Y, df['Date'], inputs.get('daily_station_columns'), danger_levels)
+
+
+def _case_daily_rolling_trends(inputs):
+    from rolling_trends import rolling_trends
+    df = inputs.get('daily')
+    return lambda: rolling_trends(df, inputs.get('daily_station_columns'))
+
+
+def _case_merge_surface_water_data(inputs):
+    from rainfall_tms_cor import merge_surface_water_data
+    folder_tidal, folder_nontidal, output_file = inputs.get('daily_folders')
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return merge_surface_water_data(folder_tidal, folder_nontidal, output_file)
+    return run
+
+
+def _render_pages(inputs, fast):
+    from daily_plots import plot_page_daily
+    from fast_render import savefig_options
+    import matplotlib.pyplot as plt
+    shared = (inputs.get('daily'), inputs.get('daily_results'), fast)
+    pages = paginate(inputs.get('daily_station_columns'))
+    pdf_path = os.path.join(inputs.work_dir, f'pages_{inputs.n_stations}_{fast}.pdf')
+
+    def run():
+        with PdfPages(pdf_path) as pdf:
+            for page in pages:
+                fig = plot_page_daily(page, shared)
+                pdf.savefig(fig, **savefig_options(fast))
+                plt.close(fig)
+    return run
+
+
+def _case_render_pages(inputs):
+    return _render_pages(inputs, fast=False)
+
+
+def _case_render_pages_fast(inputs):
+    return _render_pages(inputs, fast=True)
+
+
+CASES = {
+    'complete_date_range': ('monthly', _case_complete_date_range),
+    'fails_quality_check': ('monthly', _case_fails_quality_check),
+    'tmplt': ('monthly', _case_tmplt),
+    'daily_stl': ('daily', _case_daily_stl),
+    'daily_theilsen': ('daily', _case_daily_theilsen),
+    'daily_regression': ('daily', _case_daily_regression),
+    'daily_mann_kendall': ('daily', _case_daily_mann_kendall),
+    'daily_rolling_trends': ('daily', _case_daily_rolling_trends),
+    'daily_gev': ('daily', _case_daily_gev),
+    'daily_correlation': ('daily', _case_daily_correlation),
+    'daily_to_monthly': ('daily', _case_daily_to_monthly),
+    'merge_surface_water_data': ('daily', _case_merge_surface_water_data),
+    'render_pages': ('daily', _case_render_pages),
+    'render_pages_fast': ('daily', _case_render_pages_fast),
+}
+
+
+
+# wall and CPU time of repeat calls of func (the best and the median), then its peak traced memory
+# (a separate call, tracemalloc slows everything down; numpy and pandas buffers are traced too)
+def measure(func, repeat=3, memory=True):
+    wall, cpu = [], []
+    for _ in range(repeat):
+        gc.collect()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        func()
+        wall.append(time.perf_counter() - wall_start)
+        cpu.append(time.process_time() - cpu_start)
+
+    peak_mb = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        finally:
+            tracemalloc.stop()
+
+    return {'wall_s_min': min(wall), 'wall_s_median': float(np.median(wall)), 'cpu_s_median': float(np.median(cpu)),
+            'peak_mb': peak_mb}
+
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+
+# every case for every number of stations, one JSON line each appended to output_path (and returned as a frame)
+# cases: names from CASES (None = all), run_label: tag of the run in the file (default: its start time)
+def run_benchmarks(output_path, n_stations=(10, 100, 1000), cases=None, repeat=3, memory=True, seed=0,
+                   run_label=None):
+    cases = list(CASES) if cases is None else list(cases)
+    run_label = run_label or pd.Timestamp.now().isoformat(timespec='seconds')
+    environment = {'git_commit': _git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+                   'pandas': pd.__version__, 'machine': platform.machine(), 'cpu_count': os.cpu_count()}
+
+    records = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for n in n_stations:
+            inputs = BenchmarkInputs(n, seed=seed, work_dir=work_dir)
+
+            for case in cases:
+                resolution, setup = CASES[case]
+                timing = measure(setup(inputs), repeat=repeat, memory=memory)
+
+                record = {'run': run_label, 'case': case, 'resolution': resolution, 'n_stations': n, 'seed': seed,
+                          'repeat': repeat, **timing, **environment}
+                records.append(record)
+                with open(output_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+                peak = f", peak {timing['peak_mb']:.1f} MB" if timing['peak_mb'] is not None else ''
+                print(f"{case:<26} {n:>5} stations: {timing['wall_s_min']:.3f} s (cpu {timing['cpu_s_median']:.3f} s){peak}")
+
+    return pd.DataFrame(records)
+
+
+
+# the modules whose import is timed (a fresh interpreter each), the data jobs first: they should start without
+# the plotting stack, only pandas and numpy
+IMPORT_MODULES = ['calendar_grid', 'station_catalog', 'station_io', 'rainfall_tms_cor', 'monthly_aggregation',
+                  'station_correlation', 'gap_filling', 'trend_engine', 'bangla', 'after_curation', 'daily_plots']
+
+# the heavy packages, recorded as loaded or not by the import of each module
+HEAVY_PACKAGES = ['matplotlib', 'matplotlib.pyplot', 'seaborn', 'statsmodels', 'scipy', 'scipy.stats', 'scipy.signal']
+
+_IMPORT_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'import_s': time.perf_counter() - start,
+                  'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+
+
+# the start up cost of every module: wall time of `python -c "import module"` (interpreter start included,
+# what a short job pays before its first line) and of the import alone, the best of repeat fresh processes,
+# one JSON line per module appended to output_path like the cases of run_benchmarks (case 'import:<module>')
+def run_import_benchmarks(output_path, modules=None, repeat=5, run_label=None):
+    modules = IMPORT_MODULES if modules is None else list(modules)
+    run_label = run_label or pd.Timestamp.now().isoformat(timespec='seconds')
+    environment = {'git_commit': _git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+                   'pandas': pd.__version__, 'machine': platform.machine(), 'cpu_count': os.cpu_count()}
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+    records = []
+    for module in modules:
+        code = _IMPORT_PROBE.format(module=module, heavy=HEAVY_PACKAGES)
+        wall, import_s = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            probe = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=repo_dir,
+                                   check=True)
+            wall.append(time.perf_counter() - start)
+            result = json.loads(probe.stdout.strip().splitlines()[-1])
+            import_s.append(result['import_s'])
+
+        record = {'run': run_label, 'case': f'import:{module}', 'resolution': 'import', 'n_stations': 0,
+                  'seed': None, 'repeat': repeat, 'wall_s_min': min(wall), 'wall_s_median': float(np.median(wall)),
+                  'import_s_min': min(import_s), 'peak_mb': None, 'loaded': result['loaded'], **environment}
+        records.append(record)
+        with open(output_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        loaded = ', '.join(result['loaded']) or 'numpy/pandas only'
+        print(f"{'import ' + module:<32} {min(wall):.3f} s (import {min(import_s):.3f} s), loads {loaded}")
+
+    return pd.DataFrame(records)
+
+
+
+# the results file as a frame
+def load_results(output_path):
+    with open(output_path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+
+# best wall time and peak memory of two runs side by side (default: the last two runs in the file),
+# ratio > 1 means the second run is slower
+def compare_runs(output_path, baseline=None, candidate=None):
+    results = load_results(output_path)
+    runs = list(dict.fromkeys(results['run']))
+    baseline = baseline or runs[-2]
+    candidate = candidate or runs[-1]
+
+    keys = ['case', 'n_stations']
+    base = results[results['run'] == baseline].drop_duplicates(keys, keep='last').set_index(keys)
+    cand = results[results['run'] == candidate].drop_duplicates(keys, keep='last').set_index(keys)
+
+    table = pd.DataFrame({'baseline_s': base['wall_s_min'], 'candidate_s': cand['wall_s_min'],
+                          'baseline_mb': base['peak_mb'], 'candidate_mb': cand['peak_mb']}).dropna(subset=['baseline_s', 'candidate_s'])
+    table['ratio'] = table['candidate_s'] / table['baseline_s']
+    return table.sort_index()
+
+
+
+
+
+if __name__ == "__main__":
+
+    ## the results are appended here, one JSON line per case
+    output_path = 'benchmark_results.jsonl'                                                   ### change when needed
+
+    ## numbers of synthetic stations, and which cases (None = all of CASES)
+    n_stations = [10, 100, 1000]                                                              ### change when needed
+    cases = None                                                                              ### change when needed
+
+    ## timed calls per case (the best is reported), and whether to trace the peak memory (one more call)
+    repeat = 3                                                                                ### change when needed
+    memory = True                                                                             ### change when needed
+
+    ## the modules whose start up is timed (None = IMPORT_MODULES, [] = none)
+    import_modules = None                                                                     ### change when needed
+
+
+    run_label = pd.Timestamp.now().isoformat(timespec='seconds')
+    run_import_benchmarks(output_path, modules=import_modules, run_label=run_label)
+    run_benchmarks(output_path, n_stations=n_stations, cases=cases, repeat=repeat, memory=memory, run_label=run_label)
+
+    # against the previous run in the file, if there is one
+    if load_results(output_path)['run'].nunique() > 1:
+        print(compare_runs(output_path).to_string())
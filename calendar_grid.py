@@ -0,0 +1,98 @@
+## The fixed 1985-2018 calendars (monthly and daily) the stations are aligned onto
+## built once and reused, stations are scattered onto them by integer position instead of a merge
+
+# imports
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+
+
+# decimal year of every date: year + (day of year - 1) / days in that year
+# (the vectorized form of the old row by row year_fraction with date.toordinal)
+def decimal_year(dates):
+    dates = pd.DatetimeIndex(dates)
+    days_in_year = np.where(dates.is_leap_year, 366, 365)
+    return dates.year.to_numpy() + (dates.dayofyear.to_numpy() - 1) / days_in_year
+
+
+
+class CalendarGrid:
+
+    # freq 'ME' (month ends) or 'D' (days), any other pandas frequency works through a hash lookup
+    def __init__(self, start, end, freq):
+        self.freq = freq
+        self.dates = pd.date_range(start=start, end=end, freq=freq)
+        self.dec_year = decimal_year(self.dates)
+        self.year = self.dates.year.to_numpy()
+        self.month = self.dates.month.to_numpy()
+        self.day = self.dates.day.to_numpy()
+
+
+    def __len__(self):
+        return len(self.dates)
+
+
+    # position of every date on the grid, -1 for dates that are not on it
+    def positions(self, dates):
+        # dates that are already parsed are not parsed again (to_datetime is not free even on a DatetimeIndex)
+        if pd.api.types.is_datetime64_any_dtype(dates):
+            dates = pd.DatetimeIndex(dates)
+        else:
+            dates = pd.DatetimeIndex(pd.to_datetime(dates))
+        if len(self.dates) == 0 or len(dates) == 0:
+            return np.full(len(dates), -1, dtype=np.int64)
+
+        first = self.dates[0]
+        if self.freq == 'D':
+            pos = (dates.normalize() - first).days.to_numpy().astype(np.int64)
+            on_grid = dates == dates.normalize()
+        elif self.freq == 'ME':
+            pos = ((dates.year.to_numpy() - first.year) * 12 + dates.month.to_numpy() - first.month).astype(np.int64)
+            on_grid = (dates == dates.normalize()) & dates.is_month_end
+        else:
+            return self.dates.get_indexer(dates).astype(np.int64)
+
+        on_grid = np.asarray(on_grid) & (pos >= 0) & (pos < len(self.dates))
+        return np.where(on_grid, pos, -1)
+
+
+    # a station's values scattered onto the grid (NaN where it has no value)
+    # dates off the grid are dropped, for a repeated date the first value is kept
+    def align(self, dates, values, positions=None):
+        if positions is None:
+            positions = self.positions(dates)
+        values = np.asarray(values, dtype=float)
+
+        keep = positions >= 0
+        positions = positions[keep]
+        values = values[keep]
+
+        # first occurrence of every date
+        positions, first = np.unique(positions, return_index=True)
+
+        out = np.full(len(self.dates), np.nan)
+        out[positions] = values[first]
+        return out
+
+
+    # DateTMS, Year, Month, Day and DecYear of the grid as a frame
+    def frame(self):
+        return pd.DataFrame({
+            'DateTMS': self.dates,
+            'Year': self.year,
+            'Month': self.month,
+            'Day': self.day,
+            'DecYear': self.dec_year})
+
+
+
+# the two calendars the scripts use, computed once per process
+@lru_cache(maxsize=None)
+def monthly_grid(start='1985-01-31', end='2018-12-31'):
+    return CalendarGrid(start, end, 'ME')
+
+
+@lru_cache(maxsize=None)
+def daily_grid(start='1985-01-01', end='2018-12-31'):
+    return CalendarGrid(start, end, 'D')
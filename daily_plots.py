@@ -4,272 +4,279 @@
 
 # imports
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-import statistics
-from matplotlib.backends.backend_pdf import PdfPages
 import glob
 import os
 import datetime
 from datetime import datetime
 import time
-from scipy.stats import theilslopes
-from statsmodels.tsa.seasonal import STL
-from scipy.stats import linregress
+from parallel_run import paginate
+from trend_engine import batch_trends, summary_table, RESULT_COLUMNS
+from result_cache import ResultCache, content_hash, run_pages_cached
+from fast_render import plot_series, plot_trend, page_axes, finish_page, savefig_options, pyplot
+from stage_trace import stage, staged, start_trace, stop_trace
+from station_store import open_station_store
+from rolling_trends import rolling_trends, rolling_heatmap_pages
 
 
 
 
-the_result_table = [] 
-
-# the time series plot function
-def tmplt_daily (stationdata,station_name,ax,danger_level_data):
-
-    percentage = np.nan
-
-    mean_level= np.nan
-    slope_sen = np.nan
-    slope_linear = np.nan
-    intercept_linear = np.nan
-    slope_desea = np.nan
-    danger_level= np.nan
-
-    count= np.nan
-    
-
+# drawing one station from its row of the trend engine results (see trend_engine.batch_trends)
+# fast=True thins the series for display and draws the trend lines from their end points (see fast_render.py)
+def plot_station_daily (stationdata,station_name,ax,result,fast=False):
 
+    dt_used = stationdata
 
-    dt_used = stationdata.copy()
 
-    matching_station = danger_level_data[danger_level_data['StationID'] == station_name]     # check the matching stations 
-
-   
 
     ## plotting the time series lines and regression part 
-    ax.plot(dt_used['DecimYear'], dt_used[station_name], color='steelblue', linewidth=1, label='Surface Water Level')
+    plot_series(ax, dt_used['DecimYear'], dt_used[station_name], fast, color='steelblue', linewidth=1, label='Surface Water Level')
 
     #the simple linear regression trend with no seasonal consideration
-    slope_linear, intercept_linear, r_value_l, p_value_l, std_err_l= linregress(dt_used['DecimYear'], dt_used[station_name])
-    trend_line_linear = intercept_linear + slope_linear * dt_used['DecimYear']
+    slope_linear = result['Linear_Slope']
 
-    ax.plot(dt_used['DecimYear'], trend_line_linear,
+    plot_trend(ax, dt_used['DecimYear'], slope_linear, result['Linear_Intercept'], fast,
                  color='green',
                  label=f"Linear trend slope: {slope_linear:.5f}",
                 linewidth=1.7)
 
     # Theil Sen     
-    slope_sen, intercept_sen, lo_s, high_s= theilslopes(dt_used[station_name],dt_used['DecimYear'])
+    slope_sen = result['TheilSen_Slope']
 
-    #dt_used.plot(x='DecimYear',y=station_name,color='blue', ax=ax,label='Average surface water level')
+    plot_trend(ax, dt_used['DecimYear'], slope_sen, result['TheilSen_Intercept'], fast, color='darkorange',
+            label=f"Theil-Sen trend slope: {slope_sen:.5f}",
+            linewidth=1.7)
 
+    # linear trend of the deseasonalised (STL) data
+    slope_desea = result['Deseasonalised_Slope']
+    plot_trend(ax, dt_used['DecimYear'], slope_desea, result['Deseasonalised_Intercept'], fast, color='gold', label=f'Linear trend (deseasonalised) slope: {slope_desea:.5f}', linewidth=1.7)
 
-    trend_line_sen = intercept_sen+ (slope_sen*dt_used['DecimYear'])
 
-    ax.plot(dt_used['DecimYear'], trend_line_sen, color='darkorange',
-            label=f"Theil-Sen trend slope: {slope_sen:.5f}",
-            linewidth=1.7)
 
-    # stl decomposition
-    dt_for_stl = dt_used.set_index(pd.to_datetime(dt_used['Date']))[station_name]
+    ## matching the danger level station id and station name 
+    ax.set_title(f"{station_name}-{result['StationName']} (River: {result['RiverName']}) Water Level Daily Trend (1985-2018)")
 
 
-    stl = STL(dt_for_stl, period = 365 , robust =True)
-    stl_result= stl.fit()
+    ax.set_xlabel('Year')
+    ax.set_ylabel('Water Level (meters)')
+    ax.set_xlim(1984, 2020)
 
-    seas = stl_result.seasonal
+    #plotting the mean water level 
+    mean_level = result['MeanLevel']
+    ax.axhline(mean_level, color='black', linestyle='--', label=f'Mean Water Level: {mean_level}')
 
-    deseasonalised_swlavg = dt_for_stl-seas
 
-    #fit a linear trend to the deseasonalised data
-    slope_desea, intercept_desea, r_value_d, p_value_d, std_err_d = linregress(dt_used['DecimYear'],deseasonalised_swlavg)
 
-    #dt_used.plot(x='DecimYear',y=station_name,  ax=ax,label='Average surface water level')
+    #plotting the danger levels and num of times exceeded 
+    BWDB_danger_level = result['BWDB_DangerLevel']
+    dl_interp = result['Interpolated_DL']
+    dl_95th = result['95th_DL']
 
-    trend_line_desea = slope_desea*dt_used['DecimYear'] +intercept_desea
-    ax.plot(dt_used['DecimYear'], trend_line_desea, color='gold', label=f'Linear trend (deseasonalised) slope: {slope_desea:.5f}', linewidth=1.7)
+    ax.text(1.02, 0.6,f"({result['DL_Source']}) Danger Level Exceeded Times: {result['DL_Exceeded_Count']} ({result['DL_Exceeded_Percentage']:.2f}%)", transform=ax.transAxes, color='red', verticalalignment='top',fontsize=7)
+    ax.axhline(BWDB_danger_level, color='firebrick', linestyle='-', label=f'BWDB Danger Level: {BWDB_danger_level:.2f}')
+    ax.axhline(dl_interp, color='lightpink', linestyle='-', label=f'Interpolated Danger Level: {dl_interp:.2f}')
+    ax.axhline(dl_95th, color='mediumorchid', linestyle='-', label=f'95th Percentile Danger Level: {dl_95th:.2f}')
 
 
 
+    # Legend position and showing the grid 
+    ax.legend(loc='upper left', bbox_to_anchor=(1, 1),fontsize=7)
+    ax.grid(True)
 
-    
-    
 
-    ## matching the danger level station id and station name 
-    danger_level = np.nan
-    #if matching_station.empty:
-        #print(f"[Warning] No matching station name for station id: {station_name}")
-        #ax.set_title(f'{station_name} Water Level Daily Trend (1985-2018)')
-        #ax.text(1.02, 0.6, 'No Station Danger Level Record', transform=ax.transAxes, color='red', verticalalignment='top')
 
-    #else:
+# the time series plot function (statistics from the trend engine, then the plot)
+def tmplt_daily (stationdata,station_name,ax,danger_level_data):
 
-    actual_name = matching_station['StationNam'].iloc[0]
-    river_name = matching_station['RiverName'].iloc[0]
-    ax.set_title(f'{station_name}-{actual_name} (River: {river_name}) Water Level Daily Trend (1985-2018)')
+    with stage('batch_trends', station_name):
+        result = batch_trends(stationdata, danger_level_data, [station_name]).iloc[0]
 
+    with stage('plot', station_name):
+        plot_station_daily(stationdata, station_name, ax, result)
 
-    ax.set_xlabel('Year')
-    ax.set_ylabel('Water Level (meters)')
-    ax.set_xlim(1984, 2020)
+    return result[RESULT_COLUMNS].to_dict()
 
-    #plotting the mean water level 
-    mean_level = round(dt_used[station_name].mean(), 2)
 
-    ax.axhline(mean_level, color='black', linestyle='--', label=f'Mean Water Level: {mean_level}')
 
 
 
-    #plotting the danger level and calculating num of times exceeded 
-    count = 0
-    ninetyfive_percentile_station = ['SW113', 'SW67', 'SW332', 'SW293', 'SW331', 'SW327', 'SW57A', 'SW262', 
-                                     'SW209A','SW222', 'SW272', 'SW270', 'SW271','SW182','SW250','SW176','SW107',
-                                     'SW128','SW73','SW280','SW158','SW181','SW233','SW114','SW264A','SW157',
-                                     'SW335','SW311.4','SW97']
-    
-    dl_95th = round(np.percentile(dt_used[station_name].dropna(), 95),2)
-    BWDB_danger_level = matching_station['DLm'].iloc[0] if not matching_station.empty else np.nan
-    dl_interp = matching_station['DLmInterp'].iloc[0] if not matching_station.empty else np.nan
-
-
-    if station_name in ninetyfive_percentile_station:
-                danger_level = dl_95th
-                interpolated_note = '(95th Percentile) '
-    else: 
-        if  pd.isna(BWDB_danger_level):
-            danger_level = dl_interp
-            interpolated_note = '(Interpolated) '
-        else: 
-            danger_level = BWDB_danger_level
-            interpolated_note = '(BWDB) '
-        
-    for watervalue in dt_used[station_name]:
-        if watervalue >  danger_level:
-            count += 1
-
-    percentage = round((count/(12418))*100,2)
-    ax.text(1.02, 0.6,f'{interpolated_note}Danger Level Exceeded Times: {count} ({percentage:.2f}%)', transform=ax.transAxes, color='red', verticalalignment='top',fontsize=7)
-    ax.axhline(BWDB_danger_level, color='firebrick', linestyle='-', label=f'BWDB Danger Level: {BWDB_danger_level:.2f}')
-    ax.axhline(dl_interp, color='lightpink', linestyle='-', label=f'Interpolated Danger Level: {dl_interp:.2f}')
-    ax.axhline(dl_95th, color='mediumorchid', linestyle='-', label=f'95th Percentile Danger Level: {dl_95th:.2f}')
+# draws one page of (up to) four stations from their engine results
+def plot_page_daily(page, shared):
+    df_all_stations, results, fast = shared
 
+    fig, axes = page_axes(fast)
 
+    for i in range(4):
+        if i < len(page):
+            station_name = page[i]
 
-    # Per year num of days exceeds DL
-    df_exceed = dt_used[['Date', station_name]].copy()
-    df_exceed['Year'] = pd.to_datetime(df_exceed['Date']).dt.year
-    df_exceed['Exceed'] = df_exceed[station_name] > danger_level
+            with stage('plot', station_name):
+                plot_station_daily(df_all_stations, station_name, axes[i], results.loc[station_name], fast)
 
-    exceed_per_year = df_exceed.groupby('Year')['Exceed'].sum().to_dict()  
+        else:
+            axes[i].set_visible(False)
 
+    return finish_page(fig, fast)
 
 
-    # Legend position and showing the grid 
-    ax.legend(loc='upper left', bbox_to_anchor=(1, 1),fontsize=7)
-    ax.grid(True)
 
-    return {
-        'StationID': station_name,
-        'StartDate': stationdata['Date'].iloc[0],
-        'EndDate': stationdata['Date'].iloc[-1],
-        'MeanLevel': mean_level,
-        'Linear_Slope': slope_linear,
-        'Deseasonalised_Slope': slope_desea,
-        'TheilSen_Slope': slope_sen,
-        'DangerLevel_adopted':danger_level,
-        'BWDB_DangerLevel': BWDB_danger_level,
-        '95th_DL':dl_95th,
-        'Interpolated_DL':dl_interp, 
-        'Total_Amount_of_Data': (len(dt_used['DecimYear'])), 
-        'DL_Exceeded_Count':count,
-        'DL_Exceeded_Percentage': percentage,
-        'DL_Exceeded_Per_Year': exceed_per_year
-    }
+# cache key of a page: the series and the results of its stations (that's everything it draws)
+def daily_page_key(page, shared):
+    df_all_stations, results, fast = shared
+    key = content_hash('daily_page', fast, np.asarray(df_all_stations['DecimYear']),
+                       [np.asarray(df_all_stations[station_name]) for station_name in page],
+                       [results.loc[station_name] for station_name in page])
+    return '+'.join(page), key
+
+
+
+
+
+if __name__ == "__main__":
+
+    # the plotting stack, only the report pages need it (see fast_render.pyplot)
+    from matplotlib.backends.backend_pdf import PdfPages
+    plt = pyplot()
+
+    # getting all the station data  (input path)
+    file_csv_path = '/Users/biar/Desktop/tesr.csv'    ###change when needed 
 
+    ## stage timing: every stage of every station into this JSON lines file (None = off, see stage_trace.py),
+    ## the peak memory of every stage and station too (tracemalloc, slows the run down) and cProfile over one
+    ## station (None = no profile)
+    trace_path = None                                                                         ### change when needed 
+    trace_memory = False                                                                      ### change when needed 
+    profile_station = None                                                                    ### change when needed 
+    if trace_path or trace_memory or profile_station:
+        start_trace(trace_path, memory=trace_memory, profile_station=profile_station)
 
+    ## binary store of the merged CSV (built on the first run and whenever the CSV changes, then opened
+    ## memory-mapped in no time), None = read the CSV every run; 'float32' halves its size
+    store_dir = None                                                                          ### change when needed 
+    store_dtype = 'float64'                                                                   ### change when needed 
 
+    if store_dir:
+        print(f"Opening the station store of: {file_csv_path}")
+        with stage('open_store'):
+            df_all_stations = open_station_store(file_csv_path, store_dir, dtype=store_dtype)
+    else:
+        print(f"Loading merged CSV: {file_csv_path}")
+        with stage('read_csv'):
+            df_all_stations = pd.read_csv(file_csv_path)
 
+    #getting the danger level water data
+    DL_data = pd.read_csv('/Users/biar/Desktop/SWL_DL_extracted_from_interpolated.csv')
 
-# getting all the station data  (input path)
-file_csv_path = '/Users/biar/Desktop/tesr.csv'    ###change when needed 
-print(f"Loading merged CSV: {file_csv_path}")
 
-df_all_stations = pd.read_csv(file_csv_path)
 
-#getting the danger level water data
-DL_data = pd.read_csv('/Users/biar/Desktop/SWL_DL_extracted_from_interpolated.csv')
 
+    #getting all the stations name columns 
+    station_columns = [col for col in df_all_stations.columns 
+                      if col.startswith('SW') and col not in ['Date', 'Year', 'Month', 'Day', 'DecimYear']]
 
+    print(f"Found {len(station_columns)} stations to process")
+    print("Station names:", station_columns[:10], "..." if len(station_columns) > 10 else "")
 
 
-#getting all the stations name columns 
-station_columns = [col for col in df_all_stations.columns 
-                  if col.startswith('SW') and col not in ['Date', 'Year', 'Month', 'Day', 'DecimYear']]
+    ## setting output path
+    output_path='/Users/biar/Desktop/all_station_lowtide_plots.pdf'                         ### change the output path when needed 
 
-print(f"Found {len(station_columns)} stations to process")
-print("Station names:", station_columns[:10], "..." if len(station_columns) > 10 else "")
+    ## number of worker processes (1 = the old single process loop, None = all cores)
+    n_workers = 1                                                                             ### change when needed 
 
 
-## setting output path
-output_path='/Users/biar/Desktop/all_station_lowtide_plots.pdf'                         ### change the output path when needed 
 
 
+    ## set to False to only write the summary CSV (statistics only, no plots at all)
+    make_pdf = True                                                                           ### change when needed 
 
+    ## fast rendering: one reused figure, thinned series (smaller PDF, same statistics)
+    fast_render = False                                                                       ### change when needed 
 
+    ## Theil-Sen: 'exact' median of all pairwise slopes, 'approx' samples them (quicker look)
+    theilsen_method = 'exact'                                                                 ### change when needed 
 
+    ## GEV of the annual maxima (return period of the danger level, 10/50/100 year levels): 'lmoments' all stations
+    ## at once, 'mle' refines every station by maximum likelihood (slower, uses n_workers)
+    gev_method = 'lmoments'                                                                   ### change when needed 
 
-###the main loop
-# loop through all the stations 
+    ## result cache, unchanged stations/pages are reused from here on the next run (None = no cache)
+    cache_dir = None                                                                          ### change when needed 
+    cache = ResultCache(cache_dir, max_bytes=2 * 1024 ** 3) if cache_dir else None
 
-start_time = datetime.now()
-print(f"Loop started at: {start_time}")
+    ## moving window trends: the OLS slope of every window_years window, one every step_years (stations x windows CSV),
+    ## and their heatmap (None = no heatmap)
+    rolling_window_years = 10                                                                 ### change when needed 
+    rolling_step_years = 1                                                                    ### change when needed 
+    rolling_trends_path = '/Users/biar/Desktop/all_station_lowtide_rolling_trends.csv'        ### change the output path when needed 
+    rolling_heatmap_path = '/Users/biar/Desktop/all_station_lowtide_rolling_trends.pdf'       ### change the output path when needed 
 
 
-with PdfPages(output_path) as pdf:
 
-    for j in range(0, len(station_columns), 4):
-        fig, axes = plt.subplots(nrows=4, ncols=1, figsize=(12, 18))
 
-        for i in range(4):
-            if j + i < len(station_columns):
-                station_name = station_columns[j + i]
-              
-                # Create a subset of data for this station (with all necessary columns)
-                station_data = df_all_stations[['Date', 'Year', 'Month', 'Day', 'DecimYear', station_name]].copy()
+    ###the main loop
+    start_time = datetime.now()
+    print(f"Loop started at: {start_time}")
 
+    # all the statistics for all stations in one go (headless)
+    with stage('batch_trends', stations=len(station_columns)):
+        results, events = batch_trends(df_all_stations, DL_data, station_columns, n_workers=n_workers,
+                                       theilsen_method=theilsen_method, cache=cache, gev_method=gev_method,
+                                       return_events=True)
+    print(f"Statistics done for {len(results)} stations")
 
 
-                result_of_station = tmplt_daily(station_data, station_name, axes[i],DL_data)
+    # the plots only draw from the results, four to a page, pages come back in order even with several workers
+    if make_pdf:
+        results_by_station = results.set_index('StationID', drop=False)
 
-                the_result_table.append(result_of_station)
+        with PdfPages(output_path) as pdf:
 
+            pages = paginate(station_columns)
 
+            for page_number, fig in enumerate(staged(run_pages_cached(plot_page_daily, pages, cache, daily_page_key,
+                                                                      n_workers=n_workers,
+                                                                      shared=(df_all_stations, results_by_station, fast_render)),
+                                                     'draw_page')):
 
-            else:
-                axes[i].set_visible(False)  
+                with stage('savefig', page=page_number + 1):
+                    pdf.savefig(fig, **savefig_options(fast_render))
+                plt.close(fig)
+                print(f"Completed batch {page_number + 1}")
 
-        plt.tight_layout()
-        pdf.savefig(fig, bbox_inches='tight')
-        plt.close(fig)
-        print(f"Completed batch {j//4 + 1}")
+        print(f"PDF saved to: {os.path.abspath(output_path)}")
 
 
-results_df = pd.DataFrame(the_result_table)
+    summary_df_final = summary_table(results)
 
-exceed_per_year_df = pd.json_normalize(results_df['DL_Exceeded_Per_Year'])
-exceed_per_year_df['StationID'] = results_df['StationID']
 
-summary_df_final = pd.concat([results_df.drop(columns=['DL_Exceeded_Per_Year']), exceed_per_year_df], axis=1)
 
 
+    results_csv_path = '/Users/biar/Desktop/all_station_lowtide_summary_result.csv'      # change when needed 
+    summary_df_final.to_csv(results_csv_path, index=False)
+    print(f"Summary CSV saved to: {results_csv_path}")
 
+    # every run of days above the adopted danger level (start, duration, peak), from batch_trends' exceedance
+    events_csv_path = '/Users/biar/Desktop/all_station_lowtide_flood_events.csv'        # change when needed 
+    events.to_csv(events_csv_path, index=False)
+    print(f"Flood events CSV saved to: {events_csv_path} ({len(events)} events)")
 
-results_csv_path = '/Users/biar/Desktop/all_station_lowtide_summary_result.csv'      # change when needed 
-summary_df_final.to_csv(results_csv_path, index=False)
-print(f"Summary CSV saved to: {results_csv_path}")
+    # the slope of every station over every moving window, all from one pass of running sums
+    rolling_slopes = rolling_trends(df_all_stations, station_columns, window_years=rolling_window_years,
+                                    step_years=rolling_step_years)
+    rolling_slopes.to_csv(rolling_trends_path)
+    print(f"Moving window trends CSV saved to: {rolling_trends_path} ({rolling_slopes.shape[1]} windows)")
 
-print(f"PDF saved to: {os.path.abspath(output_path)}")
+    if rolling_heatmap_path:
+        with PdfPages(rolling_heatmap_path) as pdf:
+            for fig in rolling_heatmap_pages(rolling_slopes):
+                pdf.savefig(fig)
+                plt.close(fig)
+        print(f"Moving window heatmap saved to: {rolling_heatmap_path}")
 
-end_time = datetime.now()
-print(f"Loop ended at: {end_time}")
-print(f"Total runtime: {end_time - start_time}")
+    end_time = datetime.now()
+    print(f"Loop ended at: {end_time}")
+    print(f"Total runtime: {end_time - start_time}")
 
+    # the slowest stages and stations of the run (when traced)
+    stop_trace()
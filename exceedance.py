@@ -0,0 +1,90 @@
+## Danger level exceedance for the whole station matrix in one go
+## counts, percentages, per year counts and the flood events (runs of days above the danger level)
+
+# imports
+import numpy as np
+import pandas as pd
+
+
+
+# number of True cells per year for every column (years x stations), a one-hot product instead of a groupby
+def counts_per_year(flags, years):
+    year_values, year_codes = np.unique(np.asarray(years), return_inverse=True)
+    one_hot = (year_codes[None, :] == np.arange(len(year_values))[:, None]).astype(np.int64)
+    return year_values, one_hot @ np.asarray(flags, dtype=np.int64)
+
+
+
+# start (inclusive) and end (exclusive) of every run of True down the columns of flags (time x stations)
+# returned ordered by station and then time
+def run_lengths(flags):
+    flags = np.asarray(flags, dtype=bool)
+    if flags.ndim == 1:
+        flags = flags[:, None]
+
+    n_steps, n_stations = flags.shape
+    padded = np.zeros((n_stations, n_steps + 2), dtype=np.int8)
+    padded[:, 1:-1] = flags.T
+
+    change = np.diff(padded, axis=1)
+    station, start = np.nonzero(change == 1)
+    _, end = np.nonzero(change == -1)
+    return station, start, end
+
+
+
+# values: time x stations (NaN = no data), danger_levels: one adopted level per station
+# (BWDB, interpolated or 95th percentile, NaN = no level), dates: the time axis
+#
+# returns a dict with
+#   'exceeded'   : time x stations bool matrix (value > danger level)
+#   'count'      : days above the danger level per station
+#   'valid_days' : days with data per station
+#   'percentage' : count over valid days, in %
+#   'per_year'   : years x stations DataFrame of days above the danger level
+#   'events'     : one row per flood event: StationID, Start, End, Duration (days), Peak
+def exceedance_engine(values, danger_levels, dates, station_ids):
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    danger_levels = np.asarray(danger_levels, dtype=float).reshape(-1)
+    dates = pd.DatetimeIndex(dates)
+    station_ids = list(station_ids)
+
+
+    # NaN compares False, so days without data or stations without a level never count
+    with np.errstate(invalid='ignore'):
+        exceeded = values > danger_levels[None, :]
+
+    count = exceeded.sum(axis=0)
+    valid_days = np.isfinite(values).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percentage = count / valid_days * 100
+
+
+    year_values, per_year = counts_per_year(exceeded, dates.year)
+    per_year = pd.DataFrame(per_year, index=pd.Index(year_values, name='Year'), columns=station_ids)
+
+
+    # flood events, the peak is a max over each run of the column-major values
+    station, start, end = run_lengths(exceeded)
+    flat = np.append(values.T.ravel(), np.nan)
+    offset = station * values.shape[0]
+    bounds = np.ravel(np.column_stack([offset + start, offset + end]))
+    peak = np.maximum.reduceat(flat, bounds)[::2] if len(bounds) else np.empty(0)
+
+    events = pd.DataFrame({
+        'StationID': np.asarray(station_ids, dtype=object)[station],
+        'Start': dates[start],
+        'End': dates[end - 1],
+        'Duration': end - start,
+        'Peak': peak})
+
+
+    return {
+        'exceeded': exceeded,
+        'count': count,
+        'valid_days': valid_days,
+        'percentage': percentage,
+        'per_year': per_year,
+        'events': events}
@@ -0,0 +1,207 @@
+## Extreme value analysis of the whole station matrix: annual maxima, a GEV per station, return periods and levels
+## the annual maxima of all stations come out of one reduce over the year blocks of the matrix, the GEV of all
+## stations from their L-moments (Hosking 1990) in a few array operations; the maximum likelihood fit (scipy,
+## one station at a time) is only an optional refinement started from the L-moment fit, run on the process pool
+##
+## the shape k follows Hosking (and scipy.stats.genextreme's c): k > 0 bounded upper tail, k < 0 heavy tail (Frechet)
+
+# imports
+import numpy as np
+import pandas as pd
+from scipy.special import gamma
+from parallel_run import paginate, run_pages
+from stage_trace import stage
+
+
+
+# the return periods (years) of the return level columns
+RETURN_PERIODS = (10, 50, 100)
+
+# |k| below this is taken as the Gumbel limit (k = 0)
+_GUMBEL_K = 1e-6
+
+
+
+# the maximum of every year of every column of values (time x stations), NaN days left out
+# a year needs min_coverage of its days with data, otherwise its maximum is NaN (a dry season gap would
+# otherwise give a "maximum" far below the flood peak)
+# returns the years and the years x stations maxima
+def annual_maxima(values, dates, min_coverage=0.75):
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    years = pd.DatetimeIndex(dates).year.to_numpy()
+
+    # rows are in time order, so every year is one block and one reduceat covers all stations
+    start = np.flatnonzero(np.r_[True, years[1:] != years[:-1]])
+    year_values = years[start]
+    if len(np.unique(year_values)) != len(year_values):
+        raise ValueError("The dates must be in time order")
+
+    with np.errstate(invalid='ignore'):
+        maxima = np.fmax.reduceat(values, start, axis=0)
+    valid_days = np.add.reduceat(np.isfinite(values), start, axis=0)
+    days_in_year = np.where(pd.to_datetime(year_values.astype(str) + '-12-31').is_leap_year, 366, 365)
+
+    maxima[valid_days < min_coverage * days_in_year[:, None]] = np.nan
+    return year_values, maxima
+
+
+
+# the first three sample L-moments (l1, l2 and t3 = l3 / l2) of every column of X (samples x stations, NaN = missing)
+# from the probability weighted moments b0, b1, b2 of each column's sorted values
+def l_moments(X):
+    X = np.sort(np.asarray(X, dtype=float), axis=0)         # NaN sorts last
+    n = np.isfinite(X).sum(axis=0).astype(float)
+    j = np.arange(X.shape[0], dtype=float)[:, None]          # 0 based rank
+    x = np.where(np.isfinite(X), X, 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        b0 = x.sum(axis=0) / n
+        b1 = (x * j).sum(axis=0) / (n * (n - 1))
+        b2 = (x * j * (j - 1)).sum(axis=0) / (n * (n - 1) * (n - 2))
+
+        l1 = b0
+        l2 = 2 * b1 - b0
+        l3 = 6 * b2 - 6 * b1 + b0
+        t3 = l3 / l2
+    return l1, l2, t3, n
+
+
+
+# GEV location, scale and shape of every station from its L-moments (Hosking's approximation of k from t3)
+def gev_from_l_moments(l1, l2, t3):
+    c = 2 / (3 + t3) - np.log(2) / np.log(3)
+    k = 7.8590 * c + 2.9554 * c ** 2
+
+    gumbel = np.abs(k) < _GUMBEL_K
+    k_safe = np.where(gumbel, 1.0, k)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        g = gamma(1 + k_safe)
+        scale = np.where(gumbel, l2 / np.log(2), l2 * k_safe / ((1 - 2 ** -k_safe) * g))
+        location = np.where(gumbel, l1 - np.euler_gamma * scale, l1 - scale * (1 - g) / k_safe)
+
+    bad = ~(np.isfinite(scale) & (scale > 0))
+    for a in (location, scale, k):
+        a[bad] = np.nan
+    return location, scale, np.where(gumbel, 0.0, k)
+
+
+
+# the level exceeded on average once every T years (T > 1) of every station
+def return_level(location, scale, shape, T):
+    y = -np.log(1 - 1 / np.asarray(T, dtype=float))        # -log F
+    gumbel = np.abs(shape) < _GUMBEL_K
+    k_safe = np.where(gumbel, 1.0, shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(gumbel, location - scale * np.log(y), location + scale / k_safe * (1 - y ** k_safe))
+
+
+
+# the return period (years) of a level z of every station, 1 / (1 - F(z)) with F the GEV of the annual maxima
+# a level above the upper end of a bounded GEV (k > 0) is never reached: inf; no level (NaN) or no fit: NaN
+def return_period(location, scale, shape, z):
+    z = np.asarray(z, dtype=float)
+    gumbel = np.abs(shape) < _GUMBEL_K
+    k_safe = np.where(gumbel, 1.0, shape)
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        s = (z - location) / scale
+        inner = 1 - k_safe * s
+        reduced = np.where(gumbel, np.exp(-s), np.where(inner > 0, inner, 0.0) ** (1 / k_safe))
+        exceedance = -np.expm1(-reduced)                     # 1 - F, exact for the rare levels
+        # (inner > 0 would turn a NaN into 0, i.e. a period of 1 year or inf)
+        return np.where(np.isfinite(s), 1 / exceedance, np.nan)
+
+
+
+# the maximum likelihood GEV of a chunk of stations (columns of the annual maxima), started from their L-moment fit;
+# a fit that fails or lands nowhere sensible keeps the L-moment parameters
+def _mle_chunk(chunk, shared):
+    from scipy.stats import genextreme
+
+    maxima, location, scale, shape = shared
+    out = []
+
+    for j in chunk:
+        sample = maxima[:, j][np.isfinite(maxima[:, j])]
+        start = (shape[j], location[j], scale[j])
+        if not np.all(np.isfinite(start)):
+            out.append(start)
+            continue
+
+        try:
+            c, loc, sc = genextreme.fit(sample, start[0], loc=start[1], scale=start[2])
+        except (ValueError, RuntimeError, FloatingPointError):
+            c, loc, sc = start
+
+        out.append((c, loc, sc) if np.all(np.isfinite([c, loc, sc])) and sc > 0 else start)
+
+    return out
+
+
+
+# GEV of the annual maxima of every station plus the return period of its danger level and its return levels
+# values: time x stations, dates: the time axis, danger_levels: one level per station (NaN = none)
+# method='lmoments' the batched L-moment fit, 'mle' refines it by maximum likelihood (n_workers > 1 on a pool)
+# a station with fewer than min_years annual maxima gets no fit
+def gev_analysis(values, dates, station_ids, danger_levels, return_periods=RETURN_PERIODS, method='lmoments',
+                 min_years=10, min_coverage=0.75, n_workers=1, chunk_size=32):
+    if method not in ('lmoments', 'mle'):
+        raise ValueError(f"Unknown GEV fit method {method!r}, use 'lmoments' or 'mle'")
+    station_ids = list(station_ids)
+
+    with stage('annual_maxima', stations=len(station_ids)):
+        years, maxima = annual_maxima(values, dates, min_coverage=min_coverage)
+
+    with stage('gev_lmoments', stations=len(station_ids)):
+        l1, l2, t3, n_years = l_moments(maxima)
+        location, scale, shape = gev_from_l_moments(l1, l2, t3)
+
+    too_few = n_years < max(min_years, 3)
+    for a in (location, scale, shape):
+        a[too_few] = np.nan
+
+    if method == 'mle':
+        chunks = paginate(list(np.flatnonzero(~too_few)), per_page=chunk_size)
+        with stage('gev_mle', stations=int((~too_few).sum())):
+            fitted = [fit for chunk_out in run_pages(_mle_chunk, chunks, n_workers=n_workers,
+                                                     shared=(maxima, location, scale, shape)) for fit in chunk_out]
+        if fitted:
+            rows = np.flatnonzero(~too_few)
+            shape[rows], location[rows], scale[rows] = np.array(fitted).T
+
+    table = pd.DataFrame({
+        'StationID': station_ids,
+        'GEV_Years': n_years.astype(int),
+        'GEV_Location': location,
+        'GEV_Scale': scale,
+        'GEV_Shape': shape,
+        'DL_ReturnPeriod': return_period(location, scale, shape, danger_levels)})
+    for T in return_periods:
+        table[f'ReturnLevel_{T}'] = return_level(location, scale, shape, T)
+
+    return table
+
+
+
+
+
+if __name__ == "__main__":
+
+    # checks: a station without a danger level (NaN) or without a fit gets no return period, for every sign of k,
+    # and a Gumbel level is back at its return period
+    location, scale = np.array([5.0, 5.0, 5.0]), np.array([1.0, 1.0, 1.0])
+    for k in (-0.2, 0.0, 0.2):
+        shape = np.full(3, k)
+        periods = return_period(location, scale, shape, [6.0, np.nan, 7.0])
+        if not (np.isfinite(periods[[0, 2]]).all() and np.isnan(periods[1])):
+            raise AssertionError(f"k={k}: {periods}")
+        if not np.isnan(return_period(np.nan, np.nan, np.nan, 6.0)):
+            raise AssertionError("a station without a fit got a return period")
+
+    level = return_level(location, scale, np.zeros(3), 50)
+    if not np.allclose(return_period(location, scale, np.zeros(3), level), 50):
+        raise AssertionError("return_period is not the inverse of return_level")
+
+    print("return_period checks passed")
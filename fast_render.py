@@ -0,0 +1,119 @@
+## Fast rendering of the report pages: one reused figure per process, series thinned for display only and
+## trend lines from their two end points, so every page stays a small vector PDF page
+## (the statistics are always computed on the full series, this only changes what is drawn)
+## nothing is rasterized: a thinned line has at most 2 * DISPLAY_BINS points, and as a raster layer it is slower
+## to save and bigger in the PDF than as a vector line
+
+# imports
+import os
+import sys
+import numpy as np
+
+
+
+# a line is thinned to the min and max of this many bins (2 points per bin), about the pixels an axis has
+DISPLAY_BINS = 1000
+
+_templates = {}
+
+
+
+# pyplot, imported on first use (matplotlib takes most of a second to import, the data jobs never need it)
+# with the non-interactive Agg backend unless MPLBACKEND asks for another one or pyplot was already set up
+# (the drivers only write PDF pages, no window is ever shown)
+def pyplot():
+    if 'matplotlib.pyplot' not in sys.modules and not os.environ.get('MPLBACKEND'):
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+
+# min/max envelope of a series for display: per bin, its lowest and highest point in time order,
+# so peaks and troughs (the floods) survive the thinning; an all-NaN bin becomes one NaN (a gap in the line)
+def minmax_downsample(x, y, n_bins=DISPLAY_BINS):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= 2 * n_bins:
+        return x, y
+
+    bin_size = -(-n // n_bins)
+    n_bins = -(-n // bin_size)
+    pad = n_bins * bin_size - n
+    yb = np.concatenate([y, np.full(pad, np.nan)]).reshape(n_bins, bin_size)
+
+    empty = np.isnan(yb).all(axis=1)
+    low = np.argmin(np.where(np.isnan(yb), np.inf, yb), axis=1)
+    high = np.argmax(np.where(np.isnan(yb), -np.inf, yb), axis=1)
+
+    first = np.minimum(low, high) + np.arange(n_bins) * bin_size
+    second = np.maximum(low, high) + np.arange(n_bins) * bin_size
+    idx = np.column_stack([first, second]).ravel()
+    idx = np.minimum(idx, n - 1)
+
+    x_out = x[idx]
+    y_out = y[idx]
+    y_out[np.repeat(empty, 2)] = np.nan
+    return x_out, y_out
+
+
+
+# a station series on ax, thinned in fast mode
+def plot_series(ax, x, y, fast=False, n_bins=DISPLAY_BINS, **kwargs):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if not fast:
+        return ax.plot(x, y, **kwargs)
+
+    x, y = minmax_downsample(x, y, n_bins)
+    return ax.plot(x, y, **kwargs)
+
+
+
+# a straight trend line intercept + slope * x over x, drawn from its two end points in fast mode
+def plot_trend(ax, x, slope, intercept, fast=False, **kwargs):
+    x = np.asarray(x, dtype=float)
+    if fast:
+        x = np.array([np.nanmin(x), np.nanmax(x)])
+    return ax.plot(x, intercept + slope * x, **kwargs)
+
+
+
+# the 4 x 1 page the drivers draw on
+# fast=True hands out the same figure every time (cleared), laid out once with fixed margins that leave room
+# for the legends and texts on the right, instead of a new figure and a tight_layout per page
+def page_axes(fast=False, nrows=4, figsize=(12, 18)):
+    if not fast:
+        return pyplot().subplots(nrows=nrows, ncols=1, figsize=figsize)
+
+    key = (nrows, figsize)
+    if key not in _templates:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(figsize[0] * 1.5, figsize[1]))
+        axes = fig.subplots(nrows=nrows, ncols=1)
+        fig.subplots_adjust(left=0.05, right=0.66, bottom=0.03, top=0.97, hspace=0.3)
+        _templates[key] = (fig, np.atleast_1d(axes))
+
+    fig, axes = _templates[key]
+    for ax in axes:
+        ax.clear()
+        ax.set_visible(True)
+    return fig, axes
+
+
+
+# the end of a page: tight_layout for the normal pages, the template is already laid out
+def finish_page(fig, fast=False):
+    if not fast:
+        fig.tight_layout()
+    return fig
+
+
+
+# PdfPages.savefig options of a page (the template is laid out already, no tight bounding box needed)
+def savefig_options(fast=False):
+    if fast:
+        return {}
+    return {'bbox_inches': 'tight'}
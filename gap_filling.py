@@ -0,0 +1,223 @@
+## Filling the gaps of the merged daily station matrix from the most correlated neighbour stations
+## the Python counterpart of filling_dfgaps.R (missForest), quick enough to refill after every data correction
+##   1. every station gets the k stations it correlates best with (over at least min_overlap common days, and nearby
+##      when the coordinates are given, see station_correlation.neighbour_graph)
+##   2. per year block, the station is regressed on each neighbour over their common days of that year
+##      (the whole record when a year has too few of them) and a gap day is the r^2 weighted mean of the
+##      predictions of the neighbours that have a value on that day
+##   3. what is still missing (no neighbour has a value) gets the station's mean for that day of the year
+
+# imports
+import numpy as np
+import pandas as pd
+from parallel_run import run_pages
+from trend_engine import META_COLUMNS
+from station_correlation import pairwise_correlation, neighbour_graph
+
+
+
+# least squares of y (time x stations) on each of its neighbours x (time x stations x k), over their common days
+def _pair_regression(y, x):
+    both = np.isfinite(y)[:, :, None] & np.isfinite(x)
+    n = both.sum(axis=0)
+
+    yy = np.where(both, y[:, :, None], 0.0)
+    xx = np.where(both, x, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = xx.sum(axis=0) / n
+        y_mean = yy.sum(axis=0) / n
+        dx = np.where(both, xx - x_mean, 0.0)
+        dy = np.where(both, yy - y_mean, 0.0)
+        sxx = (dx * dx).sum(axis=0)
+        slope = (dx * dy).sum(axis=0) / sxx
+        intercept = y_mean - slope * x_mean
+
+    bad = (n < 2) | (sxx <= 0)
+    slope[bad] = np.nan
+    intercept[bad] = np.nan
+    return slope, intercept, n
+
+
+
+# the neighbour values of every station (time x stations x k), NaN for the missing neighbours
+def _neighbour_values(Y, neighbours):
+    x = Y[:, np.maximum(neighbours, 0)]
+    x[:, neighbours < 0] = np.nan
+    return x
+
+
+
+# fills one block of rows (a year), shared = (Y, neighbours, weights, whole record slope/intercept, min_block_overlap)
+# returns the block with its gaps filled where any neighbour has a value
+def _fill_block(block, shared):
+    Y, neighbours, weights, slope_all, intercept_all, min_block_overlap = shared
+    start, stop = block
+
+    y = Y[start:stop]
+    x = _neighbour_values(Y[start:stop], neighbours)
+
+    # this year's relation, or the whole record's when the year has too few common days
+    slope, intercept, n = _pair_regression(y, x)
+    use_all = (n < min_block_overlap) | ~np.isfinite(slope)
+    slope = np.where(use_all, slope_all, slope)
+    intercept = np.where(use_all, intercept_all, intercept)
+
+    prediction = intercept + slope * x
+    available = np.isfinite(prediction)
+    w = np.where(available, weights[None, :, :], 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        estimate = (np.where(available, prediction, 0.0) * w).sum(axis=2) / w.sum(axis=2)
+
+    return np.where(np.isfinite(y), y, estimate)
+
+
+
+# the gaps of Y (time x stations) filled, years: the year of every row (the blocks), day_of_year: for the fallback
+# lat / lon: the coordinates of the stations (None = neighbours by correlation only)
+# returns the filled matrix, where each filled cell came from (0 observed, 1 neighbours, 2 day of year mean,
+# 3 still missing) and the neighbours (stations x k column positions, -1 = none)
+def fill_matrix(Y, years, day_of_year, k=5, min_overlap=365, min_block_overlap=60, n_workers=1, lat=None, lon=None):
+    Y = np.asarray(Y, dtype=float)
+    years = np.asarray(years)
+    day_of_year = np.asarray(day_of_year)
+    observed = np.isfinite(Y)
+
+
+    corr, overlap = pairwise_correlation(Y)
+    neighbours, _ = neighbour_graph(corr, overlap, np.arange(Y.shape[1]), lat, lon, k=k, min_overlap=min_overlap)
+    weights = np.where(neighbours >= 0, np.take_along_axis(corr, np.maximum(neighbours, 0), axis=1) ** 2, 0.0)
+
+    slope_all, intercept_all, _ = _pair_regression(Y, _neighbour_values(Y, neighbours))
+
+
+    # year blocks (the rows of a year are contiguous in the merged matrix)
+    change = np.flatnonzero(np.diff(years)) + 1
+    bounds = np.concatenate([[0], change, [len(years)]])
+    blocks = [(int(bounds[j]), int(bounds[j + 1])) for j in range(len(bounds) - 1)]
+
+    filled = np.empty_like(Y)
+    shared = (Y, neighbours, weights, slope_all, intercept_all, min_block_overlap)
+    for (start, stop), block_filled in zip(blocks, run_pages(_fill_block, blocks, n_workers=n_workers, shared=shared)):
+        filled[start:stop] = block_filled
+    from_neighbours = ~observed & np.isfinite(filled)
+
+
+    # the day of year mean of each station for what no neighbour could fill
+    doy_values, doy_codes = np.unique(day_of_year, return_inverse=True)
+    one_hot = (doy_codes[None, :] == np.arange(len(doy_values))[:, None]).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        doy_mean = (one_hot @ np.where(observed, Y, 0.0)) / (one_hot @ observed.astype(float))
+    still_missing = ~np.isfinite(filled)
+    filled[still_missing] = doy_mean[doy_codes][still_missing]
+
+    source = np.zeros(Y.shape, dtype=np.int8)
+    source[from_neighbours] = 1
+    source[still_missing] = 2
+    source[~np.isfinite(filled)] = 3
+
+    return filled, source, neighbours
+
+
+
+# NRMSE of the filling on held out values, the same measure as missForest's OOB error:
+# sqrt(mean((true - filled)^2) / var(true)) over a random fraction of the observed cells
+# returns the overall error and one per station (NaN for stations without held out cells)
+def holdout_error(Y, years, day_of_year, fraction=0.05, seed=42, **fill_options):
+    Y = np.asarray(Y, dtype=float)
+    rng = np.random.default_rng(seed)
+
+    held_out = np.isfinite(Y) & (rng.random(Y.shape) < fraction)
+    masked = np.where(held_out, np.nan, Y)
+    filled, _, _ = fill_matrix(masked, years, day_of_year, **fill_options)
+
+    true = np.where(held_out, Y, np.nan)
+    error = np.where(held_out, filled - Y, np.nan)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        overall = np.sqrt(np.nanmean(error[held_out] ** 2) / np.var(true[held_out]))
+        per_station = np.sqrt(np.nanmean(error ** 2, axis=0) / np.nanvar(true, axis=0))
+
+    return overall, per_station
+
+
+
+# the merged frame (Date, Year, Month, Day, DecimYear, SW...) with its station gaps filled,
+# plus a report of one row per station: how many days were filled and how, its neighbours and its holdout error
+# coordinates: the station info table (StationID, Latitude, Longitude) to prefer nearby neighbours, None = not used
+def fill_gaps(df_all_stations, station_columns=None, k=5, min_overlap=365, min_block_overlap=60, n_workers=1,
+              holdout_fraction=0.05, seed=42, coordinates=None):
+
+    if station_columns is None:
+        station_columns = [col for col in df_all_stations.columns if col not in META_COLUMNS]
+    station_columns = list(station_columns)
+
+    dates = pd.DatetimeIndex(pd.to_datetime(df_all_stations['Date']))
+    Y = df_all_stations[station_columns].to_numpy(dtype=float)
+    fill_options = {'k': k, 'min_overlap': min_overlap, 'min_block_overlap': min_block_overlap, 'n_workers': n_workers}
+    if coordinates is not None:
+        coords = coordinates.drop_duplicates(subset='StationID').set_index('StationID').reindex(station_columns)
+        fill_options.update(lat=coords['Latitude'].to_numpy(dtype=float), lon=coords['Longitude'].to_numpy(dtype=float))
+
+    filled, source, neighbours = fill_matrix(Y, dates.year, dates.dayofyear, **fill_options)
+
+    df_filled = df_all_stations.copy()
+    df_filled[station_columns] = filled
+
+
+    overall, per_station = holdout_error(Y, dates.year, dates.dayofyear, fraction=holdout_fraction, seed=seed,
+                                         **fill_options)
+
+    names = np.asarray(station_columns, dtype=object)
+    report = pd.DataFrame({
+        'StationID': station_columns,
+        'Missing': (source > 0).sum(axis=0),
+        'FilledFromNeighbours': (source == 1).sum(axis=0),
+        'FilledFromDayOfYearMean': (source == 2).sum(axis=0),
+        'StillMissing': (source == 3).sum(axis=0),
+        'Neighbours': [','.join(names[row[row >= 0]]) for row in neighbours],
+        'HoldoutNRMSE': per_station})
+    report.attrs['HoldoutNRMSE'] = overall
+
+    return df_filled, report
+
+
+
+
+
+if __name__ == "__main__":
+
+    # the merged matrix of merge_surface_water_data (input path)
+    merged_csv_path = '/Users/biar/Desktop/merged_surface_water_data.csv'                   ### change when needed
+    output_csv_path = '/Users/biar/Desktop/surface_water_data_filled.csv'                   ### change when needed
+    report_csv_path = '/Users/biar/Desktop/surface_water_data_filled_report.csv'            ### change when needed
+
+    ## number of neighbour stations per station, and worker processes for the year blocks (None = all cores)
+    k = 5                                                                                   ### change when needed
+    n_workers = 1                                                                           ### change when needed
+
+    ## the station info table (StationID, Latitude, Longitude), nearby stations are then preferred as neighbours
+    ## (None = neighbours by correlation only)
+    coordinates_path = None                                                                 ### change when needed
+
+
+    df = pd.read_csv(merged_csv_path)
+    coordinates = pd.read_csv(coordinates_path) if coordinates_path else None
+
+    print("Starting neighbour imputation...")
+    start_time = pd.Timestamp.now()
+
+    df_filled, report = fill_gaps(df, k=k, n_workers=n_workers, coordinates=coordinates)
+
+    end_time = pd.Timestamp.now()
+    print("Imputation finished!")
+    print(f"Elapsed time: {end_time - start_time}")
+
+
+    # imputation error estimate (comparable to missForest's OOB error)
+    print(f"Holdout NRMSE: {report.attrs['HoldoutNRMSE']:.4f}")
+
+
+    df_filled.to_csv(output_csv_path, index=False)
+    report.to_csv(report_csv_path, index=False)
+    print(f"Filled CSV saved to: {output_csv_path}")
+    print(f"Report saved to: {report_csv_path}")
@@ -0,0 +1,158 @@
+## Mann-Kendall trend test for every station at once
+## S counts the rising minus the falling pairs of a series, here from one inversion count per station (O(n log n),
+## all stations in one batched count, see theilsen.count_inversions) instead of the n(n-1)/2 pair signs
+## the variance is corrected for ties in the values and, for the serial correlation of daily/monthly levels,
+## with Hamed and Rao (1998): the ranks of the series detrended with its Theil-Sen slope, their autocorrelation
+## (by FFT) at the significant lags inflates the variance
+
+# imports
+import numpy as np
+from scipy.special import ndtr, ndtri      # norm.cdf and norm.ppf (scipy.stats alone takes about a second to import)
+from theilsen import count_inversions
+
+
+
+# the valid values of every column of Y (time x stations) one station after the other, with the station number
+# and the time position of each
+def _stacked(Y):
+    valid = np.isfinite(Y).T
+    station, position = np.nonzero(valid)
+    return Y.T[valid], station, position
+
+
+
+# rank of every value within its station (0 based), equal values in time order, plus that sort order
+def _ranks_within(values, station, position):
+    order = np.lexsort((position, values, station))
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(station))])[:-1] if len(station) else np.zeros(0, np.int64)
+    rank = np.empty(len(values), dtype=np.int64)
+    rank[order] = np.arange(len(values))
+    return rank - offsets[station], order
+
+
+
+# S, its variance with the tie correction and the number of values of every station
+def mann_kendall_s(Y):
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    n_stations = Y.shape[1]
+
+    values, station, position = _stacked(Y)
+    n = np.bincount(station, minlength=n_stations).astype(np.int64)
+    if len(values) == 0:
+        return np.zeros(n_stations, dtype=np.int64), np.zeros(n_stations), n
+
+    local_rank, order = _ranks_within(values, station, position)
+    offsets = np.concatenate([[0], np.cumsum(n)])[:-1]
+
+    # falling pairs: a later value strictly below an earlier one (equal values are ranked in time order)
+    falling = np.zeros(n_stations, dtype=np.int64)
+    counted = count_inversions(local_rank + offsets[station], groups=station)
+    falling[:len(counted)] = counted
+
+    # runs of equal values within a station
+    sorted_values = values[order]
+    sorted_station = station[order]
+    new_run = np.ones(len(values), dtype=bool)
+    new_run[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_station[1:] != sorted_station[:-1])
+    run_start = np.flatnonzero(new_run)
+    t = np.diff(np.concatenate([run_start, [len(values)]])).astype(float)
+    run_station = sorted_station[run_start]
+    tied_pairs = np.bincount(run_station, weights=t * (t - 1) / 2, minlength=n_stations)
+    tie_term = np.bincount(run_station, weights=t * (t - 1) * (2 * t + 5), minlength=n_stations)
+
+    pairs = n * (n - 1) // 2
+    rising = pairs - falling - np.rint(tied_pairs).astype(np.int64)
+    s = rising - falling
+
+    nf = n.astype(float)
+    var_s = (nf * (nf - 1) * (2 * nf + 5) - tie_term) / 18
+    return s, var_s, n
+
+
+
+# autocorrelation of every row of R (stations x time, zero padded after n[i] values) up to each row's length,
+# by FFT, like statsmodels acf (the mean removed, sums over the overlap divided by the lag 0 sum)
+def _acf_rows(R, n):
+    from scipy import fft as sp_fft
+    n_max = R.shape[1]
+    mask = np.arange(n_max)[None, :] < n[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(mask, R, 0.0).sum(axis=1) / n
+    centred = np.where(mask, R - mean[:, None], 0.0)
+
+    n_fft = sp_fft.next_fast_len(2 * n_max - 1, real=True)
+    f = sp_fft.rfft(centred, n_fft, axis=1)
+    acov = sp_fft.irfft(f * np.conj(f), n_fft, axis=1)[:, :n_max]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return acov / acov[:, :1]
+
+
+
+# the Hamed and Rao variance factor n/n* of every station: the ranks of the detrended series (values - slope * x),
+# their autocorrelation at the lags where it is significant (alpha), summed with the weights of eq. 21
+# max_lag: only the first max_lag lags (None = all, as in the paper)
+def hamed_rao_factor(Y, x, slopes, alpha=0.05, max_lag=None, chunk_size=64):
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    x = np.asarray(x, dtype=float)
+    slopes = np.asarray(slopes, dtype=float)
+    n_stations = Y.shape[1]
+
+    detrended = Y - np.where(np.isfinite(slopes), slopes, 0.0)[None, :] * x[:, None]
+    values, station, position = _stacked(detrended)
+    n_all = np.bincount(station, minlength=n_stations)
+    local_rank, _ = _ranks_within(values, station, position)
+    offsets = np.concatenate([[0], np.cumsum(n_all)])[:-1]
+    within = np.arange(len(values)) - offsets[station]
+
+    z = ndtri(1 - alpha / 2)
+    factor = np.full(n_stations, np.nan)
+
+    for start in range(0, n_stations, chunk_size):
+        stop = min(start + chunk_size, n_stations)
+        n = n_all[start:stop]
+        if n.max(initial=0) < 3:
+            continue
+
+        n_lags = n.max() if max_lag is None else min(n.max(), max_lag + 1)
+        pick = (station >= start) & (station < stop)
+        R = np.zeros((stop - start, n.max()))
+        R[station[pick] - start, within[pick]] = local_rank[pick] + 1
+        acf = _acf_rows(R, n)[:, 1:n_lags]
+
+        k = np.arange(1, n_lags)[None, :]
+        nn = n[:, None].astype(float)
+        weights = (nn - k) * (nn - k - 1) * (nn - k - 2)
+        # a station without values (n = 0) in the chunk divides by zero here, its factor is NaN below anyway
+        with np.errstate(invalid='ignore', divide='ignore'):
+            significant = (np.abs(acf) > z / np.sqrt(nn)) & (k < nn)
+            total = np.where(significant, weights * acf, 0.0).sum(axis=1)
+            factor[start:stop] = np.where(n >= 3, 1 + 2 * total / (n * (n - 1.0) * (n - 2.0)), np.nan)
+
+    return factor
+
+
+
+# the Mann-Kendall test of every column of Y (time x stations): S, the (corrected) variance, Z and the two sided p
+# x, slopes: the time axis and the Theil-Sen slopes for the Hamed and Rao correction (None = no correction)
+# a correction factor that is not positive (strong negative autocorrelation) leaves the variance uncorrected
+def mann_kendall(Y, x=None, slopes=None, alpha=0.05, max_lag=None):
+    s, var_s, n = mann_kendall_s(Y)
+
+    if x is not None and slopes is not None:
+        factor = hamed_rao_factor(Y, x, slopes, alpha=alpha, max_lag=max_lag)
+        factor = np.where(np.isfinite(factor) & (factor > 0), factor, 1.0)
+    else:
+        factor = np.ones(len(s))
+    var_corrected = var_s * factor
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = np.sqrt(var_corrected)
+        z = np.where(s > 0, (s - 1) / sd, np.where(s < 0, (s + 1) / sd, 0.0))
+    z[(n < 3) | ~(var_corrected > 0)] = np.nan
+    p = 2 * ndtr(-np.abs(z))
+
+    return {'S': s, 'VarS': var_corrected, 'Z': z, 'p': p, 'n': n, 'Correction': factor}
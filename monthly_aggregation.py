@@ -0,0 +1,115 @@
+## Monthly series of every station straight from the merged daily matrix (the CSV of merge_surface_water_data)
+## so the monthly scripts don't depend on the separately produced *_monthly.csv files: mean (SWLavg), min, max and
+## the number of days with data of every month, all stations in one reduce over the month blocks of the matrix,
+## and cached by the daily CSV it came from
+
+# imports
+import numpy as np
+import pandas as pd
+from calendar_grid import monthly_grid
+from result_cache import content_hash
+from stage_trace import stage
+from station_store import STORE_META_COLUMNS, open_station_store, source_fingerprint, station_matrix
+
+
+
+# a month with fewer days of data than this gets no mean/min/max (NaN), its ValidDays are still kept
+MIN_VALID_DAYS = 20
+
+
+
+# values: days x stations (NaN = no data), dates: the day of every row
+# returns a dict of months x stations arrays on the monthly 1985-2018 calendar (calendar_grid.monthly_grid):
+#   'SWLavg', 'SWLmin', 'SWLmax' : mean, lowest and highest level of the month (NaN below min_valid_days)
+#   'ValidDays'                  : days with data in the month
+# plus 'station_ids' and the 'grid'; days outside the calendar are left out
+def monthly_aggregate(values, dates, station_ids, min_valid_days=MIN_VALID_DAYS, grid=None):
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    grid = monthly_grid() if grid is None else grid
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+
+    # the calendar row of every day's month
+    first = grid.dates[0]
+    month_position = (dates.year.to_numpy() - first.year) * 12 + dates.month.to_numpy() - first.month
+    keep = (month_position >= 0) & (month_position < len(grid))
+    month_position = month_position[keep]
+    values = values[keep]
+
+    # days grouped by month (a no-op for the merged matrix, it is in time order already), one block per month
+    order = np.argsort(month_position, kind='stable')
+    month_position = month_position[order]
+    values = values[order]
+    start = np.flatnonzero(np.r_[True, month_position[1:] != month_position[:-1]]) if len(order) else np.zeros(0, int)
+    rows = month_position[start]
+
+    n_months, n_stations = len(grid), values.shape[1]
+    out = {name: np.full((n_months, n_stations), np.nan) for name in ('SWLavg', 'SWLmin', 'SWLmax')}
+    out['ValidDays'] = np.zeros((n_months, n_stations), dtype=np.int64)
+
+    if len(start):
+        valid = np.isfinite(values)
+        valid_days = np.add.reduceat(valid, start, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = np.add.reduceat(np.where(valid, values, 0.0), start, axis=0)
+            lowest = np.fmin.reduceat(values, start, axis=0)
+            highest = np.fmax.reduceat(values, start, axis=0)
+            mean = total / valid_days
+
+        enough = valid_days >= max(min_valid_days, 1)
+        out['SWLavg'][rows] = np.where(enough, mean, np.nan)
+        out['SWLmin'][rows] = np.where(enough, lowest, np.nan)
+        out['SWLmax'][rows] = np.where(enough, highest, np.nan)
+        out['ValidDays'][rows] = valid_days
+
+    out['station_ids'] = list(station_ids)
+    out['grid'] = grid
+    return out
+
+
+
+# the monthly aggregate of a merged daily CSV, read (or opened from its station store, see station_store.py) and
+# aggregated only when the CSV or min_valid_days changed since the cached one
+# cache: a result_cache.ResultCache (None = aggregate every time)
+def monthly_from_daily(csv_path, cache=None, min_valid_days=MIN_VALID_DAYS, store_dir=None):
+    if cache is not None:
+        key = content_hash('monthly_aggregate', source_fingerprint(csv_path), min_valid_days)
+        cached = cache.get('monthly_matrix', key)
+        if cached is not None:
+            return cached
+
+    with stage('read_daily'):
+        source = open_station_store(csv_path, store_dir) if store_dir else pd.read_csv(csv_path)
+    station_ids = [col for col in source.columns if col not in STORE_META_COLUMNS]
+
+    with stage('monthly_aggregate', stations=len(station_ids)):
+        monthly = monthly_aggregate(station_matrix(source, station_ids), source['Date'], station_ids,
+                                    min_valid_days=min_valid_days)
+
+    if cache is not None:
+        cache.put('monthly_matrix', key, monthly)
+    return monthly
+
+
+
+# every station of a monthly aggregate as the frame complete_date_range gives for a monthly file
+# (DateTMS, Year, Month, Day, SWLavg, DecYear, indexed by DateTMS) plus SWLmin, SWLmax and ValidDays,
+# by station id, so the monthly pages (tmplt) can draw from it as they draw from the files
+def monthly_station_frames(monthly, station_ids=None):
+    station_ids = monthly['station_ids'] if station_ids is None else list(station_ids)
+    columns = {station_id: j for j, station_id in enumerate(monthly['station_ids'])}
+    calendar = monthly['grid'].frame()
+
+    station_frames = {}
+    for station_id in station_ids:
+        j = columns[station_id]
+        df = calendar.copy()
+        df.insert(4, 'SWLavg', monthly['SWLavg'][:, j])
+        df['SWLmin'] = monthly['SWLmin'][:, j]
+        df['SWLmax'] = monthly['SWLmax'][:, j]
+        df['ValidDays'] = monthly['ValidDays'][:, j]
+        df.index = df['DateTMS']
+        station_frames[station_id] = df
+
+    return station_frames
@@ -0,0 +1,59 @@
+## Running the per-station pages of the drivers on a process pool
+
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+
+
+# data every page needs (station matrix, danger levels...), set once per worker
+_shared = None
+
+
+def _init_worker(shared):
+    global _shared
+
+    # workers only write into the PDF, they never need a window
+    import matplotlib
+    matplotlib.use('Agg')
+
+    _shared = shared
+
+
+# the output is pickled here, then the worker's pyplot figures are closed: once pickled the page's figure is only
+# needed in the parent, left open every page would stay in the worker's memory
+def _call_page(page_func, page):
+    out = pickle.dumps(page_func(page, _shared), protocol=pickle.HIGHEST_PROTOCOL)
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+    return out
+
+
+
+# splitting the stations into pages of four (same layout as the drivers)
+def paginate(items, per_page=4):
+    return [items[j:j + per_page] for j in range(0, len(items), per_page)]
+
+
+
+# run page_func(page, shared) for every page and yield the outputs in the original page order,
+# so the PDF pages and the summary rows come out exactly as in a single process run
+# n_workers <= 1 runs everything in this process, n_workers=None uses all the cores
+def run_pages(page_func, pages, n_workers=1, shared=None):
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    if n_workers <= 1 or len(pages) <= 1:
+        for page in pages:
+            yield page_func(page, shared)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(pages)),
+                             initializer=_init_worker, initargs=(shared,)) as executor:
+
+        # map keeps the submission order no matter which worker finishes first
+        for out in executor.map(partial(_call_page, page_func), pages):
+            yield pickle.loads(out)
@@ -0,0 +1,57 @@
+## Quality screening of the whole monthly station matrix in one call
+## the same three criteria as bangla.fails_quality_check, run-length encoded with numpy instead of a groupby
+
+# imports
+import numpy as np
+import pandas as pd
+from exceedance import run_lengths
+
+
+
+# reasons a station is skipped, in the order the criteria are checked
+REASON_TOO_FEW = 'Covering too few years'
+REASON_LONG_GAP = 'Long continuous gap'
+REASON_MULTIPLE_GAPS = 'Multiple long gaps'
+
+
+
+# values: months x stations (NaN = missing month), e.g. the SWLavg of complete_date_range for every station
+#   1. fewer than min_valid_months months with data (204 = 17 of the 34 years)
+#   2. a gap of long_gap_months or more (60 = 5 years)
+#   3. more than max_multiple_gaps gaps of multiple_gap_months or more (24 = 2 years)
+# returns one row per station: ValidMonths, Coverage (%), LongestGap, NumLongGaps (>= multiple_gap_months),
+# Passed and the Reason it failed ('' when it passed)
+def quality_table(values, station_ids, min_valid_months=204, long_gap_months=60, multiple_gap_months=24,
+                  max_multiple_gaps=1):
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    n_months, n_stations = values.shape
+
+    missing = np.isnan(values)
+    valid_months = n_months - missing.sum(axis=0)
+
+    # every run of missing months
+    station, start, end = run_lengths(missing)
+    gap_length = end - start
+
+    longest_gap = np.zeros(n_stations, dtype=np.int64)
+    np.maximum.at(longest_gap, station, gap_length)
+    num_gaps = np.bincount(station[gap_length >= multiple_gap_months], minlength=n_stations)
+
+    too_few = valid_months < min_valid_months
+    long_gap = longest_gap >= long_gap_months
+    multiple_gaps = num_gaps > max_multiple_gaps
+
+    reason = np.where(too_few, REASON_TOO_FEW,
+             np.where(long_gap, REASON_LONG_GAP,
+             np.where(multiple_gaps, REASON_MULTIPLE_GAPS, '')))
+
+    return pd.DataFrame({
+        'StationID': list(station_ids),
+        'ValidMonths': valid_months,
+        'Coverage': np.round(valid_months / n_months * 100, 2),
+        'LongestGap': longest_gap,
+        'NumLongGaps': num_gaps,
+        'Passed': reason == '',
+        'Reason': reason})
@@ -0,0 +1,188 @@
+## Rainfall to water level correlation: the nearest rain gauges of every surface water station and the
+## lagged cross-correlation of each pair, all pairs and all lags at once with FFTs
+
+# imports
+import numpy as np
+import pandas as pd
+
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+
+# great circle distance in km between points given in degrees
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+
+# points on the unit sphere, the straight line (chord) between two of them grows with their great circle distance,
+# so the nearest points by chord in a KD tree are the nearest by haversine distance
+def _unit_vectors(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+
+# spatial index over the rain gauges (or any set of stations with coordinates)
+class GaugeIndex:
+
+    def __init__(self, station_ids, lat, lon):
+        from scipy.spatial import cKDTree
+
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        located = np.isfinite(lat) & np.isfinite(lon)
+
+        self.station_ids = np.asarray(station_ids, dtype=object)[located]
+        self.positions = np.flatnonzero(located)
+        self.lat = lat[located]
+        self.lon = lon[located]
+        self.tree = cKDTree(_unit_vectors(self.lat, self.lon))
+
+
+    # the k nearest gauges of every query point: (points x k) gauge positions (in the original order, -1 = none)
+    # and distances in km (inf = none); gauges further than max_km are left out
+    def nearest(self, lat, lon, k=3, max_km=None):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        located = np.isfinite(lat) & np.isfinite(lon)
+
+        k = min(k, len(self.station_ids))
+        gauges = np.full((len(lat), k), -1, dtype=np.int64)
+        distance = np.full((len(lat), k), np.inf)
+        if k == 0 or not located.any():
+            return gauges, distance
+
+        chord_limit = np.inf if max_km is None else 2 * np.sin(min(max_km / EARTH_RADIUS_KM, np.pi) / 2)
+        chord, found = self.tree.query(_unit_vectors(lat[located], lon[located]), k=k,
+                                       distance_upper_bound=chord_limit)
+        chord = chord.reshape(-1, k)
+        found = found.reshape(-1, k)
+
+        hit = np.isfinite(chord)
+        rows = np.flatnonzero(located)
+        gauges[rows] = np.where(hit, self.positions[np.minimum(found, len(self.positions) - 1)], -1)
+        distance[rows] = np.where(hit, 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0.0, 1.0)), np.inf)
+        return gauges, distance
+
+
+
+# pearson correlation of x[t] with y[t + lag] for every column pair (x[:, j], y[:, j]) and every lag,
+# NaN cells are left out (each lag only uses the time steps both series have)
+# x, y: time x pairs; returns (pairs x lags) correlations and common time step counts
+def lagged_correlation(x, y, lags):
+    from scipy import fft as sp_fft
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x.ndim == 1:
+        x, y = x[:, None], y[:, None]
+    lags = np.asarray(lags, dtype=np.int64)
+    n_steps = x.shape[0]
+
+    mx = np.isfinite(x)
+    my = np.isfinite(y)
+    # centred first, so the sums of squares don't lose precision
+    with np.errstate(invalid='ignore'):
+        x = np.where(mx, x - np.nanmean(np.where(mx, x, np.nan), axis=0), 0.0)
+        y = np.where(my, y - np.nanmean(np.where(my, y, np.nan), axis=0), 0.0)
+    mx = mx.astype(float)
+    my = my.astype(float)
+
+    n_fft = sp_fft.next_fast_len(2 * n_steps - 1, real=True)
+
+    def _fft(a):
+        return sp_fft.rfft(a, n_fft, axis=0)
+
+    # cross-correlation sum_t a[t] * b[t + lag], lag l sits at position l mod n_fft of the inverse transform
+    rows = np.mod(lags, n_fft)
+
+    def _xcorr(a_fft, b_fft):
+        return sp_fft.irfft(np.conj(a_fft) * b_fft, n_fft, axis=0)[rows].T
+
+    fx, fy, fmx, fmy = _fft(x), _fft(y), _fft(mx), _fft(my)
+    count = np.rint(_xcorr(fmx, fmy))
+    sum_x = _xcorr(fx, fmy)
+    sum_y = _xcorr(fmx, fy)
+    sum_xx = _xcorr(_fft(x * x), fmy)
+    sum_yy = _xcorr(fmx, _fft(y * y))
+    sum_xy = _xcorr(fx, fy)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = sum_xy - sum_x * sum_y / count
+        var_x = sum_xx - sum_x ** 2 / count
+        var_y = sum_yy - sum_y ** 2 / count
+        corr = cov / np.sqrt(var_x * var_y)
+
+    outside = (count < 3) | (np.abs(lags)[None, :] >= n_steps) | (var_x <= 0) | (var_y <= 0)
+    corr[outside] = np.nan
+    return np.clip(corr, -1.0, 1.0), count.astype(np.int64)
+
+
+
+# every surface water station paired with its k nearest rain gauges and their lagged correlation
+# water_level / rainfall: time x stations frames on the same calendar (columns = station ids)
+# sw_coords / gauge_coords: frames with the station id column, Latitude and Longitude
+# lags in time steps of the calendar (positive = the water level follows the rain)
+# returns one row per pair (distance, best lag and its correlation) and the full (pairs x lags) correlations
+def rain_level_correlation(water_level, rainfall, sw_coords, gauge_coords, lags=range(0, 13), k=3, max_km=None,
+                           sw_id='StationID', gauge_id='Station', lat='Latitude', lon='Longitude', min_overlap=24):
+    lags = np.asarray(list(lags), dtype=np.int64)
+
+    gauge_coords = gauge_coords.drop_duplicates(subset=gauge_id)
+    gauge_coords = gauge_coords[gauge_coords[gauge_id].isin(rainfall.columns)]
+    sw_coords = sw_coords.drop_duplicates(subset=sw_id).set_index(sw_id).reindex(list(water_level.columns))
+
+    index = GaugeIndex(gauge_coords[gauge_id], gauge_coords[lat], gauge_coords[lon])
+    gauges, distance = index.nearest(sw_coords[lat], sw_coords[lon], k=k, max_km=max_km)
+
+    sw_pos, rank = np.nonzero(gauges >= 0)
+    gauge_names = gauge_coords[gauge_id].to_numpy(dtype=object)[gauges[sw_pos, rank]]
+    sw_names = np.asarray(water_level.columns, dtype=object)[sw_pos]
+
+
+    # the pairs as columns of two matrices, one FFT pass for all of them
+    x = rainfall[list(gauge_names)].to_numpy(dtype=float)
+    y = water_level[list(sw_names)].to_numpy(dtype=float)
+    corr, count = lagged_correlation(x, y, lags)
+
+    corr_usable = np.where(count >= min_overlap, corr, np.nan)
+    has_value = np.isfinite(corr_usable).any(axis=1)
+    best = np.argmax(np.where(np.isfinite(corr_usable), corr_usable, -np.inf), axis=1)
+    rows = np.arange(len(best))
+
+    pairs = pd.DataFrame({
+        'StationID': sw_names,
+        'RainStation': gauge_names,
+        'Rank': rank + 1,
+        'DistanceKm': distance[sw_pos, rank],
+        'BestLag': np.where(has_value, lags[best], -1),
+        'BestCorr': np.where(has_value, corr_usable[rows, best], np.nan),
+        'Overlap': np.where(has_value, count[rows, best], 0),
+        'ZeroLagCorr': corr_usable[:, lags == 0][:, 0] if (lags == 0).any() else np.nan})
+
+    correlations = pd.DataFrame(corr, columns=pd.Index(lags, name='Lag'),
+                                index=pd.MultiIndex.from_arrays([sw_names, gauge_names],
+                                                                names=['StationID', 'RainStation']))
+    return pairs, correlations
+
+
+
+# long rows (station, year, month, value) as a months x stations matrix on the monthly calendar
+# (the BMD rainfall layout); rows off the calendar are dropped, for a repeated month the first row is kept
+def monthly_station_matrix(rows, grid, station_col='Station', value_col='Rainfall'):
+    month_end = pd.to_datetime(pd.DataFrame({'year': rows['Year'], 'month': rows['Month'], 'day': 1})) \
+                + pd.offsets.MonthEnd(0)
+    stations = rows[station_col].astype(str).str.strip()
+
+    columns = {}
+    positions = grid.positions(month_end)
+    for station_name, idx in stations.groupby(stations).indices.items():
+        columns[station_name] = grid.align(None, rows[value_col].to_numpy(dtype=float)[idx], positions[idx])
+
+    return pd.DataFrame(columns, index=grid.dates)
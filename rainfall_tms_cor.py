@@ -2,38 +2,113 @@
 
 # imports
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-import seaborn as sns
-import statistics
-from scipy.stats import linregress
-from matplotlib.backends.backend_pdf import PdfPages
 import glob
 import os
-import shutil
 from datetime import datetime
+from calendar_grid import daily_grid, monthly_grid
+from rain_correlation import rain_level_correlation, monthly_station_matrix
+from station_catalog import StationCatalog, station_id_from_path, link_files
+from stage_trace import stage
+from station_io import read_daily_station, read_stations, READ_THREADS
+
+
+
+# the BMD rainfall rows of start_year-end_year joined with the gauge coordinates, read and written in one streaming pass
+# the source is read chunksize rows at a time (only usecols, with the given dtypes), each chunk is filtered on
+# Year and joined with the coordinates before it is appended to output_path, so memory stays at about one chunk
+# output_path ending in .parquet is written with pyarrow (needed only then), anything else as CSV
+# value_col: the rainfall column, read as float32 unless dtypes says otherwise
+def stream_rainfall_with_coords(rainfall_path, coord_path, output_path, start_year=1985, end_year=2018,
+                                usecols=None, dtypes=None, chunksize=200_000, value_col='Rainfall'):
+    if dtypes is None:
+        dtypes = {'Station': str, 'Year': 'Int16', 'Month': 'Int8', value_col: 'float32'}
+
+    rainfall_coord_solo = pd.read_csv(coord_path)
+    rainfall_coord_solo['Station'] = rainfall_coord_solo['Station'].astype(str).str.strip()
+
+    as_parquet = output_path.endswith('.parquet')
+    if as_parquet:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    writer = None
+    schema = None
+    n_rows = 0
+
+    try:
+        for chunk in pd.read_csv(rainfall_path, usecols=usecols, dtype=dtypes, chunksize=chunksize):
+            chunk = chunk[chunk['Year'].between(start_year, end_year).fillna(False).to_numpy(dtype=bool)].copy()
+            if chunk.empty and n_rows > 0:
+                continue
+            chunk['Station'] = chunk['Station'].str.strip()
+
+            chunk = pd.merge(chunk, rainfall_coord_solo, on='Station', how='left')
+
+            if as_parquet:
+                if chunk.empty:
+                    continue
+                if writer is None:
+                    # a column that is all empty in the first chunk is kept as text
+                    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                    schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                        for field in schema], metadata=schema.metadata)
+                    writer = pq.ParquetWriter(output_path, schema)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            else:
+                chunk.to_csv(output_path, mode='w' if n_rows == 0 else 'a', header=n_rows == 0, index=False)
+            n_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n_rows
 
 
 
 ##merging and clean the rainfall data to get coord and right time
 def merging_rainfall_withCoord():
-    rainfall_coord_solo = pd.read_csv('/Users/biar/Desktop/rainfallsta_coordinates.csv')
+    rainfall_path = '/Users/biar/Desktop/BMD_monthly_rainfall_all_stations_07Aug24.csv'
+    coord_path = '/Users/biar/Desktop/rainfallsta_coordinates.csv'
+    output_path = '/Users/biar/Desktop/rfdata_rightime_withCoord.parquet'                      ### change the output path when needed 
 
-    rainfall_daata = pd.read_csv('/Users/biar/Desktop/BMD_monthly_rainfall_all_stations_07Aug24.csv')
+    # the rainfall column, and the columns that are used later (rainfall_level_correlation), None reads all of them
+    value_col = 'Rainfall'                                                                       ### change the rainfall column name when needed 
+    usecols = ['Station', 'Year', 'Month', value_col]                                            ### change when needed 
 
-    rainfall_daata['Station'] = rainfall_daata['Station'].str.strip()
-    rainfall_coord_solo['Station'] = rainfall_coord_solo['Station'].str.strip()
+    n_rows = stream_rainfall_with_coords(rainfall_path, coord_path, output_path, 1985, 2018, usecols=usecols,
+                                         value_col=value_col)
+    print(f"{n_rows} rainfall rows (1985-2018) with coordinates saved to: {output_path}")
 
 
-    rainfall_withCoord = pd.merge(rainfall_daata, rainfall_coord_solo, 
-                                on='Station', how='left')
 
-    rainfall_withCoord.to_csv('/Users/biar/Desktop/rainfalldata_withCoord.csv')
+## correlation of the monthly water levels with the rainfall of their nearest BMD gauges, at lags of 0-12 months
+def rainfall_level_correlation():
+    from bangla import load_monthly_stations
 
-    rainfall_withCoord = pd.read_csv('/Users/biar/Desktop/rainfalldata_withCoord.csv')
+    folder_path_monthly = '/Users/biar/Desktop/cleaned_BWDB_tidal_data_1985_2018'             ### change the path name when needed 
+    csv_files_monthly = glob.glob(f'{folder_path_monthly}/*.csv')
+
+    sw_coords = pd.read_csv('/Users/biar/Desktop/BWDB_SWL_station_info.csv')                   # StationID, Latitude, Longitude
+    rainfall_rows = pd.read_parquet('/Users/biar/Desktop/rfdata_rightime_withCoord.parquet')   # from merging_rainfall_withCoord
+
+    rainfall_rows['Station'] = rainfall_rows['Station'].str.strip()
+    gauge_coords = rainfall_rows[['Station', 'Latitude', 'Longitude']].drop_duplicates(subset='Station')
+
+
+    # both on the 1985-2018 monthly calendar
+    station_frames = load_monthly_stations(csv_files_monthly)
+    water_level = pd.DataFrame({station_id_from_path(file_path): df['SWLavg'].to_numpy()
+                                for file_path, df in station_frames.items() if df is not None}, index=monthly_grid().dates)
+    rainfall = monthly_station_matrix(rainfall_rows, monthly_grid(), value_col='Rainfall')           ### change the rainfall column name when needed 
+
+
+    pairs, correlations = rain_level_correlation(water_level, rainfall, sw_coords, gauge_coords,
+                                                 lags=range(0, 13), k=3, max_km=100)                ### change when needed 
+
+    pairs.to_csv('/Users/biar/Desktop/rainfall_water_level_correlation.csv', index=False)
+    correlations.to_csv('/Users/biar/Desktop/rainfall_water_level_correlation_by_lag.csv')
+    print(f"{len(pairs)} station-gauge pairs, median best lag {pairs['BestLag'].median()} months")
 
-    right_time_rainfall = rainfall_withCoord[(rainfall_withCoord['Year']>=1985) & (rainfall_withCoord['Year']<= 2018)]
-    right_time_rainfall.to_csv('/Users/biar/Desktop/rfdata_rightime_withCoord.csv')
 
 
 def checking_dl():
@@ -46,59 +121,79 @@ def checking_dl():
     mismatched.to_csv('/Users/biar/Desktop/mismatched_dl.csv')
 
 
-### getting the daily stations wanted 
+### getting the daily stations wanted (the daily files of the stations that have a cleaned monthly file)
 def matching_daily_wanted():
 
     folder_path_monthly = '/Users/biar/Desktop/cleaned_BWDB_tidal_data_1985_2018'             ### change the path name when needed 
-    csv_files_monthly= glob.glob(f'{folder_path_monthly}/*.csv')
-    monthly_list = []
-
     folder_path_daily= '/Users/biar/Desktop/BWDB_daily_tidal_data'
-    csv_files_daily= glob.glob(f'{folder_path_daily}/*.csv')
-    daily_list = []
 
-    print(f"Found {len(csv_files_monthly)} CSV files to process")
+    # both folders in one catalog, kept next to the daily data and only rebuilt when a file changed
+    catalog = StationCatalog([(folder_path_monthly, 'monthly', 'tidal'), (folder_path_daily, 'daily', 'tidal')],
+                             catalog_path=os.path.join(folder_path_daily, '.station_catalog.json'))
 
-    ## Part 1 of writting selected data files into a new folder  
-    stations_passed = []
+    print(f"Found {len(catalog.files('monthly'))} CSV files to process")
 
+    ## Part 1 of writting selected data files into a new folder  
     destination_folder = '/Users/biar/Desktop/cleaned_daily_BWDB_tidal_data_1985_2018'           ### change the output folder name when needed 
-    os.makedirs(destination_folder, exist_ok=True)
 
+    monthly_stations = set(catalog.station_ids('monthly'))
+    print(len(monthly_stations))
 
-    for monthly_file_path in csv_files_monthly:
-        monthly_file_name = os.path.basename(monthly_file_path)
-        monthly_file_name = os.path.splitext(monthly_file_name)[0]
-        monthly_station_name = monthly_file_name.split('_monthly')[0]
+    stations_passed = catalog.files('daily', [station_id for station_id in catalog.station_ids('daily')
+                                              if station_id in monthly_stations])
+    print(len(stations_passed))
 
-        monthly_list.append(monthly_station_name)
-    
-    print(len(monthly_list))
+    ## Part 2 of writting selected data files into a new folder (hard links, no bytes copied)
+    linked, copied = link_files(stations_passed, destination_folder)
+    print(f"{linked} station files linked, {copied} copied into: {destination_folder}")
 
 
-    for daily_file_path in csv_files_daily:
-        daily_file_name = os.path.basename(daily_file_path)
-        daily_file_name = os.path.splitext(daily_file_name)[0]
-        daily_station_name = daily_file_name.split('_tidal')[0]
 
-        daily_list.append(daily_station_name)
-    
 
-        if daily_station_name in monthly_list:       ### change the location when needed 
-                
-            stations_passed.append(daily_file_path)
 
-    print(len(stations_passed))
-    ## Part 2 of writting selected data files into a new folder 
-    for stations_path in stations_passed:
-        if os.path.isfile(stations_path):  
-            shutil.copy(stations_path, destination_folder)
-        else:
-            print(f"File not found: {stations_path}")
+# one daily station file -> station name and its water level series (indexed by date, 1985-2018)
+# (typed, only the Date and water level columns, see station_io.py)
+def read_station_series(file_path):
+    return read_daily_station(file_path, start='1985-01-01', end='2018-12-31')
 
 
 
-def merge_surface_water_data(folder_path_tidal, folder_path_nontidal,output_file):
+# the daily calendar the merged matrix is built on
+def daily_master_frame(start='1985-01-01', end='2018-12-31'):
+    grid = daily_grid(start, end)
+
+    return pd.DataFrame({
+        'Date': grid.dates,
+        'Year': grid.year,
+        'Month': grid.month,
+        'Day': grid.day
+    })
+
+
+
+# all the stations scattered onto the daily calendar by position and put together once (no merge per station)
+def build_station_matrix(all_stations_data, start='1985-01-01', end='2018-12-31'):
+
+    grid = daily_grid(start, end)
+    master_df = daily_master_frame(start, end)
+
+    # Reorder columns to match your desired format: Date, Year, Month, Day, SW1, SW2, etc.
+    station_columns = sorted(name for name in all_stations_data if name.startswith('SW'))
+
+    aligned = {name: grid.align(all_stations_data[name].index, all_stations_data[name].to_numpy()) for name in station_columns}
+    station_df = pd.DataFrame(aligned, index=master_df.index, columns=station_columns)
+
+    master_df = pd.concat([master_df, station_df], axis=1)
+
+    for station_name in station_columns:
+        print(f"Added {station_name} - Data points: {master_df[station_name].notna().sum()}")
+
+    return master_df
+
+
+
+# n_threads: station files read at the same time (see station_io.read_stations)
+def merge_surface_water_data(folder_path_tidal, folder_path_nontidal,output_file, n_threads=READ_THREADS):
 
     # Get all CSV files in the folder
     csv_files_tidal = glob.glob(f'{folder_path_tidal}/*.csv')
@@ -109,69 +204,30 @@ def merge_surface_water_data(folder_path_tidal, folder_path_nontidal,output_file
     csv_files = csv_files_tidal+csv_files_nontidal
     print(f"Total files to process: {len(csv_files)}")
 
-    date_range = pd.date_range(start='1985-01-01', end='2018-12-31', freq='D')
-    
-    # Initialize the master dataframe with date components
-    master_df = pd.DataFrame({
-        'Date': date_range,
-        'Year': date_range.year,
-        'Month': date_range.month,
-        'Day': date_range.day
-    })
-    
     all_stations_data = {}
-    
-    # Process each CSV file
-    for file_path in csv_files:
-            # Extract station name from filename
-            file_name = os.path.basename(file_path)
-            station_name = file_name.split('_')[0]  
-            
+
+    # all the files read on a thread pool, in their order
+    with stage('read_stations', files=len(csv_files)):
+        stations = read_stations(csv_files, read_station_series, n_threads=n_threads)
+
+    # Process each CSV file (a later file with the same station name replaces the earlier one)
+    for station_name, station_data in stations:
             print(f"Processing {station_name}...")
-            
-            # Read the CSV file
-            df = pd.read_csv(file_path)
-            
-            df = df[(df['Date'] >= '1985-01-01') & (df['Date'] <= '2018-12-31')]
-            
-            water_level_col = None
-            if 'SWLmpwd' in df.columns:
-                water_level_col = 'SWLmpwd'
-            if 'SWLmin' in df.columns:
-                water_level_col = 'SWLmin'
- 
-            
-            # Keep only Date and water level columns
-            station_data = df[['Date',water_level_col]].copy()
-            station_data = station_data.rename(columns={water_level_col: station_name})
-            
+
             # Store in dictionary
             all_stations_data[station_name] = station_data
             
        
-    # Merge all station data with master dataframe
+    # Align all station data onto the daily calendar in one step
     print("Merging all station data...")
-
-
-    for station_name, station_data in all_stations_data.items():
-        station_data['Date'] = pd.to_datetime(station_data['Date'])
-        station_data = station_data.drop_duplicates(subset='Date', keep='first')
-
-        master_df = master_df.merge(station_data, on='Date', how='left')
-        print(f"Added {station_name} - Data points: {station_data[station_name].notna().sum()}")
-    
-    # Reorder columns to match your desired format: Date, Year, Month, Day, SW1, SW2, etc.
+    with stage('build_matrix', stations=len(all_stations_data)):
+        master_df = build_station_matrix(all_stations_data)
     station_columns = [col for col in master_df.columns if col.startswith('SW')]
-    station_columns.sort()  # Sort station names
-    
-    final_columns = ['Date', 'Year', 'Month', 'Day'] + station_columns
-    master_df = master_df[final_columns]
-
-    master_df = master_df.drop_duplicates(subset='Date', keep='first')
 
     
     # Save to CSV
-    master_df.to_csv(output_file, index=False)
+    with stage('write_csv'):
+        master_df.to_csv(output_file, index=False)
     
     # Print summary statistics
     print(f"Output saved to: {output_file}")
@@ -191,6 +247,38 @@ def merge_surface_water_data(folder_path_tidal, folder_path_nontidal,output_file
            # merged_data = merge_surface_water_data(folder_path_tidal, folder_path_nontidal,output_file)
 
 
+
+
+
+# add or replace one station's column in an already merged matrix (e.g. after a corrected BWDB file)
+# master_df can be the merged frame or the path of the merged CSV; the result is written to output_file if given
+def update_station_in_matrix(master_df, file_path, output_file=None):
+
+    if isinstance(master_df, (str, os.PathLike)):
+        master_df = pd.read_csv(master_df)
+
+    station_name, station_data = read_station_series(file_path)
+
+    dates = pd.DatetimeIndex(pd.to_datetime(master_df['Date']))
+    replaced = station_name in master_df.columns
+    master_df[station_name] = station_data.reindex(dates).to_numpy(dtype=float)
+
+    # a new station goes in its sorted place among the station columns
+    if not replaced:
+        meta_columns = [col for col in master_df.columns if not col.startswith('SW')]
+        station_columns = sorted(col for col in master_df.columns if col.startswith('SW'))
+        master_df = master_df[meta_columns + station_columns]
+
+    print(f"{'Replaced' if replaced else 'Added'} {station_name} - Data points: {master_df[station_name].notna().sum()}")
+
+    if output_file is not None:
+        master_df.to_csv(output_file, index=False)
+        print(f"Output saved to: {output_file}")
+
+    return master_df
+
+
+
 def adding_coordinates():
     # Load your station metadata file
     results_df = pd.read_csv('/Users/biar/Desktop/all_station_summary_result.csv')
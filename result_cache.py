@@ -0,0 +1,196 @@
+## On-disk cache of per-station results and rendered pages, keyed by a hash of their inputs
+## a station (or page) is only recomputed when its series, danger level row or the analysis parameters change
+
+# imports
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+from parallel_run import run_pages
+
+
+
+# bump when the analysis code changes in a way that makes the old cache entries wrong
+CACHE_VERSION = 1
+
+
+
+def _feed(h, part):
+    if part is None:
+        h.update(b'None')
+    elif isinstance(part, bytes):
+        h.update(part)
+    elif isinstance(part, str):
+        h.update(part.encode())
+    elif isinstance(part, pd.DataFrame):
+        h.update(b'DataFrame')
+        _feed(h, part.index)
+        for name in part.columns:
+            _feed(h, str(name))
+            _feed(h, part[name].to_numpy())
+    elif isinstance(part, (pd.Series, pd.Index)):
+        h.update(type(part).__name__.encode())
+        _feed(h, str(part.name))
+        if isinstance(part, pd.Series):
+            _feed(h, part.index)
+        _feed(h, part.to_numpy())
+    elif isinstance(part, np.ndarray):
+        if part.dtype == object:
+            h.update(json.dumps(part.tolist(), default=str).encode())
+        else:
+            h.update(str(part.dtype).encode() + str(part.shape).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(part, (list, tuple)):
+        h.update(f'{type(part).__name__}{len(part)}'.encode())
+        for item in part:
+            _feed(h, item)
+    else:
+        # dicts of parameters, numbers...
+        h.update(json.dumps(part, sort_keys=True, default=str).encode())
+    h.update(b'|')
+
+
+
+# sha256 of any mix of arrays, pandas objects, parameter dicts, strings and numbers
+def content_hash(*parts):
+    h = hashlib.sha256()
+    _feed(h, CACHE_VERSION)
+    for part in parts:
+        _feed(h, part)
+    return h.hexdigest()
+
+
+
+# a directory of pickled entries named <label>__<hash>.pkl, where label is the station id
+# (or the station ids of a page joined with '+'); the least recently used entries are removed
+# once the directory grows over max_bytes
+# the size of the directory is scanned once and then kept as a running total of this process' writes, the
+# directory is only scanned again when that total goes over max_bytes (entries written by other processes
+# show up at that scan)
+class ResultCache:
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = None             # not scanned yet
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def _path(self, label, key):
+        safe_label = ''.join(c if c.isalnum() or c in '.+-_' else '_' for c in str(label))
+        return os.path.join(self.cache_dir, f'{safe_label}__{key}.pkl')
+
+
+    def get(self, label, key):
+        path = self._path(label, key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+        # a hit counts as a use for the eviction order
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+
+    def put(self, label, key, value):
+        # written to a temporary file first, so a reader (or another worker) never sees half an entry
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for _, size, _, _ in self.entries())
+
+        path = self._path(label, key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        try:
+            self.total_bytes -= os.stat(path).st_size       # an entry written again replaces the old one
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+
+        self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+
+    def entries(self):
+        found = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                label = entry.name.rsplit('__', 1)[0]
+                found.append((stat.st_mtime, stat.st_size, label, entry.path))
+        return found
+
+
+    # drop the least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        found = sorted(self.entries())
+        total = sum(size for _, size, _, _ in found)
+        for _, size, _, path in found:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+
+    # remove every entry of one station (its own results and the pages it is drawn on), or everything
+    def invalidate(self, station_name=None):
+        removed = 0
+        for _, _, label, path in self.entries():
+            if station_name is None or station_name in label.split('+'):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        self.total_bytes = None
+        return removed
+
+
+    def clear(self):
+        return self.invalidate()
+
+
+
+# like parallel_run.run_pages, but pages whose key is in the cache are not recomputed
+# page_key(page, shared) -> (label, key); cache=None simply runs every page
+def run_pages_cached(page_func, pages, cache, page_key, n_workers=1, shared=None):
+
+    if cache is None:
+        yield from run_pages(page_func, pages, n_workers=n_workers, shared=shared)
+        return
+
+    keys = [page_key(page, shared) for page in pages]
+    hits = {}
+    for i, (label, key) in enumerate(keys):
+        value = cache.get(label, key)
+        if value is not None:
+            hits[i] = value
+
+    missing = [i for i in range(len(pages)) if i not in hits]
+    print(f"Cache: {len(hits)} of {len(pages)} pages reused, {len(missing)} to compute")
+    fresh = run_pages(page_func, [pages[i] for i in missing], n_workers=n_workers, shared=shared)
+
+    for i in range(len(pages)):
+        if i in hits:
+            yield hits[i]
+        else:
+            value = next(fresh)
+            cache.put(*keys[i], value)
+            yield value
@@ -0,0 +1,139 @@
+## Moving window trends of the whole station matrix (when did a station's decline speed up?)
+## the OLS slope of every station over every window (e.g. each 10 year window, one year apart) from cumulative sums:
+## the running sums of n, x, x^2, y and x*y over the valid days give the sums of any window as a difference of two
+## rows, so a window costs the same whatever its length and all windows of all stations come out of one pass
+
+# imports
+import numpy as np
+import pandas as pd
+from stage_trace import stage
+from station_store import station_matrix
+
+
+
+# the windows [start, start + window_years) of whole calendar years that fit in x (decimal years),
+# one every step_years, with the row range of each (x sorted ascending)
+def year_windows(x, window_years=10, step_years=1):
+    x = np.asarray(x, dtype=float)
+    first_year = int(np.floor(np.nanmin(x)))
+    last_year = int(np.floor(np.nanmax(x)))
+
+    starts = np.arange(first_year, last_year - window_years + 2, step_years)
+    begin = np.searchsorted(x, starts, side='left')
+    end = np.searchsorted(x, starts + window_years, side='left')
+    labels = [f"{start}-{start + window_years - 1}" for start in starts]
+    return labels, begin, end
+
+
+
+# slopes and intercepts of the columns of Y (time x stations) against x over the row ranges begin[k]:end[k]
+# a window needs at least min_coverage of its days (and 2 of them) valid, otherwise NaN
+# stations are done chunk_size at a time, the running sums of a chunk are 5 arrays of its size
+def rolling_ols(x, Y, begin, end, min_coverage=0.5, chunk_size=256):
+    x = np.asarray(x, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    begin = np.asarray(begin)
+    end = np.asarray(end)
+    n_stations = Y.shape[1]
+
+    # centred, so the decimal years (~2000) don't eat the precision of x^2 and x*y
+    x_mean = np.nanmean(x)
+    xc = x - x_mean
+    window_length = end - begin
+
+    slope = np.full((n_stations, len(begin)), np.nan)
+    intercept = np.full((n_stations, len(begin)), np.nan)
+
+    def running(a):
+        out = np.zeros((a.shape[0] + 1,) + a.shape[1:])
+        np.cumsum(a, axis=0, out=out[1:])
+        return out[end] - out[begin]
+
+    for start in range(0, n_stations, chunk_size):
+        stop = min(start + chunk_size, n_stations)
+        block = Y[:, start:stop]
+        valid = np.isfinite(block) & np.isfinite(xc)[:, None]
+
+        # each station's own mean taken off too, same reason
+        with np.errstate(invalid='ignore'):
+            y_mean = np.nanmean(np.where(valid, block, np.nan), axis=0)
+        yc = np.where(valid, block - y_mean, 0.0)
+        xv = np.where(valid, xc[:, None], 0.0)
+
+        n = running(valid.astype(float))
+        sx = running(xv)
+        sy = running(yc)
+        sxx = running(xv * xv)
+        sxy = running(xv * yc)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var_x = sxx - sx * sx / n
+            b = (sxy - sx * sy / n) / var_x
+            a = (sy - b * sx) / n
+
+        enough = (n >= 2) & (n >= min_coverage * window_length[:, None]) & (var_x > 0)
+        b[~enough] = np.nan
+        a[~enough] = np.nan
+
+        slope[start:stop] = b.T
+        # back to the original x and y
+        intercept[start:stop] = (a + y_mean - b * x_mean).T
+
+    return slope, intercept
+
+
+
+# the moving window OLS slope of every station: stations x windows (labelled by their years)
+# df_all_stations: the merged frame (or a station_store.StationStore), see trend_engine.batch_trends
+# the stations are read block_size at a time, only one block of the matrix is in memory (None = all at once)
+def rolling_trends(df_all_stations, station_columns, window_years=10, step_years=1, min_coverage=0.5,
+                   block_size=256):
+    station_columns = list(station_columns)
+    x = np.asarray(df_all_stations['DecimYear'], dtype=float)
+    labels, begin, end = year_windows(x, window_years, step_years)
+    slope = np.full((len(station_columns), len(labels)), np.nan)
+    block_size = block_size or max(len(station_columns), 1)
+
+    with stage('rolling_trends', stations=len(station_columns), windows=len(labels)):
+        for start in range(0, len(station_columns), block_size):
+            block = station_columns[start:start + block_size]
+            slope[start:start + len(block)], _ = rolling_ols(x, station_matrix(df_all_stations, block), begin, end,
+                                                             min_coverage=min_coverage, chunk_size=block_size)
+
+    return pd.DataFrame(slope, index=pd.Index(station_columns, name='StationID'), columns=labels)
+
+
+
+# heatmap pages of a stations x windows slope table, per_page stations to a page, all pages on one colour scale
+# (centred on 0, clipped at the 98th percentile of the absolute slopes so a few wild windows don't wash it out)
+def rolling_heatmap_pages(slopes, per_page=40, units='m/year', figsize=(12, 18)):
+    from fast_render import pyplot
+    plt = pyplot()
+
+    values = slopes.to_numpy(dtype=float)
+    finite = np.abs(values[np.isfinite(values)])
+    limit = np.percentile(finite, 98) if len(finite) else 1.0
+    limit = limit if limit > 0 else 1.0
+    cmap = plt.get_cmap('RdBu').copy()
+    cmap.set_bad('lightgrey')               # windows without enough data
+
+    for start in range(0, len(slopes), per_page):
+        page = slopes.iloc[start:start + per_page]
+
+        fig, ax = plt.subplots(figsize=figsize)
+        image = ax.imshow(np.ma.masked_invalid(page.to_numpy(dtype=float)), aspect='auto', cmap=cmap,
+                          vmin=-limit, vmax=limit, interpolation='nearest')
+
+        ax.set_yticks(np.arange(len(page)))
+        ax.set_yticklabels(page.index)
+        ax.set_xticks(np.arange(len(page.columns)))
+        ax.set_xticklabels(page.columns, rotation=90)
+        ax.set_xlabel('Window')
+        ax.set_ylabel('Station')
+        ax.set_title(f'Moving window trends (OLS), stations {start + 1}-{start + len(page)}')
+        fig.colorbar(image, ax=ax, label=f'Slope ({units})', shrink=0.6)
+
+        fig.tight_layout()
+        yield fig
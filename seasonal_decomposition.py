@@ -0,0 +1,320 @@
+## STL decomposition of many stations at once (seasonal, trend and residual components)
+## the same loops as statsmodels' STL (_stl.pyx), run on a whole (time x stations) block of series with numpy
+## the LOESS weights only depend on the series length and the window, so they are set up once and shared
+## by every station on the same grid; the components are kept in the result cache between runs
+
+# imports
+from functools import lru_cache
+import numpy as np
+from result_cache import content_hash
+
+
+
+# above this length the sliding part of a LOESS smooth is done with FFT convolutions,
+# below it every output point gets a row of one dense weight matrix
+DENSE_MAX_LENGTH = 512
+
+
+
+# the STL settings with the defaults of statsmodels' STL filled in
+def stl_settings(period, seasonal=7, trend=None, low_pass=None, seasonal_deg=1, trend_deg=1, low_pass_deg=1,
+                 robust=False, inner_iter=None, outer_iter=None):
+    if period < 2:
+        raise ValueError('period must be a positive integer >= 2')
+    if seasonal < 3 or seasonal % 2 == 0:
+        raise ValueError('seasonal must be an odd positive integer >= 3')
+
+    if trend is None:
+        trend = int(np.ceil(1.5 * period / (1 - 1.5 / seasonal)))
+        trend += ((trend % 2) == 0)
+    if low_pass is None:
+        low_pass = period + 1
+        low_pass += ((low_pass % 2) == 0)
+    if inner_iter is None:
+        inner_iter = 2 if robust else 5
+    if outer_iter is None:
+        outer_iter = 15 if robust else 0
+
+    return {'period': int(period), 'seasonal': int(seasonal), 'trend': int(trend), 'low_pass': int(low_pass),
+            'seasonal_deg': int(seasonal_deg), 'trend_deg': int(trend_deg), 'low_pass_deg': int(low_pass_deg),
+            'robust': bool(robust), 'inner_iter': int(inner_iter), 'outer_iter': int(outer_iter)}
+
+
+
+# (xs, nleft, nright) of every point _ess evaluates (jump 1), 1-based like the fortran original
+def _ess_positions(n, length):
+    if length >= n:
+        return [(i + 1, 1, n) for i in range(n)]
+
+    nsh = (length + 2) // 2
+    nleft, nright = 1, length
+    positions = []
+    for i in range(n):
+        if (i + 1) > nsh and nright != n:
+            nleft += 1
+            nright += 1
+        positions.append((i + 1, nleft, nright))
+    return positions
+
+
+
+# tricube weights of one evaluation point over its window, as in _est
+def _tricube_row(n, length, xs, nleft, nright):
+    h = max(xs - nleft, nright - xs)
+    if length > n:
+        h += (length - n) // 2
+    r = np.abs(np.arange(nleft, nright + 1) - xs).astype(float)
+
+    w = np.zeros(len(r))
+    inside = r <= 0.999 * h
+    w[inside] = (1.0 - (r[inside] / h) ** 3) ** 3
+    w[r <= 0.001 * h] = 1.0
+    return w, h
+
+
+
+# the LOESS setup of one (series length, window, degree): the kernel rows of every evaluation point,
+# times 1, d and d^2 (d = distance to the point), grouped by window, plus the FFT of the shared interior kernel
+# the output is indexed by xs: 1..n are the series points, 0 and n + 1 the two extrapolated ends
+# (only evaluated when extrapolate=True, that's what the cycle-subseries smoothing needs)
+@lru_cache(maxsize=32)
+def loess_setup(n, length, deg, extrapolate=False):
+    positions = _ess_positions(n, length)
+    if extrapolate:
+        positions = [(0, 1, min(length, n))] + positions + [(n + 1, max(1, n - length + 1), n)]
+
+    half = (length - 1) // 2
+    use_fft = n > DENSE_MAX_LENGTH and length < n
+
+    interior = []
+    groups = {}
+    for xs, nleft, nright in positions:
+        if use_fft and 1 <= xs <= n and nleft == xs - half and nright == xs + half:
+            interior.append(xs)
+        else:
+            groups.setdefault((nleft, nright) if use_fft else (1, n), []).append((xs, nleft, nright))
+
+    blocks = []
+    for (lo, hi), members in groups.items():
+        xs_out = np.array([xs for xs, _, _ in members])
+        kernel = np.zeros((len(members), hi - lo + 1))
+        fit_line = np.zeros(len(members), dtype=bool)
+        for row, (xs, nleft, nright) in enumerate(members):
+            w, h = _tricube_row(n, length, xs, nleft, nright)
+            kernel[row, nleft - lo:nright - lo + 1] = w
+            fit_line[row] = h > 0 and deg > 0
+        d = np.arange(lo, hi + 1)[None, :] - xs_out[:, None]
+        blocks.append((xs_out, lo - 1, hi, np.stack([kernel, kernel * d, kernel * d ** 2]), fit_line))
+
+    fft_part = None
+    if interior:
+        from scipy import fft as sp_fft
+        w, h = _tricube_row(n, length, half + 1, 1, length)
+        d = np.arange(-half, half + 1)
+        # reversed, so the convolution sums w(d) * x[i + d]
+        kernels = np.stack([w, w * d, w * d ** 2])[:, ::-1]
+        n_fft = sp_fft.next_fast_len(n + length - 1, real=True)
+        fft_part = (np.array(interior), half, n_fft, sp_fft.rfft(kernels, n_fft, axis=1), h > 0 and deg > 0,
+                    w.sum())
+
+    return {'n': n, 'blocks': blocks, 'fft': fft_part}
+
+
+
+# local linear (or constant) fits of every column of y at the points of a setup, robustness weights rw
+# (None = all ones); returns (n + 2) x stations indexed by xs, NaN where a window has no weight
+def loess(y, setup, rw=None):
+    n = setup['n']
+    if rw is None:
+        rw = np.ones_like(y)
+    ry = rw * y
+
+    out = np.full((n + 2, y.shape[1]), np.nan)
+    rng = n - 1.0
+
+    def _finish(xs_out, m0, m1, m2, y0, y1, fit_line, empty):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ys = y0 / m0
+            mean_d = m1 / m0
+            c = m2 / m0 - mean_d ** 2
+            use_line = fit_line & (np.sqrt(c) > 0.001 * rng)
+            ys_line = ys + (-mean_d / c) * (y1 / m0 - mean_d * ys)
+        ys = np.where(use_line, ys_line, ys)
+        ys[empty] = np.nan
+        out[xs_out] = ys
+
+    for xs_out, start, stop, kernels, fit_line in setup['blocks']:
+        r = rw[start:stop]
+        v = ry[start:stop]
+        m0 = kernels[0] @ r
+        _finish(xs_out, m0, kernels[1] @ r, kernels[2] @ r, kernels[0] @ v, kernels[1] @ v,
+                fit_line[:, None], m0 <= 0)
+
+    if setup['fft'] is not None:
+        from scipy import fft as sp_fft
+        xs_out, half, n_fft, kernel_fft, fit_line, kernel_sum = setup['fft']
+        r_fft = sp_fft.rfft(rw, n_fft, axis=0)
+        v_fft = sp_fft.rfft(ry, n_fft, axis=0)
+        rows = xs_out - 1 + half
+
+        def _conv(x_fft, q):
+            return sp_fft.irfft(x_fft * kernel_fft[q][:, None], n_fft, axis=0)[rows]
+
+        m0 = _conv(r_fft, 0)
+        # the FFT leaves rounding noise where the exact sum would be 0
+        _finish(xs_out, m0, _conv(r_fft, 1), _conv(r_fft, 2), _conv(v_fft, 0), _conv(v_fft, 1),
+                fit_line, m0 <= 1e-10 * kernel_sum)
+
+    return out
+
+
+
+# _ess: the smoothed series, a point whose window has no weight keeps its own value
+def _smooth(y, length, deg, rw=None):
+    n = y.shape[0]
+    if n < 2:
+        return y.copy()
+    ys = loess(y, loess_setup(n, length, deg), rw)[1:n + 1]
+    return np.where(np.isnan(ys), y, ys)
+
+
+
+# moving average of length k down the columns
+def _moving_average(x, k):
+    csum = np.cumsum(np.vstack([np.zeros((1, x.shape[1])), x]), axis=0)
+    return (csum[k:] - csum[:-k]) / k
+
+
+
+# _ss: every cycle-subseries (all Januaries, all Februaries...) smoothed and extended by one cycle at each end
+# the subseries of the same length are smoothed together; returns (n + 2 * period) x stations
+def _cycle_subseries(y, rw, settings):
+    n, n_stations = y.shape
+    period = settings['period']
+    out = np.empty((n + 2 * period, n_stations))
+
+    for k in sorted({(n - (j + 1)) // period + 1 for j in range(period)}):
+        js = np.array([j for j in range(period) if (n - (j + 1)) // period + 1 == k])
+        rows = js[None, :] + period * np.arange(k)[:, None]
+
+        sub_y = y[rows].reshape(k, -1)
+        sub_rw = None if rw is None else rw[rows].reshape(k, -1)
+
+        if k < 2:
+            smoothed = np.repeat(sub_y, 3, axis=0)
+        else:
+            smoothed = loess(sub_y, loess_setup(k, settings['seasonal'], settings['seasonal_deg'], True), sub_rw)
+            middle = smoothed[1:k + 1]
+            smoothed[1:k + 1] = np.where(np.isnan(middle), sub_y, middle)
+            smoothed[0] = np.where(np.isnan(smoothed[0]), smoothed[1], smoothed[0])
+            smoothed[k + 1] = np.where(np.isnan(smoothed[k + 1]), smoothed[k], smoothed[k + 1])
+
+        out_rows = js[None, :] + period * np.arange(k + 2)[:, None]
+        out[out_rows] = smoothed.reshape(k + 2, len(js), n_stations)
+
+    return out
+
+
+
+# _rwts: bisquare robustness weights from the residuals (6 x median absolute residual)
+def _robustness_weights(y, fit):
+    resid = np.abs(y - fit)
+    n = y.shape[0]
+    mid = [n // 2, n - n // 2 - 1]
+    part = np.partition(resid, mid, axis=0)
+    cmad = 3.0 * (part[mid[0]] + part[mid[1]])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rw = np.where(resid <= 0.001 * cmad, 1.0,
+             np.where(resid <= 0.999 * cmad, (1.0 - (resid / cmad) ** 2) ** 2, 0.0))
+    rw[:, cmad == 0] = 1.0
+    return rw
+
+
+
+# STL of every column of y (time x stations, no NaN, all on the same time steps)
+# settings as from stl_settings; returns a dict of seasonal, trend, resid and the robustness weights
+def batch_stl(y, settings):
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 1:
+        y = y[:, None]
+    n = y.shape[0]
+    period = settings['period']
+
+    season = np.zeros_like(y)
+    trend = np.zeros_like(y)
+    rw = None
+
+    for outer in range(settings['outer_iter'] + 1):
+        for _ in range(settings['inner_iter']):
+            cycle = _cycle_subseries(y - trend, rw, settings)
+
+            low_pass = _moving_average(_moving_average(_moving_average(cycle, period), period), 3)
+            low_pass = _smooth(low_pass, settings['low_pass'], settings['low_pass_deg'])
+
+            season = cycle[period:period + n] - low_pass
+            trend = _smooth(y - season, settings['trend'], settings['trend_deg'], rw)
+
+        if outer < settings['outer_iter']:
+            rw = _robustness_weights(y, trend + season)
+
+    return {'seasonal': season, 'trend': trend, 'resid': y - season - trend,
+            'weights': np.ones_like(y) if rw is None else rw}
+
+
+
+# STL components of every column of values (time x stations, NaN = no data), the way the scripts fit them:
+# each station's missing days are left out and its remaining values decomposed as one series
+# stations with the same number of values share a LOESS setup and are decomposed together
+# stations with fewer than min_valid values (default 2 periods, never less than one period) get NaN components
+# cache: a result_cache.ResultCache, a station's components are reused until its series or the settings change
+# returns a dict of seasonal, trend and resid (time x stations, NaN where there is no data)
+def decompose_stations(values, station_ids, stl_params, cache=None, min_valid=None, chunk_size=64):
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    station_ids = list(station_ids)
+    settings = stl_settings(**stl_params)
+    if min_valid is None:
+        min_valid = 2 * settings['period']
+
+    components = {name: np.full(values.shape, np.nan) for name in ['seasonal', 'trend', 'resid']}
+
+
+    # the cached stations first
+    to_fit = []
+    keys = {}
+    for s, station_name in enumerate(station_ids):
+        if cache is not None:
+            keys[s] = content_hash('stl', values[:, s], settings)
+            cached = cache.get(station_name, keys[s])
+            if cached is not None:
+                for name in components:
+                    components[name][:, s] = cached[name]
+                continue
+        to_fit.append(s)
+
+
+    # the rest, grouped by their number of values
+    valid = np.isfinite(values)
+    n_valid = valid.sum(axis=0)
+    by_length = {}
+    for s in to_fit:
+        if n_valid[s] >= max(min_valid, settings['period'], 2):
+            by_length.setdefault(n_valid[s], []).append(s)
+
+    for n, stations in by_length.items():
+        for j in range(0, len(stations), chunk_size):
+            chunk = stations[j:j + chunk_size]
+            compact = np.column_stack([values[valid[:, s], s] for s in chunk])
+            fitted = batch_stl(compact, settings)
+            for col, s in enumerate(chunk):
+                for name in components:
+                    components[name][valid[:, s], s] = fitted[name][:, col]
+
+
+    if cache is not None:
+        for s in to_fit:
+            cache.put(station_ids[s], keys[s], {name: components[name][:, s] for name in components})
+
+    return components
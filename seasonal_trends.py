@@ -0,0 +1,115 @@
+## Per calendar month trends of the monthly stations (is the dry season falling faster than the monsoon?)
+## every station's 1985-2018 series (the complete_date_range grid) is folded into years x months, then the OLS and
+## Theil-Sen slope of each month over the years and the seasonal Kendall test (Hirsch, Slack and Smith 1982) are
+## computed for all stations and months together; with 34 years a month has only 561 year pairs, so all of them
+## are built at once instead of 12 regressions and Theil-Sen fits per station in a loop
+
+# imports
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+from trend_engine import ols_columns
+
+
+
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+
+# Z and two sided p of a Kendall S with its variance (continuity corrected)
+def _kendall_z(s, var_s):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = np.sqrt(var_s)
+        z = np.where(s > 0, (s - 1) / sd, np.where(s < 0, (s + 1) / sd, 0.0))
+    z = np.where(var_s > 0, z, np.nan)
+    return z, 2 * ndtr(-np.abs(z))
+
+
+
+# values: months x stations on a calendar that starts in January and covers whole years (the monthly grid of
+# complete_date_range), years: the year of every row
+# months with data in fewer than min_years years get no slopes and no test
+# returns the tidy table (one row per station and month) and the seasonal Kendall test of every station
+def seasonal_trends(values, station_ids, years, min_years=10):
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    years = np.asarray(years)
+    n_rows, n_stations = values.shape
+    if n_rows % 12:
+        raise ValueError(f"The monthly series must cover whole years, got {n_rows} months")
+    n_years = n_rows // 12
+
+    # years x (months * stations): column m * n_stations + j is month m of station j
+    Y = values.reshape(n_years, 12 * n_stations)
+    x = years.reshape(n_years, 12)[:, 0].astype(float)
+    valid = np.isfinite(Y)
+    n = valid.sum(axis=0)
+    enough = n >= max(min_years, 3)
+
+
+    # OLS over the years
+    ols_slope, ols_intercept = ols_columns(x, Y)
+
+
+    # every pair of years (i < j): slope, sign and tie of the values
+    i, j = np.triu_indices(n_years, 1)
+    dy = Y[j] - Y[i]
+    pair_slope = dy / (x[j] - x[i])[:, None]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)      # months without any pair
+        ts_slope = np.nanmedian(np.where(np.isfinite(pair_slope), pair_slope, np.nan), axis=0) if len(i) else np.full(Y.shape[1], np.nan)
+        ts_intercept = np.nanmedian(Y, axis=0) - ts_slope * np.nanmedian(np.where(valid, x[:, None], np.nan), axis=0)
+
+    s = np.nansum(np.sign(dy), axis=0)
+
+    # tie correction: every value counts the values equal to it (its own included), a group of t equal values
+    # then adds t * (t - 1) * (2t + 5) once over its t members
+    equal = (Y[:, None, :] == Y[None, :, :]).sum(axis=1).astype(float)
+    tie_term = np.where(valid, (equal - 1) * (2 * equal + 5), 0.0).sum(axis=0)
+    var_s = (n * (n - 1.0) * (2 * n + 5) - tie_term) / 18
+    mk_z, mk_p = _kendall_z(s, var_s)
+
+    for column in (ols_slope, ols_intercept, ts_slope, ts_intercept, mk_z, mk_p):
+        column[~enough] = np.nan
+
+
+    station_ids = np.asarray(station_ids, dtype=object)
+    by_month = pd.DataFrame({
+        'StationID': np.tile(station_ids, 12),
+        'Month': np.repeat(np.arange(1, 13), n_stations),
+        'MonthName': np.repeat(MONTH_NAMES, n_stations),
+        'Years': n,
+        'OLS_Slope': ols_slope,
+        'OLS_Intercept': ols_intercept,
+        'TheilSen_Slope': ts_slope,
+        'TheilSen_Intercept': ts_intercept,
+        'MK_S': np.where(enough, s, np.nan),
+        'MK_Z': mk_z,
+        'MK_p': mk_p})
+    by_month = by_month.sort_values(['StationID', 'Month'], kind='stable').reset_index(drop=True)
+
+
+    # seasonal Kendall: the months' S and variances summed (months taken as independent), and the
+    # seasonal Kendall slope, the median of the pair slopes of all the months together
+    used = enough.reshape(12, n_stations)
+    sk_s = np.where(used, s.reshape(12, n_stations), 0.0).sum(axis=0)
+    sk_var = np.where(used, var_s.reshape(12, n_stations), 0.0).sum(axis=0)
+    sk_z, sk_p = _kendall_z(sk_s, sk_var)
+
+    pooled = np.where(np.repeat(used[None, :, :], len(i), axis=0), pair_slope.reshape(len(i), 12, n_stations), np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        sk_slope = np.nanmedian(pooled.reshape(len(i) * 12, n_stations), axis=0) if len(i) else np.full(n_stations, np.nan)
+
+    seasonal_kendall = pd.DataFrame({
+        'StationID': station_ids,
+        'MonthsUsed': used.sum(axis=0),
+        'SeasonalKendall_S': sk_s,
+        'SeasonalKendall_Z': sk_z,
+        'SeasonalKendall_p': sk_p,
+        'SeasonalKendall_Slope': sk_slope})
+
+    return by_month, seasonal_kendall
@@ -0,0 +1,246 @@
+## Per-stage timing of a pipeline run: the drivers and the engines mark their stages with `with stage(...)`,
+## which does nothing until a trace is started; with a trace every stage adds one JSON line (wall and CPU time,
+## peak memory, station) and stop_trace prints the slowest stages and stations
+## only the process that started the trace records (pages run in worker processes are not traced)
+
+# imports
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:        # not on Windows
+    resource = None
+
+
+
+# the trace of this process, None = not tracing
+_trace = None
+
+
+
+class StageTrace:
+
+    # path: JSON lines file the records are appended to (None = only kept in memory)
+    # memory: trace the peak Python/numpy allocation of every stage with tracemalloc (slows the run down),
+    #         otherwise only the process' peak resident memory so far is recorded
+    # profile_station: run cProfile over the stages of this station, stats written to profile_dir
+    def __init__(self, path=None, memory=False, profile_station=None, profile_dir='.'):
+        self.path = path
+        self.memory = memory
+        self.profile_station = profile_station
+        self.profile_dir = profile_dir
+
+        self.records = []
+        self.stack = []
+        self.profiler = None
+        self.start = time.perf_counter()
+        self.file = open(path, 'a', buffering=1) if path else None
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+    def _enter(self, name, station, info):
+        frame = {'name': name, 'station': station, 'info': info, 'profiling': False,
+                 'wall': time.perf_counter(), 'cpu': time.process_time()}
+
+        if self.memory:
+            # the peak is reset for every stage, the enclosing stage keeps the highest one seen so far
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+            frame['base'] = current
+            frame['peak'] = current
+            tracemalloc.reset_peak()
+
+        if station is not None and station == self.profile_station and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            frame['profiling'] = True
+            self.profiler.enable()
+
+        self.stack.append(frame)
+
+
+    def _exit(self, frame):
+        wall = time.perf_counter() - frame['wall']
+        cpu = time.process_time() - frame['cpu']
+        self.stack.pop()
+
+        if frame['profiling']:
+            self.profiler.disable()
+            self._write_profile(frame)
+            self.profiler = None
+
+        if frame.get('discard'):
+            return
+
+        record = {'stage': frame['name'], 'station': frame['station'],
+                  'parent': self.stack[-1]['name'] if self.stack else None, 'depth': len(self.stack),
+                  'start_s': round(frame['wall'] - self.start, 6), 'wall_s': wall, 'cpu_s': cpu, **frame['info']}
+
+        if self.memory:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = (peak - frame['base']) / 1024 ** 2
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+        if resource is not None:
+            # ru_maxrss is in KB on Linux and in bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            record['max_rss_mb'] = max_rss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+        self.records.append(record)
+        if self.file is not None:
+            self.file.write(json.dumps(record, default=str) + '\n')
+
+
+    def _write_profile(self, frame):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f"{frame['station']}_{frame['name']}".replace(os.sep, '_')
+        prof_path = os.path.join(self.profile_dir, f'{name}.prof')
+        self.profiler.dump_stats(prof_path)
+
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(20)
+        print(f"cProfile of {frame['station']} ({frame['name']}) saved to: {prof_path}")
+        print(out.getvalue())
+
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+
+# start tracing this process (see StageTrace for the options), replaces a trace that is still running
+def start_trace(path=None, memory=False, profile_station=None, profile_dir='.'):
+    global _trace
+    if _trace is not None:
+        stop_trace(summary=False)
+    _trace = StageTrace(path, memory=memory, profile_station=profile_station, profile_dir=profile_dir)
+    return _trace
+
+
+
+# stop tracing, print the summary and return the records as a frame
+def stop_trace(summary=True, top=10):
+    global _trace
+    trace, _trace = _trace, None
+    if trace is None:
+        return pd.DataFrame()
+
+    trace.close()
+    records = pd.DataFrame(trace.records)
+    if summary:
+        print_summary(records, top=top)
+    return records
+
+
+
+# marks a stage of the run, e.g. `with stage('stl', station_name):`, extra keywords go into the record
+# (a no-op when no trace is running); yields the open stage (None when not tracing)
+@contextmanager
+def stage(name, station=None, **info):
+    trace = _trace
+    if trace is None:
+        yield None
+        return
+
+    trace._enter(name, station, info)
+    frame = trace.stack[-1]
+    try:
+        yield frame
+    finally:
+        trace._exit(frame)
+
+
+
+# the items of a generator with the work of producing each one as a stage (page=1, 2, ...), for the page loops
+# where the drawing happens inside run_pages_cached
+def staged(items, name):
+    iterator = iter(items)
+
+    for number in itertools.count(1):
+        with stage(name, page=number) as frame:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                if frame is not None:
+                    frame['discard'] = True
+                return
+        yield item
+
+
+
+# a trace file as a frame
+def load_trace(path):
+    with open(path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+
+# the stages by total wall time, and the stations by the wall time of their outermost stages
+# (a stage of a station inside another stage of the same station is not counted twice)
+def summarize(records, top=10):
+    if records.empty:
+        return pd.DataFrame(), pd.DataFrame()
+
+    stages = records.groupby('stage').agg(count=('wall_s', 'size'), total_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'),
+                                          mean_s=('wall_s', 'mean'), max_s=('wall_s', 'max'))
+    if 'peak_mb' in records:
+        stages['peak_mb'] = records.groupby('stage')['peak_mb'].max()
+    stages = stages.sort_values('total_s', ascending=False).head(top)
+
+    per_station = records[records['station'].notna()]
+    if per_station.empty:
+        return stages, pd.DataFrame()
+
+    # outermost: no enclosing stage of the same station started before it and is still open around it
+    per_station = per_station.assign(end_s=per_station['start_s'] + per_station['wall_s'])
+    outermost = []
+    for _, group in per_station.sort_values(['station', 'start_s', 'depth']).groupby('station'):
+        open_until = -1.0
+        for idx, start, end in zip(group.index, group['start_s'], group['end_s']):
+            if start >= open_until:
+                outermost.append(idx)
+                open_until = end
+    stations = per_station.loc[outermost].groupby('station').agg(total_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'))
+    if 'peak_mb' in per_station:
+        stations['peak_mb'] = per_station.groupby('station')['peak_mb'].max()
+
+    # the slowest stage inside each station (its outermost one when it has nothing inside)
+    def _slowest(rows):
+        return rows.sort_values('wall_s').groupby('station').tail(1).set_index('station')['stage']
+
+    slowest = _slowest(per_station.drop(index=outermost))
+    stations['slowest_stage'] = slowest.reindex(stations.index).fillna(_slowest(per_station))
+    stations = stations.sort_values('total_s', ascending=False).head(top)
+
+    return stages, stations
+
+
+
+def print_summary(records, top=10):
+    stages, stations = summarize(records, top=top)
+    if stages.empty:
+        print("No stages were traced")
+        return
+
+    with pd.option_context('display.width', 160, 'display.float_format', '{:.3f}'.format):
+        print(f"\nSlowest stages (top {top}):")
+        print(stages.to_string())
+        if not stations.empty:
+            print(f"\nSlowest stations (top {top}):")
+            print(stations.to_string())
@@ -0,0 +1,217 @@
+## One index of every station: its monthly/daily files, tidal or non-tidal, coordinates and danger level record
+## built in one scan of the data folders, kept as JSON next to the data and rebuilt when a file changes (mtime/size)
+
+# imports
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+
+CATALOG_VERSION = 1
+
+
+
+# the station id of a station file, the part of its name before the first '_'
+# (SW72B_monthly.csv, SW136.1_tidal.csv, SW8_nontidal_daily.csv ...); a bare station id (SW136.1) comes back as it is
+def station_id_from_path(file_path):
+    station_id = os.path.basename(file_path).split('_')[0]
+    return station_id[:-len('.csv')] if station_id.endswith('.csv') else station_id
+
+
+
+# the danger level row of every station, the first one when a station is listed more than once
+# (the row tmplt used to get with a boolean mask over the whole table for every station)
+class DangerLevelIndex:
+
+    def __init__(self, danger_level_data, id_column='StationID'):
+        self.data = danger_level_data
+        first = ~danger_level_data[id_column].duplicated(keep='first')
+        ids = danger_level_data[id_column].to_numpy()
+        self.rows = {station_id: position for station_id, position in zip(ids[first.to_numpy()], np.flatnonzero(first))}
+
+
+    def __contains__(self, station_id):
+        return station_id in self.rows
+
+
+    # the record as a Series, None when there is none
+    def get(self, station_id):
+        position = self.rows.get(station_id)
+        return None if position is None else self.data.iloc[position]
+
+
+    # the record as a one row frame (empty when there is none), the shape the cache keys hash
+    def frame(self, station_id):
+        position = self.rows.get(station_id)
+        return self.data.iloc[[] if position is None else [position]]
+
+
+
+# the files of a list of folders with their modification time and size, the catalog's fingerprint
+def _scan(folders, extra_files):
+    found = {}
+    for folder, _, _ in folders:
+        if not os.path.isdir(folder):
+            continue
+        for entry in os.scandir(folder):
+            if entry.is_file() and entry.name.endswith('.csv'):
+                stat = entry.stat()
+                found[entry.path] = [stat.st_mtime_ns, stat.st_size]
+    for file_path in extra_files:
+        if file_path and os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            found[file_path] = [stat.st_mtime_ns, stat.st_size]
+    return found
+
+
+
+def _json_value(value):
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (np.floating, float)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, (np.bool_,)):
+        return bool(value)
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    return value
+
+
+
+# folders: list of (folder, 'monthly' or 'daily', 'tidal' or 'nontidal')
+# danger_level_path / coordinates_path: the BWDB danger level table and the station info table (StationID,
+# Latitude, Longitude), both optional; catalog_path: where the index is kept between runs (None = not kept)
+class StationCatalog:
+
+    def __init__(self, folders, danger_level_path=None, coordinates_path=None, catalog_path=None):
+        self.folders = [(os.path.abspath(folder), resolution, tide) for folder, resolution, tide in folders]
+        self.danger_level_path = danger_level_path
+        self.coordinates_path = coordinates_path
+        self.catalog_path = catalog_path
+
+        self.stations = None
+        self.rebuilt = False
+        self.refresh()
+
+
+    def _settings(self):
+        return {'version': CATALOG_VERSION, 'folders': self.folders, 'danger_level_path': self.danger_level_path,
+                'coordinates_path': self.coordinates_path}
+
+
+    # reload the kept index if nothing changed on disk, otherwise scan again
+    def refresh(self):
+        fingerprint = _scan(self.folders, [self.danger_level_path, self.coordinates_path])
+
+        if self.catalog_path and os.path.isfile(self.catalog_path):
+            try:
+                with open(self.catalog_path) as f:
+                    kept = json.load(f)
+                if kept.get('settings') == json.loads(json.dumps(self._settings())) and kept.get('files') == fingerprint:
+                    self.stations = kept['stations']
+                    self.rebuilt = False
+                    return self
+            except (ValueError, KeyError):
+                pass
+
+        self.stations = self._build(fingerprint)
+        self.rebuilt = True
+
+        if self.catalog_path:
+            tmp_path = self.catalog_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'settings': self._settings(), 'files': fingerprint, 'stations': self.stations}, f)
+            os.replace(tmp_path, self.catalog_path)
+        return self
+
+
+    def _record(self, stations, station_id):
+        if station_id not in stations:
+            stations[station_id] = {'monthly': [], 'daily': [], 'tide': None, 'latitude': None, 'longitude': None,
+                                    'danger_level': None}
+        return stations[station_id]
+
+
+    def _build(self, fingerprint):
+        stations = {}
+
+        for folder, resolution, tide in self.folders:
+            files = sorted(file_path for file_path in fingerprint if os.path.dirname(file_path) == folder)
+            for file_path in files:
+                record = self._record(stations, station_id_from_path(file_path))
+                record[resolution].append(file_path)
+                record['tide'] = record['tide'] or tide
+
+        if self.coordinates_path and os.path.isfile(self.coordinates_path):
+            coords = pd.read_csv(self.coordinates_path).drop_duplicates(subset='StationID', keep='first')
+            for station_id, lat, lon in zip(coords['StationID'], coords['Latitude'], coords['Longitude']):
+                if station_id in stations:
+                    stations[station_id]['latitude'] = _json_value(lat)
+                    stations[station_id]['longitude'] = _json_value(lon)
+
+        if self.danger_level_path and os.path.isfile(self.danger_level_path):
+            dl = pd.read_csv(self.danger_level_path).drop_duplicates(subset='StationID', keep='first')
+            for row in dl.to_dict(orient='records'):
+                if row['StationID'] in stations:
+                    stations[row['StationID']]['danger_level'] = {key: _json_value(value) for key, value in row.items()}
+
+        return stations
+
+
+    def __contains__(self, station_id):
+        return station_id in self.stations
+
+
+    def __getitem__(self, station_id):
+        return self.stations[station_id]
+
+
+    def get(self, station_id, default=None):
+        return self.stations.get(station_id, default)
+
+
+    # station ids that have files of the given resolution (and tide), in order
+    def station_ids(self, resolution=None, tide=None):
+        return sorted(station_id for station_id, record in self.stations.items()
+                      if (resolution is None or record[resolution]) and (tide is None or record['tide'] == tide))
+
+
+    # the files of one resolution of the given stations (all stations when None)
+    def files(self, resolution, station_ids=None, tide=None):
+        if station_ids is None:
+            station_ids = self.station_ids(resolution, tide)
+        return [file_path for station_id in station_ids if station_id in self.stations
+                for file_path in self.stations[station_id][resolution]]
+
+
+
+# puts the files into destination_folder as hard links (no bytes copied, the same file under a second name)
+# and falls back to a copy where a link is not possible (another disk, a file system without links)
+# note: a linked file is the same file, editing it in place edits the original too
+def link_files(file_paths, destination_folder):
+    os.makedirs(destination_folder, exist_ok=True)
+    linked, copied = 0, 0
+
+    for file_path in file_paths:
+        if not os.path.isfile(file_path):
+            print(f"File not found: {file_path}")
+            continue
+
+        destination = os.path.join(destination_folder, os.path.basename(file_path))
+        if os.path.exists(destination):
+            if os.path.samefile(file_path, destination):
+                linked += 1
+                continue
+            os.remove(destination)
+
+        try:
+            os.link(file_path, destination)
+            linked += 1
+        except OSError:
+            shutil.copy(file_path, destination)
+            copied += 1
+
+    return linked, copied
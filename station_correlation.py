@@ -0,0 +1,258 @@
+## How every station relates to the others: pairwise complete Pearson / Spearman correlation of the whole daily
+## station matrix and the number of common days of each pair, plus the k nearest neighbour graph of the stations
+## that weighs the correlation with the distance between them (for the curation lists and the gap filling checks)
+## the sums over the common days of every pair are masked matrix products, done block x block of stations so the
+## memory stays at a few (days x block) arrays instead of what pandas df.corr() needs for the whole matrix
+## (Spearman: the pairs with different gaps are re-ranked over their common days on top of that, see _rerank_pairs)
+
+# imports
+import numpy as np
+import pandas as pd
+from rain_correlation import haversine_km
+from stage_trace import stage
+
+
+
+# the columns of Y (time x stations), NaN kept, replaced by their ranks within the column (ties get their mean rank)
+def column_ranks(Y):
+    return pd.DataFrame(np.asarray(Y, dtype=float)).rank(axis=0, method='average').to_numpy()
+
+
+
+# each column centred on its mean (NaN cells 0) and its mask, so the sums of squares don't lose precision
+def _centred(Y):
+    valid = np.isfinite(Y)
+    with np.errstate(invalid='ignore'):
+        mean = np.nanmean(np.where(valid, Y, np.nan), axis=0)
+    return np.where(valid, Y - mean, 0.0), valid.astype(float)
+
+
+
+# correlation and common days of the columns a (time x m) with the columns b (time x n) over the days each pair has
+def _block_correlation(Za, Va, Zb, Vb):
+    overlap = Va.T @ Vb
+    sum_a = Za.T @ Vb               # [i, j]: sum of a_i over the days both a_i and b_j have
+    sum_b = Va.T @ Zb
+    sum_aa = (Za * Za).T @ Vb
+    sum_bb = Va.T @ (Zb * Zb)
+    sum_ab = Za.T @ Zb
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = sum_ab - sum_a * sum_b / overlap
+        var_a = sum_aa - sum_a ** 2 / overlap
+        var_b = sum_bb - sum_b ** 2 / overlap
+        corr = cov / np.sqrt(var_a * var_b)
+
+    corr[(overlap < 2) | ~(var_a > 0) | ~(var_b > 0)] = np.nan
+    return np.clip(corr, -1.0, 1.0), np.rint(overlap).astype(np.int64)
+
+
+
+# every column's days in value order (the days without a value last) and, for every place in that order, the
+# first and the last place of its run of tied values
+def _value_order(Y):
+    key = np.where(np.isfinite(Y), Y, np.inf)
+    order = np.argsort(key, axis=0, kind='stable')
+    key = np.take_along_axis(key, order, axis=0)
+
+    place = np.arange(len(Y))[:, None]
+    tie_start = np.ones(key.shape, dtype=bool)
+    tie_start[1:] = key[1:] != key[:-1]
+    tie_end = np.ones(key.shape, dtype=bool)
+    tie_end[:-1] = tie_start[1:]
+    first = np.maximum.accumulate(np.where(tie_start, place, 0), axis=0)
+    last = np.minimum.accumulate(np.where(tie_end, place, len(Y) - 1)[::-1], axis=0)[::-1]
+    return order, first, last
+
+
+
+# ranks (ties get their mean rank) of the days within the masked ones, in value order
+# mask: days x pairs in the value order of the ranked column, first / last: its tie runs (see _value_order)
+def _ranks_within(mask, first, last):
+    count = np.cumsum(mask, axis=0, dtype=np.int32)
+    below = np.take_along_axis(count - mask, first, axis=0)
+    upto = np.take_along_axis(count, last, axis=0)
+    return (below + upto + 1) / 2
+
+
+
+# the Spearman correlation of the pairs whose gaps differ, each pair re-ranked over its common days (what
+# pandas df.corr('spearman') does), written into corr; the pairs with the same gaps are left out, the
+# correlation of their whole record ranks already is the pairwise one
+# a station's rank of a day among the common days is a running count of the common days in its value order,
+# so the re-ranking is a cumulative sum per pair, the value order of every station is sorted once per block
+def _rerank_pairs(Y, corr, block_size):
+    n_days, n_stations = Y.shape
+    valid = np.isfinite(Y)
+    gaps = pd.factorize(pd.Series([valid[:, j].tobytes() for j in range(n_stations)]))[0]
+    starts = range(0, n_stations, block_size)
+
+    for a in starts:
+        order_a, first_a, last_a = _value_order(Y[:, a:a + block_size])
+        for b in starts:
+            if b < a:
+                continue
+            order_b, first_b, last_b = _value_order(Y[:, b:b + block_size])
+            J = np.arange(b, min(b + block_size, n_stations))
+
+            for i in range(a, min(a + block_size, n_stations)):
+                pick = (J > i) & (gaps[J] != gaps[i])
+                if not pick.any():
+                    continue
+                j = J[pick]
+                common = valid[:, [i]] & valid[:, j]
+
+                # i ranked within the days it shares with each j, and each j within the days it shares with i
+                o = order_a[:, [i - a]]
+                ri = np.empty(common.shape)
+                np.put_along_axis(ri, o, _ranks_within(common[o[:, 0]], first_a[:, [i - a]], last_a[:, [i - a]]),
+                                  axis=0)
+                o = order_b[:, pick]
+                rj = np.empty(common.shape)
+                np.put_along_axis(rj, o, _ranks_within(valid[o, i], first_b[:, pick], last_b[:, pick]), axis=0)
+
+                # both ranks run 1..m over the m common days, so their mean is (m + 1) / 2
+                m = common.sum(axis=0)
+                di = np.where(common, ri - (m + 1) / 2, 0.0)
+                dj = np.where(common, rj - (m + 1) / 2, 0.0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    c = (di * dj).sum(axis=0) / np.sqrt((di * di).sum(axis=0) * (dj * dj).sum(axis=0))
+                c[(m < 2) | ~np.isfinite(c)] = np.nan
+
+                corr[i, j] = corr[j, i] = np.clip(c, -1.0, 1.0)
+
+
+
+# the correlation of every pair of columns of Y (time x stations, NaN = no value) over their common days and
+# the number of those days; method 'pearson', 'spearman' or 'spearman_global'
+# spearman: pairwise complete like pandas df.corr('spearman'), every pair ranked over its common days; one matrix
+# product for the pairs with the same gaps, the others re-ranked pair by pair (about as slow as pandas, ~20 s for
+# 150 stations that all have different gaps, but in block sized memory)
+# spearman_global: the fast approximation, each station ranked once over its own record and the Pearson correlation
+# of those ranks taken over the common days; not the pairwise statistic when the gaps of a pair differ (a station
+# with a gap in the dry season has its monsoon days ranked lower against the full record than over the common days)
+# block_size: stations per block, the memory is about 4 (days x block_size) arrays
+def pairwise_correlation(Y, method='pearson', block_size=256):
+    if method not in ('pearson', 'spearman', 'spearman_global'):
+        raise ValueError(f"Unknown correlation method {method!r}, use 'pearson', 'spearman' or 'spearman_global'")
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    values = Y
+    if method != 'pearson':
+        Y = column_ranks(Y)
+
+    n_stations = Y.shape[1]
+    corr = np.empty((n_stations, n_stations))
+    overlap = np.empty((n_stations, n_stations), dtype=np.int64)
+    starts = range(0, n_stations, block_size)
+
+    with stage('pairwise_correlation', stations=n_stations, method=method):
+        for a in starts:
+            Za, Va = _centred(Y[:, a:a + block_size])
+            for b in starts:
+                if b < a:
+                    continue
+                Zb, Vb = (Za, Va) if b == a else _centred(Y[:, b:b + block_size])
+                c, n = _block_correlation(Za, Va, Zb, Vb)
+                corr[a:a + block_size, b:b + block_size] = c
+                overlap[a:a + block_size, b:b + block_size] = n
+                corr[b:b + block_size, a:a + block_size] = c.T
+                overlap[b:b + block_size, a:a + block_size] = n.T
+
+        if method == 'spearman':
+            with stage('spearman_rerank', stations=n_stations):
+                _rerank_pairs(values, corr, block_size)
+
+    return corr, overlap
+
+
+
+# the correlation matrix as a frame (station ids on both axes)
+def correlation_frame(corr, station_ids):
+    index = pd.Index(list(station_ids), name='StationID')
+    return pd.DataFrame(corr, index=index, columns=index)
+
+
+
+# the k best neighbours of every station, the score of a pair is |r| * exp(-distance / distance_scale_km)
+# (only pairs with at least min_overlap common days and within max_km), so a well correlated station nearby ranks
+# above an equally correlated one across the country; a station without coordinates is scored on |r| alone
+# lat / lon: one per station (NaN = unknown), None = correlation only
+# returns (stations x k) neighbour positions (-1 = none) and one row per edge: StationID, Neighbour, Rank,
+# Correlation, Overlap, DistanceKm, Score
+def neighbour_graph(corr, overlap, station_ids, lat=None, lon=None, k=5, min_overlap=365, max_km=None,
+                    distance_scale_km=100.0):
+    station_ids = np.asarray(list(station_ids), dtype=object)
+    n_stations = len(station_ids)
+
+    if lat is None or lon is None:
+        distance = np.full((n_stations, n_stations), np.nan)
+    else:
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        distance = haversine_km(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+
+    with np.errstate(invalid='ignore'):
+        weight = np.where(np.isfinite(distance), np.exp(-distance / distance_scale_km), 1.0)
+        score = np.abs(corr) * weight
+        usable = np.isfinite(score) & (overlap >= min_overlap)
+        if max_km is not None:
+            usable &= ~(distance > max_km)
+    score = np.where(usable, score, -1.0)
+    np.fill_diagonal(score, -1.0)
+
+    k = min(k, max(n_stations - 1, 0))
+    order = np.argsort(-score, axis=1, kind='stable')[:, :k]
+    neighbours = np.where(np.take_along_axis(score, order, axis=1) >= 0, order, -1)
+
+    station, rank = np.nonzero(neighbours >= 0)
+    other = neighbours[station, rank]
+    edges = pd.DataFrame({
+        'StationID': station_ids[station],
+        'Neighbour': station_ids[other],
+        'Rank': rank + 1,
+        'Correlation': corr[station, other],
+        'Overlap': overlap[station, other],
+        'DistanceKm': distance[station, other],
+        'Score': score[station, other]})
+
+    return neighbours, edges
+
+
+
+
+
+if __name__ == "__main__":
+
+    # the merged matrix of merge_surface_water_data and the station info table (StationID, Latitude, Longitude)
+    merged_csv_path = '/Users/biar/Desktop/merged_surface_water_data.csv'                    ### change when needed
+    coordinates_path = '/Users/biar/Desktop/BWDB_SWL_station_info.csv'                       ### change when needed
+    correlation_csv_path = '/Users/biar/Desktop/station_correlation.csv'                     ### change when needed
+    overlap_csv_path = '/Users/biar/Desktop/station_correlation_overlap.csv'                 ### change when needed
+    graph_csv_path = '/Users/biar/Desktop/station_neighbours.csv'                            ### change when needed
+
+    ## 'pearson', 'spearman' (pairwise complete, slow) or 'spearman_global' (each station ranked over its own
+    ## record, fast, not the pairwise statistic where the gaps differ: see pairwise_correlation), neighbours per
+    ## station, and the common days a pair needs
+    method = 'pearson'                                                                       ### change when needed
+    k = 5                                                                                    ### change when needed
+    min_overlap = 365                                                                        ### change when needed
+
+
+    df = pd.read_csv(merged_csv_path)
+    station_columns = [col for col in df.columns if col not in ['Date', 'Year', 'Month', 'Day', 'DecimYear']]
+
+    corr, overlap = pairwise_correlation(df[station_columns].to_numpy(dtype=float), method=method)
+
+    coords = pd.read_csv(coordinates_path).drop_duplicates(subset='StationID').set_index('StationID')
+    coords = coords.reindex(station_columns)
+    neighbours, edges = neighbour_graph(corr, overlap, station_columns, coords['Latitude'], coords['Longitude'],
+                                        k=k, min_overlap=min_overlap)
+
+
+    correlation_frame(corr, station_columns).to_csv(correlation_csv_path)
+    correlation_frame(overlap, station_columns).to_csv(overlap_csv_path)
+    edges.to_csv(graph_csv_path, index=False)
+    print(f"Correlations ({method}) of {len(station_columns)} stations saved to: {correlation_csv_path}")
+    print(f"Neighbour graph ({len(edges)} edges) saved to: {graph_csv_path}")
@@ -0,0 +1,201 @@
+## Binary store of the merged daily station matrix (the CSV of merge_surface_water_data) for quick starts
+## stations x days in one .npy file (float64 or float32) next to the date / decimal year axis and the station ids,
+## opened memory-mapped: nothing is read until a station is used and a station column is a view, not a copy
+
+# imports
+import json
+import os
+import numpy as np
+import pandas as pd
+from calendar_grid import decimal_year
+
+
+
+STORE_VERSION = 1
+
+# the calendar columns of the merged CSV, everything else is a station
+STORE_META_COLUMNS = ['Date', 'Year', 'Month', 'Day', 'DecimYear']
+
+
+
+def _paths(store_dir):
+    return {name: os.path.join(store_dir, file_name) for name, file_name in
+            [('values', 'values.npy'), ('dates', 'dates.npy'), ('decimal_year', 'decimal_year.npy'),
+             ('meta', 'store.json')]}
+
+
+# the CSV a store (or a cached result) was built from, its path, modification time and size
+def source_fingerprint(csv_path):
+    stat = os.stat(csv_path)
+    return {'path': os.path.abspath(csv_path), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+
+# writes the axis files and the metadata around a values file filled by fill(values), the metadata last,
+# so a store whose store.json is there is complete
+def _write_store(store_dir, dates, dec_year, station_ids, dtype, fill, source=None):
+    os.makedirs(store_dir, exist_ok=True)
+    paths = _paths(store_dir)
+    if os.path.exists(paths['meta']):
+        os.remove(paths['meta'])
+
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    np.save(paths['dates'], dates)
+    np.save(paths['decimal_year'], np.asarray(dec_year, dtype=float))
+
+    values = np.lib.format.open_memmap(paths['values'], mode='w+', dtype=np.dtype(dtype),
+                                       shape=(len(station_ids), len(dates)))
+    fill(values)
+    values.flush()
+    del values
+
+    meta = {'version': STORE_VERSION, 'station_ids': list(station_ids), 'dtype': np.dtype(dtype).name,
+            'n_days': len(dates), 'source': source}
+    tmp_path = paths['meta'] + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, paths['meta'])
+    return StationStore(store_dir)
+
+
+
+# a merged frame (Date, Year, Month, Day, DecimYear, SW...) as a store
+def write_station_store(df_all_stations, store_dir, dtype='float64', station_columns=None):
+    if station_columns is None:
+        station_columns = [col for col in df_all_stations.columns if col not in STORE_META_COLUMNS]
+    station_columns = list(station_columns)
+
+    dates = pd.to_datetime(df_all_stations['Date'])
+    dec_year = df_all_stations['DecimYear'] if 'DecimYear' in df_all_stations else decimal_year(dates)
+
+    def fill(values):
+        for j, station_name in enumerate(station_columns):
+            values[j] = df_all_stations[station_name].to_numpy(dtype=values.dtype)
+
+    return _write_store(store_dir, dates, dec_year, station_columns, dtype, fill)
+
+
+
+# the merged CSV as a store, read chunksize rows at a time (memory stays at about one chunk however many stations)
+def build_station_store(csv_path, store_dir, dtype='float64', chunksize=1000):
+    header = pd.read_csv(csv_path, nrows=0).columns
+    station_ids = [col for col in header if col not in STORE_META_COLUMNS]
+
+    axis = pd.read_csv(csv_path, usecols=[col for col in ['Date', 'DecimYear'] if col in header])
+    dates = pd.to_datetime(axis['Date'])
+    dec_year = axis['DecimYear'] if 'DecimYear' in axis else decimal_year(dates)
+
+    def fill(values):
+        start = 0
+        for chunk in pd.read_csv(csv_path, usecols=station_ids, dtype={name: values.dtype for name in station_ids},
+                                 chunksize=chunksize):
+            stop = start + len(chunk)
+            values[:, start:stop] = chunk[station_ids].to_numpy(dtype=values.dtype).T
+            start = stop
+
+    return _write_store(store_dir, dates, dec_year, station_ids, dtype, fill, source=source_fingerprint(csv_path))
+
+
+
+# the store of a merged CSV, built again only when the CSV (or the dtype) changed since the store was written
+def open_station_store(csv_path, store_dir, dtype='float64', chunksize=1000):
+    meta_path = _paths(store_dir)['meta']
+    if os.path.isfile(meta_path):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('version') == STORE_VERSION and meta.get('dtype') == np.dtype(dtype).name \
+                    and meta.get('source') == source_fingerprint(csv_path):
+                return StationStore(store_dir)
+        except (ValueError, KeyError):
+            pass
+
+    print(f"Building the station store of {csv_path} in {store_dir}")
+    return build_station_store(csv_path, store_dir, dtype=dtype, chunksize=chunksize)
+
+
+
+# an opened store; store[station_id] is that station's row of the memory-mapped matrix (a view, no copy),
+# store['Date'] / store['DecimYear'] / store['Year'] ... the calendar, so the plots can use it like the merged frame
+class StationStore:
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        paths = _paths(store_dir)
+
+        with open(paths['meta']) as f:
+            meta = json.load(f)
+        if meta.get('version') != STORE_VERSION:
+            raise ValueError(f"Station store {store_dir} has version {meta.get('version')}, expected {STORE_VERSION}")
+
+        self.station_ids = meta['station_ids']
+        self.positions = {station_id: j for j, station_id in enumerate(self.station_ids)}
+        self.values = np.load(paths['values'], mmap_mode='r')
+        self.dates = np.load(paths['dates'])
+        self.decimal_year = np.load(paths['decimal_year'])
+
+
+    # only the directory travels to the worker processes, they open the files themselves
+    def __getstate__(self):
+        return {'store_dir': self.store_dir}
+
+
+    def __setstate__(self, state):
+        self.__init__(state['store_dir'])
+
+
+    def __len__(self):
+        return len(self.dates)
+
+
+    def __contains__(self, key):
+        return key in self.positions or key in STORE_META_COLUMNS
+
+
+    @property
+    def columns(self):
+        return STORE_META_COLUMNS + self.station_ids
+
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+
+    def __getitem__(self, key):
+        if key in self.positions:
+            return self.values[self.positions[key]]
+        if key == 'DecimYear':
+            return self.decimal_year
+        if key == 'Date':
+            return np.datetime_as_string(self.dates, unit='D')
+        if key in ('Year', 'Month', 'Day'):
+            dates = pd.DatetimeIndex(self.dates)
+            return getattr(dates, key.lower()).to_numpy(dtype=np.int64)
+        raise KeyError(key)
+
+
+    # days x stations of the given stations (all when None), as a new array of dtype
+    def matrix(self, station_ids=None, dtype=float):
+        if station_ids is None:
+            return self.values.T.astype(dtype)
+        rows = [self.positions[station_id] for station_id in station_ids]
+        out = np.empty((len(self), len(rows)), dtype=dtype)
+        for k, j in enumerate(rows):
+            out[:, k] = self.values[j]
+        return out
+
+
+    # the merged frame layout (Date, Year, Month, Day, DecimYear, stations), a copy
+    def frame(self, station_ids=None):
+        station_ids = self.station_ids if station_ids is None else list(station_ids)
+        df = pd.DataFrame({name: self[name] for name in STORE_META_COLUMNS})
+        return pd.concat([df, pd.DataFrame(self.matrix(station_ids), columns=station_ids)], axis=1)
+
+
+
+# days x stations of a merged frame or a StationStore, float64 unless asked otherwise
+def station_matrix(source, station_ids, dtype=float):
+    if isinstance(source, StationStore):
+        return source.matrix(station_ids, dtype=dtype)
+    return source[list(station_ids)].to_numpy(dtype=dtype)
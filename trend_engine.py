@@ -0,0 +1,258 @@
+## Headless trend statistics for the whole daily station matrix (no plotting in here)
+## the input is the wide frame from merge_surface_water_data: Date, Year, Month, Day, DecimYear, SW...
+
+# imports
+import numpy as np
+import pandas as pd
+from theilsen import theil_sen
+from mann_kendall import mann_kendall
+from seasonal_decomposition import decompose_stations
+from parallel_run import paginate, run_pages
+from exceedance import exceedance_engine
+from result_cache import content_hash
+from stage_trace import stage
+from station_store import StationStore, station_matrix
+from extreme_values import gev_analysis, RETURN_PERIODS
+
+
+
+# stations where the BWDB danger level is not usable, the 95th percentile is adopted instead
+ninetyfive_percentile_station = ['SW113', 'SW67', 'SW332', 'SW293', 'SW331', 'SW327', 'SW57A', 'SW262',
+                                 'SW209A','SW222', 'SW272', 'SW270', 'SW271','SW182','SW250','SW176','SW107',
+                                 'SW128','SW73','SW280','SW158','SW181','SW233','SW114','SW264A','SW157',
+                                 'SW335','SW311.4','SW97']
+
+
+# the columns of the_result_table / the summary CSV, in order
+RESULT_COLUMNS = ['StationID', 'StartDate', 'EndDate', 'MeanLevel', 'Linear_Slope', 'Deseasonalised_Slope',
+                  'TheilSen_Slope', 'MK_S', 'MK_Z', 'MK_p', 'DangerLevel_adopted', 'BWDB_DangerLevel', '95th_DL', 'Interpolated_DL',
+                  'DL_ReturnPeriod'] + [f'ReturnLevel_{T}' for T in RETURN_PERIODS] + [
+                  'Total_Amount_of_Data', 'DL_Exceeded_Count', 'DL_Exceeded_Percentage', 'DL_Exceeded_Per_Year']
+
+META_COLUMNS = ['Date', 'Year', 'Month', 'Day', 'DecimYear']
+
+# the STL of the daily series (also part of the result cache keys)
+daily_stl_params = {'period': 365, 'robust': True}
+
+
+
+# closed form least squares of every column of Y (time x stations) against x, NaN cells are left out per column
+def ols_columns(x, Y):
+    x = np.asarray(x, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:, None]
+
+    valid = np.isfinite(Y) & np.isfinite(x)[:, None]
+    n = valid.sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.where(valid, x[:, None], 0.0).sum(axis=0) / n
+        y_mean = np.where(valid, Y, 0.0).sum(axis=0) / n
+
+        # centred sums, so the decimal years (~2000) don't eat the precision
+        dx = np.where(valid, x[:, None] - x_mean, 0.0)
+        dy = np.where(valid, Y - y_mean, 0.0)
+        sxx = (dx * dx).sum(axis=0)
+        sxy = (dx * dy).sum(axis=0)
+
+        slope = sxy / sxx
+        intercept = y_mean - slope * x_mean
+
+    too_few = n < 2
+    slope[too_few] = np.nan
+    intercept[too_few] = np.nan
+    return slope, intercept
+
+
+
+# BWDB, interpolated and 95th percentile danger levels for every station, and which one is adopted
+def adopted_danger_levels(station_columns, danger_level_data, dl_95th):
+    dl_lookup = danger_level_data.drop_duplicates(subset='StationID', keep='first').set_index('StationID')
+    dl_lookup = dl_lookup.reindex(station_columns)
+
+    bwdb = dl_lookup['DLm'].to_numpy(dtype=float)
+    interp = dl_lookup['DLmInterp'].to_numpy(dtype=float)
+
+    use_95th = np.isin(station_columns, ninetyfive_percentile_station)
+    adopted = np.where(use_95th, dl_95th, np.where(np.isnan(bwdb), interp, bwdb))
+    source = np.where(use_95th, '95th Percentile', np.where(np.isnan(bwdb), 'Interpolated', 'BWDB'))
+
+    return pd.DataFrame({
+        'StationName': dl_lookup['StationNam'].to_numpy(),
+        'RiverName': dl_lookup['RiverName'].to_numpy(),
+        'BWDB_DangerLevel': bwdb,
+        'Interpolated_DL': interp,
+        'DangerLevel_adopted': adopted,
+        'DL_Source': source}, index=pd.Index(station_columns, name='StationID'))
+
+
+
+# the expensive per-station part (Theil-Sen), run on a chunk of stations
+# with a cache, a station is only refitted when its series or the fit settings changed
+# (the danger levels only enter the cheap vectorized part, so changing one never refits anything)
+def _slow_trends_chunk(chunk, shared):
+    x, df_all_stations, theilsen_method, cache = shared
+    out = []
+
+    for station_name in chunk:
+        values = np.asarray(df_all_stations[station_name], dtype=float)
+
+        if cache is not None:
+            key = content_hash('daily_theilsen', values, x, {'theilsen_method': theilsen_method})
+            cached = cache.get(station_name, key)
+            if cached is not None:
+                out.append(cached)
+                continue
+
+        with stage('theilsen', station_name):
+            slope_sen, intercept_sen, lo_s, high_s = theil_sen(values, x, method=theilsen_method)
+
+        out.append((slope_sen, intercept_sen))
+        if cache is not None:
+            cache.put(station_name, key, out[-1])
+
+    return out
+
+
+
+# the whole the_result_table in one go, plus the intercepts/danger level source the plots need
+# the STL of all stations is done together (seasonal_decomposition.py), n_workers > 1 spreads the
+# Theil-Sen fits over a process pool
+# theilsen_method='approx' samples the pairwise slopes instead of selecting the exact median (see theilsen.py)
+# cache: a result_cache.ResultCache, unchanged stations (their STL components and Theil-Sen fit) are then served from disk
+# df_all_stations can also be a station_store.StationStore (the workers then open the store instead of getting a copy)
+# gev_method: the GEV of the annual maxima from the L-moments ('lmoments') or refined by maximum likelihood ('mle',
+# on the pool with n_workers), see extreme_values.py
+# return_events=True: (results, events), events the runs above the adopted danger level of exceedance_engine
+# (start, duration, peak of every one), so the caller doesn't run the exceedance over the whole matrix again
+# block_size: stations whose days x stations matrix is in memory at a time (every statistic is per station), so
+# with a store the memory stays at a few blocks however many stations there are (None = all at once)
+def batch_trends(df_all_stations, danger_level_data, station_columns=None, n_workers=1, chunk_size=16,
+                 theilsen_method='exact', cache=None, gev_method='lmoments', return_events=False, block_size=256):
+
+    if station_columns is None:
+        station_columns = [col for col in df_all_stations.columns
+                           if col.startswith('SW') and col not in META_COLUMNS]
+    station_columns = list(station_columns)
+    block_size = block_size or max(len(station_columns), 1)
+
+    calendar = (pd.DatetimeIndex(pd.to_datetime(df_all_stations['Date'])),
+                np.asarray(df_all_stations['DecimYear'], dtype=float), np.asarray(df_all_stations['Date']))
+
+    blocks = [_trends_block(df_all_stations, danger_level_data, station_columns[start:start + block_size], calendar,
+                            n_workers, chunk_size, theilsen_method, cache, gev_method)
+              for start in range(0, len(station_columns), block_size)]
+
+    results = pd.concat([results for results, _ in blocks], ignore_index=True)
+    if return_events:
+        return results, pd.concat([events for _, events in blocks], ignore_index=True)
+    return results
+
+
+
+# the results (and the exceedance events) of one block of stations, see batch_trends
+def _trends_block(df_all_stations, danger_level_data, station_columns, calendar, n_workers, chunk_size,
+                  theilsen_method, cache, gev_method):
+    dates, x, date_labels = calendar
+    Y = station_matrix(df_all_stations, station_columns)
+    n_days = len(date_labels)
+
+
+    # STL of every station, batched
+    with stage('stl', stations=len(station_columns)):
+        seasonal = decompose_stations(Y, station_columns, daily_stl_params, cache=cache)['seasonal']
+
+    # Theil-Sen, per station (in the pool if asked)
+    slope_sen = np.empty(len(station_columns))
+    intercept_sen = np.empty(len(station_columns))
+
+    chunks = paginate(station_columns, per_page=chunk_size)
+    k = 0
+    stations = df_all_stations if isinstance(df_all_stations, StationStore) else df_all_stations[station_columns]
+    for chunk_out in run_pages(_slow_trends_chunk, chunks, n_workers=n_workers,
+                               shared=(x, stations, theilsen_method, cache)):
+        for s, b in chunk_out:
+            slope_sen[k] = s
+            intercept_sen[k] = b
+            k += 1
+
+
+    # Mann-Kendall significance of all stations at once (ties and, with the Theil-Sen slopes, the serial
+    # correlation corrected for, see mann_kendall.py)
+    with stage('mann_kendall', stations=len(station_columns)):
+        mk = mann_kendall(Y, x, slope_sen)
+
+    # all the least squares fits at once
+    with stage('regression', stations=len(station_columns)):
+        slope_linear, intercept_linear = ols_columns(x, Y)
+        slope_desea, intercept_desea = ols_columns(x, Y - seasonal)
+
+    with np.errstate(invalid='ignore'):
+        mean_level = np.round(np.nanmean(Y, axis=0), 2)
+        dl_95th = np.round(np.nanpercentile(Y, 95, axis=0), 2)
+
+
+    # danger levels and exceedance
+    dl_table = adopted_danger_levels(station_columns, danger_level_data, dl_95th)
+    danger_level = dl_table['DangerLevel_adopted'].to_numpy()
+
+    with stage('exceedance', stations=len(station_columns)):
+        exceedance = exceedance_engine(Y, danger_level, dates, station_columns)
+    count = exceedance['count']
+    percentage = np.round(count / n_days * 100, 2)
+
+    # return period of the adopted danger level and the return levels, from the GEV of the annual maxima
+    with stage('extreme_values', stations=len(station_columns)):
+        gev = gev_analysis(Y, dates, station_columns, danger_level, method=gev_method, n_workers=n_workers)
+
+    per_year = exceedance['per_year']
+    exceed_per_year = [dict(zip(per_year.index.tolist(), per_year.iloc[:, k].tolist())) for k in range(len(station_columns))]
+
+
+    results = pd.DataFrame({
+        'StationID': station_columns,
+        'StartDate': date_labels[0],
+        'EndDate': date_labels[-1],
+        'MeanLevel': mean_level,
+        'Linear_Slope': slope_linear,
+        'Deseasonalised_Slope': slope_desea,
+        'TheilSen_Slope': slope_sen,
+        'MK_S': mk['S'],
+        'MK_Z': mk['Z'],
+        'MK_p': mk['p'],
+        'DangerLevel_adopted': danger_level,
+        'BWDB_DangerLevel': dl_table['BWDB_DangerLevel'].to_numpy(),
+        '95th_DL': dl_95th,
+        'Interpolated_DL': dl_table['Interpolated_DL'].to_numpy(),
+        'DL_ReturnPeriod': np.round(gev['DL_ReturnPeriod'].to_numpy(), 2),
+        **{f'ReturnLevel_{T}': np.round(gev[f'ReturnLevel_{T}'].to_numpy(), 2) for T in RETURN_PERIODS},
+        'Total_Amount_of_Data': n_days,
+        'DL_Exceeded_Count': count,
+        'DL_Exceeded_Percentage': percentage,
+        'DL_Exceeded_Per_Year': exceed_per_year,
+        # only used for drawing
+        'Linear_Intercept': intercept_linear,
+        'Deseasonalised_Intercept': intercept_desea,
+        'TheilSen_Intercept': intercept_sen,
+        'MK_Correction': mk['Correction'],
+        'GEV_Years': gev['GEV_Years'].to_numpy(),
+        'GEV_Location': gev['GEV_Location'].to_numpy(),
+        'GEV_Scale': gev['GEV_Scale'].to_numpy(),
+        'GEV_Shape': gev['GEV_Shape'].to_numpy(),
+        'DL_Source': dl_table['DL_Source'].to_numpy(),
+        'StationName': dl_table['StationName'].to_numpy(),
+        'RiverName': dl_table['RiverName'].to_numpy()})
+
+    return results, exceedance['events']
+
+
+
+# flattening the per year dict into one column per year, the layout of the summary CSV
+def summary_table(results):
+    results_df = results[RESULT_COLUMNS].reset_index(drop=True)
+
+    exceed_per_year_df = pd.json_normalize(results_df['DL_Exceeded_Per_Year'])
+    exceed_per_year_df['StationID'] = results_df['StationID']
+
+    return pd.concat([results_df.drop(columns=['DL_Exceeded_Per_Year']), exceed_per_year_df], axis=1)